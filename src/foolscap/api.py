@@ -17,14 +17,17 @@ from foolscap.pb import Tub
 
 # names we import so that others can reach them as foolscap.api.foo
 from foolscap.remoteinterface import RemoteInterface
-from foolscap.referenceable import Referenceable, SturdyRef
+from foolscap.referenceable import Referenceable, SturdyRef, broadcastRemote, \
+     callRemoteBatch
 from foolscap.copyable import Copyable, RemoteCopy, registerRemoteCopy
 from foolscap.copyable import registerCopier, registerRemoteCopyFactory
 from foolscap.ipb import DeadReferenceError, IConnectionHintHandler
 from foolscap.tokens import BananaError
 from foolscap.schema import StringConstraint, IntegerConstraint, \
-    ListOf, TupleOf, SetOf, DictOf, ChoiceOf, Any
+    ListOf, TupleOf, SetOf, DictOf, ChoiceOf, Any, Blob, BlobConstraint
 from foolscap.storage import serialize, unserialize
+from foolscap.prepared import PreSerialized
+from foolscap.blocking import blocking, cpu_bound
 from foolscap.tokens import Violation, RemoteException
 from foolscap.eventual import eventually, fireEventually, flushEventualQueue
 from foolscap.logging import app_versions
@@ -34,14 +37,14 @@ _unused = [
     __version__,
     Tub,
     RemoteInterface,
-    Referenceable, SturdyRef,
+    Referenceable, SturdyRef, broadcastRemote, callRemoteBatch,
     Copyable, RemoteCopy, registerRemoteCopy,
     registerCopier, registerRemoteCopyFactory,
     DeadReferenceError, IConnectionHintHandler,
     BananaError,
     StringConstraint, IntegerConstraint,
-    ListOf, TupleOf, SetOf, DictOf, ChoiceOf, Any,
-    serialize, unserialize,
+    ListOf, TupleOf, SetOf, DictOf, ChoiceOf, Any, Blob, BlobConstraint,
+    serialize, unserialize, PreSerialized, blocking, cpu_bound,
     Violation, RemoteException,
     eventually, fireEventually, flushEventualQueue,
     app_versions,
@@ -1,9 +1,9 @@
 
 import six
-import struct, time
+import re, struct
 import collections
 
-from twisted.internet import protocol, defer, reactor
+from twisted.internet import protocol, defer
 from twisted.python.failure import Failure
 from twisted.python import log
 
@@ -16,15 +16,24 @@ from . import tokens
 
 from .tokens import BananaError, BananaFailure, Violation
 from .tokens import SIZE_LIMIT, LIST, INT, NEG, FLOAT, OPEN, CLOSE, ABORT, ERROR, PING, PONG
-from .tokens import BYTES, STRING, BVOCAB, SVOCAB
+from .tokens import BYTES, STRING, BVOCAB, SVOCAB, NONE, TRUE, FALSE
+from .eventual import eventually
+from .vocab import AdaptiveVocabulary
+from .timerwheel import TimerWheel
 
 
 STUB = object()
 
-EPSILON = 0.1
 MAXINT  =  2 ** 31 - 1
 MININT  = -2 ** 31
 
+# the first banana-decision-version that knows the NONE/TRUE/FALSE tokens
+COMPACT_TOKENS_VERSION = 192
+# the first one that accepts top-level (add-vocab)/(set-vocab) sequences
+ADAPTIVE_VOCAB_VERSION = 193
+# the first one that accepts (blob) sequences
+BLOB_VERSION = 199
+
 struct_uint  = struct.Struct('>I')
 struct_float = struct.Struct('!d')
 
@@ -70,13 +79,31 @@ class Banana(protocol.Protocol):
     prefixLimit = 64
     smallestInt = -2 ** (prefixLimit * 7) + 1
     largestInt  =  2 ** (prefixLimit * 7) - 1
+    vocabManager = None
+    # the peer may add this many entries to the negotiated initial table
+    # (far more than its AdaptiveVocabulary will use): populateVocabTable()
+    # sets maxIncomingVocabulary to the size of that table plus this
+    maxAddedIncomingVocabulary = 2048
+    maxIncomingVocabulary = maxAddedIncomingVocabulary
 
     def __init__(self, features={}):
         """
         @param features: a dictionary of negotiated connection features
         """
+        version = features.get('banana-decision-version') or 0
+        # None/True/False go out as single-byte tokens instead of
+        # OPEN/'none'/CLOSE sequences, but only if the peer can read them
+        self.compactTokens = COMPACT_TOKENS_VERSION <= version
+        # Blobs may only be sent, or received, if both ends know (blob)
+        self.blobs = BLOB_VERSION <= version
+        # (add-vocab)/(set-vocab) sequences may only be sent, or received,
+        # once both ends adapt their vocabulary
+        self.adaptiveVocab = ADAPTIVE_VOCAB_VERSION <= version
         self.initSend()
         self.initReceive()
+        if self.adaptiveVocab:
+            # hot strings are added to the outbound vocab table as they show up
+            self.vocabManager = AdaptiveVocabulary()
 
     def populateVocabTable(self, vocabStrings):
         """
@@ -90,10 +117,17 @@ class Banana(protocol.Protocol):
         contents of this table.
         """
 
+        if self.vocabManager:
+            self.vocabManager.base = list(vocabStrings)
+
         out_vocabDict = dict([(v, k) for k, v in enumerate(vocabStrings)])
         self.outgoingVocabTableWasReplaced(out_vocabDict)
 
         in_vocabDict = dict(enumerate(vocabStrings))
+        # however many application words the table holds, the peer gets the
+        # same room for its own additions
+        self.maxIncomingVocabulary = (len(in_vocabDict) +
+                                      self.maxAddedIncomingVocabulary)
         self.replaceIncomingVocabulary(in_vocabDict)
 
     ### connection setup
@@ -105,22 +139,36 @@ class Banana(protocol.Protocol):
         self.initSlicer()
         self.initUnslicer()
 
+        if (self.keepaliveTimeout is not None
+            or self.disconnectTimeout is not None):
+            # the idle deadlines live on a timer wheel, normally the one
+            # that our Tub shares among all of its Brokers
+            if self.idleTimers is None:
+                self.idleTimers = TimerWheel()
+            self.dataLastReceivedAt = self.idleTimers.clock.seconds()
+            self.useKeepalives = True
+
         if self.keepaliveTimeout is not None:
-            self.dataLastReceivedAt = time.time()
-            t = reactor.callLater(self.keepaliveTimeout + EPSILON, self.keepaliveTimerFired)
+            self.idleTimers.fitTimeout(self.keepaliveTimeout)
+            t = self.idleTimers.callLater(self.keepaliveTimeout,
+                                          self.keepaliveTimerFired)
             self.keepaliveTimer = t
-            self.useKeepalives = True
 
         if self.disconnectTimeout is not None:
-            self.dataLastReceivedAt = time.time()
-            t = reactor.callLater(self.disconnectTimeout + EPSILON, self.disconnectTimerFired)
+            self.idleTimers.fitTimeout(self.disconnectTimeout)
+            t = self.idleTimers.callLater(self.disconnectTimeout,
+                                          self.disconnectTimerFired)
             self.disconnectTimer = t
-            self.useKeepalives = True
 
         # prime the pump
         self.produce()
 
     def connectionLost(self, why):
+        # whatever is still sitting in the write buffer can never be sent
+        self.discardWrites()
+        watchers, self.writeWatchers = self.writeWatchers, []
+        for offset, d in watchers:
+            d.errback(why)
         if self.disconnectTimer:
             self.disconnectTimer.cancel()
             self.disconnectTimer = None
@@ -138,11 +186,47 @@ class Banana(protocol.Protocol):
     streamable  = True # this is checked at connectionMade() time
     debugSend   = False
 
+    # Outbound tokens are accumulated in a write buffer and handed to the
+    # transport in a single write() call. When coalesceWrites is False, the
+    # buffer is flushed each time a top-level object has been completely
+    # serialized (and whenever produce() runs out of work). When it is True,
+    # the flush is put off until the end of the current reactor turn, so
+    # back-to-back send() calls share a single write. In either mode the
+    # buffer is flushed early once it holds maxWriteBatch bytes.
+    coalesceWrites = False
+    maxWriteBatch  = 64 * 1024
+
+    # The Broker lets us register with its transport as a streaming
+    # producer, but only for as long as the transport is pushing back: we
+    # register before each write(), and unregister once a write() has gone
+    # through without pausing us, or once resumeProducing() has drained the
+    # buffer. A TLS transport will not close while a producer is
+    # registered, and transport.loseConnection() has to keep working.
+    # While the transport has us paused, the write buffer holds on to
+    # outbound data instead of handing it over, and once it reaches
+    # highWatermark bytes, produce() stops pulling tokens from the
+    # slicerStack. resumeProducing() drains the buffer into the transport
+    # (for as long as the transport will take it), and slicing starts again
+    # once no more than lowWatermark bytes are left.
+    highWatermark  = 256 * 1024
+    lowWatermark   = 64 * 1024
+
     def initSend(self):
         self.openCount = 0
         self.outgoingVocabulary = {}
         self.nextAvailableOutgoingVocabularyIndex = 0
         self.pendingVocabAdditions = set()
+        self.writeBuffer = []
+        self.writeBufferSize = 0
+        self.writeFlushScheduled = False
+        self.writeFlushCount = 0 # number of transport.write() calls
+        self.writeFlushBytes = 0 # total bytes handed to the transport
+        self.writeFlushMaxBytes = 0 # largest single flush
+        self.writeWatchers = [] # (offset, Deferred), see whenWritten()
+        self.useBackpressure = False # see registerWithTransport()
+        self.producerRegistered = False
+        self.transportPaused = False
+        self.produceInterrupted = False
 
     def initSlicer(self):
         self.rootSlicer = self.slicerClass(self)
@@ -157,10 +241,10 @@ class Banana(protocol.Protocol):
 
         self.slicerStack = [top]
 
-    def send(self, obj):
+    def send(self, obj, priority=tokens.PRIORITY_NORMAL, key=None):
         if self.debugSend:
             print('Banana.send(%s) / rootSlicer=%r' % (obj, self.rootSlicer))
-        return self.rootSlicer.send(obj)
+        return self.rootSlicer.send(obj, priority, key)
 
     def _slice_error(self, f, s):
         log.msg('Error in Deferred returned by slicer %s: %s' % (s, f))
@@ -169,12 +253,21 @@ class Banana(protocol.Protocol):
     def produce(self, dummy=None):
         # optimize: cache 'next' because we get many more tokens than stack
         # pushes/pops
-        while self.slicerStack and not self.paused:
+        while self.slicerStack:
+            if self.paused:
+                # the transport is full. resumeProducing() will restart us
+                self.produceInterrupted = True
+                break
             if self.debugSend:
                 print('produce.loop')
 
             try:
                 slicer, next, openID = self.slicerStack[-1]
+                if slicer is self.rootSlicer and not self.coalesceWrites:
+                    # a top-level object has just been finished (or is about
+                    # to be started): hand its bytes to the transport before
+                    # the RootSlicer announces its completion
+                    self.flushWrites()
                 obj = next()
 
                 if self.debugSend:
@@ -242,6 +335,7 @@ class Banana(protocol.Protocol):
                 return
 
         assert self.slicerStack # should never be empty
+        self.scheduleFlush()
 
     def handleSendViolation(self, f, doPop, sendAbort):
         f.value.setLocation(self.describeSend())
@@ -330,6 +424,8 @@ class Banana(protocol.Protocol):
         # we are now committed to sending the OPEN token, meaning that
         # failures after this point will cause an ABORT/CLOSE to be sent
 
+        if slicer.measureBytes:
+            slicer.startOffset = self.writeFlushBytes + self.writeBufferSize
         openID = None
         if slicer.sendOpen:
             openID = self.sendOpen()
@@ -348,6 +444,10 @@ class Banana(protocol.Protocol):
         if openID is not None:
             self.sendClose(openID)
 
+        if slicer.measureBytes:
+            size = self.writeFlushBytes + self.writeBufferSize
+            slicer.sentBytes(size - slicer.startOffset)
+
         if self.debugSend:
             print('pop', slicer)
 
@@ -365,7 +465,7 @@ class Banana(protocol.Protocol):
 
         return '.'.join(where)
 
-    def setOutgoingVocabulary(self, vocabBytes):
+    def setOutgoingVocabulary(self, vocabBytes, priority=tokens.PRIORITY_NORMAL):
         """Schedule a replacement of the outbound VOCAB table.
 
         Higher-level code may call this at any time with a list of strings.
@@ -400,7 +500,7 @@ class Banana(protocol.Protocol):
         # differential compression), but confusing. It accomplishes this by
         # clearing our self.outgoingVocabulary dict when it begins to be
         # serialized.
-        self.send(s)
+        self.send(s, priority)
 
         # likewise, when it finishes, the ReplaceVocabSlicer replaces our
         # self.outgoingVocabulary dict when it has finished sending the
@@ -424,10 +524,19 @@ class Banana(protocol.Protocol):
             self.pendingVocabAdditions.add(value)  # [bw] возможна утечка?
             self.send(AddVocabSlicer(value))
 
+    def maybeVocabize(self, value):
+        # called when the vocab manager thinks 'value' is worth a table
+        # entry. Strings inside a (set-vocab) or (add-vocab) sequence are
+        # left alone: the table is being rewritten until it is finished.
+        if not isinstance(self.slicerStack[-1][0], (ReplaceVocabSlicer, AddVocabSlicer)):
+            self.addToOutgoingVocabulary(value)
+
     def outgoingVocabTableWasReplaced(self, newTable):
         # this is called by the ReplaceVocabSlicer to manipulate our table.
         # It must certainly *not* be called by higher-level user code.
         self.outgoingVocabulary = newTable
+        if self.vocabManager:
+            self.vocabManager.replaced(newTable)
         if newTable:
             maxIndex = max(newTable.values()) + 1
             self.nextAvailableOutgoingVocabularyIndex = maxIndex
@@ -446,6 +555,13 @@ class Banana(protocol.Protocol):
         # return self.outgoingVocabulary[value]
 
         self.pendingVocabAdditions.remove(value)  # [bw] --> outgoingVocabTableWasAmended
+
+        vm = self.vocabManager
+        if vm and vm.isFull():
+            # reuse the slot of the least-used adaptive entry. The far end
+            # simply overwrites it when the (add-vocab) arrives.
+            return self.outgoingVocabulary.pop(vm.evict())
+
         index = self.nextAvailableOutgoingVocabularyIndex
         self.nextAvailableOutgoingVocabularyIndex = index + 1
         return index
@@ -455,28 +571,184 @@ class Banana(protocol.Protocol):
         assert type(value) is bytes, type(value)
         self.outgoingVocabulary[value] = index
 
+        vm = self.vocabManager
+        if vm:
+            vm.added(value)
+            if vm.wantsReset():
+                # the table has churned all the way through: start over with
+                # the entries that are still earning their keep. This goes
+                # ahead of anything else in the queue, so no (add-vocab) can
+                # change the table before it is sent.
+                self.setOutgoingVocabulary(vm.resetTable(), tokens.PRIORITY_HIGH)
+
+    # these methods manage the outbound write buffer
+
+    def bufferWrite(self, data):
+        self.writeBuffer.append(data)
+        self.writeBufferSize += len(data)
+        if self.writeBufferSize >= self.maxWriteBatch:
+            self.flushWrites()
+
+    def scheduleFlush(self):
+        if not self.writeBuffer:
+            return
+        if not self.coalesceWrites:
+            self.flushWrites()
+        elif not self.writeFlushScheduled:
+            self.writeFlushScheduled = True
+            eventually(self._scheduledFlush)
+
+    def _scheduledFlush(self):
+        self.writeFlushScheduled = False
+        self.flushWrites()
+
+    def flushWrites(self, force=False):
+        """Hand the write buffer to the transport, using one write() call
+        per maxWriteBatch bytes. While the transport has paused us, the data
+        is held back unless force=True."""
+        if not self.transport:
+            self.discardWrites()
+            return
+        while self.writeBuffer:
+            if self.transportPaused and not force:
+                if self.writeBufferSize >= self.highWatermark:
+                    self.paused = True
+                return
+            if force or self.writeBufferSize <= self.maxWriteBatch:
+                chunks = self.writeBuffer
+                self.writeBuffer = []
+            else:
+                # take whole chunks until we have a full batch, leaving the
+                # rest for later in case the transport pauses us again
+                size = 0
+                for i, chunk in enumerate(self.writeBuffer):
+                    size += len(chunk)
+                    if size >= self.maxWriteBatch:
+                        break
+                chunks = self.writeBuffer[:i+1]
+                del self.writeBuffer[:i+1]
+            if len(chunks) == 1:
+                data = chunks[0]
+            else:
+                data = b''.join(chunks)
+            self.writeBufferSize -= len(data)
+            self.writeFlushCount += 1
+            self.writeFlushBytes += len(data)
+            if len(data) > self.writeFlushMaxBytes:
+                self.writeFlushMaxBytes = len(data)
+            if self.useBackpressure and not self.producerRegistered:
+                self.producerRegistered = True
+                self.transport.registerProducer(self, True)
+            # this may call pauseProducing() before it returns
+            self.transport.write(data)
+        if self.producerRegistered and not self.transportPaused:
+            self.unregisterFromTransport()
+        if self.writeWatchers:
+            self.checkWriteWatchers()
+
+    def discardWrites(self):
+        self.writeBuffer = []
+        self.writeBufferSize = 0
+
+    def whenWritten(self):
+        """Return a Deferred that fires (with None) once everything which
+        has been serialized so far has been handed to the transport, and
+        the transport has accepted it without pausing us (or has since
+        resumed). The Deferred errbacks if the connection is lost first."""
+        d = defer.Deferred()
+        offset = self.writeFlushBytes + self.writeBufferSize
+        self.writeWatchers.append((offset, d))
+        self.checkWriteWatchers()
+        return d
+
+    def checkWriteWatchers(self):
+        if self.transportPaused:
+            return
+        # offsets only ever grow, so the list is sorted
+        while self.writeWatchers:
+            offset, d = self.writeWatchers[0]
+            if offset > self.writeFlushBytes:
+                break
+            self.writeWatchers.pop(0)
+            d.callback(None)
+
+    # IPushProducer, for the benefit of our transport
+
+    def pauseProducing(self):
+        self.transportPaused = True
+
+    def resumeProducing(self):
+        self.transportPaused = False
+        self.flushWrites()
+        self.checkWriteWatchers()
+        if self.paused and self.writeBufferSize <= self.lowWatermark:
+            self.paused = False
+            if self.produceInterrupted:
+                self.produceInterrupted = False
+                self.produce()
+
+    def stopProducing(self):
+        # the transport is going away, connectionLost() will follow
+        self.producerRegistered = False
+        self.transportPaused = True
+        self.paused = True
+
+    def registerWithTransport(self):
+        # let the transport tell us when its buffer is full, so we can stop
+        # slicing instead of piling up data in memory. flushWrites() does
+        # the actual registering, around each write().
+        self.useBackpressure = hasattr(self.transport, "registerProducer")
+
+    def unregisterFromTransport(self):
+        if self.producerRegistered:
+            self.producerRegistered = False
+            self.transport.unregisterProducer()
+
+    def dropConnection(self):
+        # transports will not close while a producer is still registered,
+        # and if the transport is holding us back, it may be a while before
+        # flushWrites() would unregister us
+        self.unregisterFromTransport()
+        self.transport.loseConnection()
+
+    def getWriteStats(self):
+        """Return a dictionary describing how outbound data has been batched
+        into transport writes."""
+        count = self.writeFlushCount
+        return {
+            'flushes': count,
+            'bytes': self.writeFlushBytes,
+            'max-bytes-per-flush': self.writeFlushMaxBytes,
+            'mean-bytes-per-flush': (self.writeFlushBytes / count
+                                     if count else 0),
+            'buffered-bytes': self.writeBufferSize,
+            'transport-paused': self.transportPaused,
+            'slicing-paused': self.paused,
+        }
+
     # these methods define how we emit low-level tokens
 
     def sendPING(self, number=0):
         if number:
-            int2b128(number, self.transport.write)
-        self.transport.write(PING)
+            int2b128(number, self.bufferWrite)
+        self.bufferWrite(PING)
+        self.scheduleFlush()
 
     def sendPONG(self, number):
         if number:
-            int2b128(number, self.transport.write)
-        self.transport.write(PONG)
+            int2b128(number, self.bufferWrite)
+        self.bufferWrite(PONG)
+        self.scheduleFlush()
 
     def sendOpen(self):
         openID = self.openCount
         self.openCount += 1
-        int2b128(openID, self.transport.write)
-        self.transport.write(OPEN)
+        int2b128(openID, self.bufferWrite)
+        self.bufferWrite(OPEN)
         return openID
 
     def sendToken(self, obj, write=STUB):
-        write = self.transport.write if write is STUB else write
-
+        write = self.bufferWrite if write is STUB else write
         if type(obj) is int:
             if obj < self.smallestInt or self.largestInt < obj:
                 raise BananaError('int is too large to send (%d)' % obj)
@@ -496,47 +768,81 @@ class Banana(protocol.Protocol):
         if type(obj) is bytes:
             if self.debugSend:
                 print('sendToken[bytes]: ({}) {!r}'.format(len(obj), obj))
-            if obj in self.outgoingVocabulary:
-                int2b128(self.outgoingVocabulary[obj], write)
+            index = self.outgoingVocabulary.get(obj)
+            if index is not None:
+                int2b128(index, write)
                 write(BVOCAB)
+                if self.vocabManager:
+                    self.vocabManager.hit(obj)
             else:
                 if self.sizeLimit < len(obj):
                     raise BananaError('bytes is too long to send (%d)', obj)
-# @todo:        self.maybeVocabizeSymbol(obj) / maybeVocabizeString
                 int2b128(len(obj), write)
                 write(BYTES)
                 write(obj)
+                if self.vocabManager and self.vocabManager.miss(obj):
+                    self.maybeVocabize(obj)
             return True
 
         if type(obj) is str:
             if self.debugSend:
                 print('sendToken[str]: ({}) {!r}'.format(len(obj), obj))
             data = obj.encode('utf8')
-            if data in self.outgoingVocabulary:
-                int2b128(self.outgoingVocabulary[data], write)
+            index = self.outgoingVocabulary.get(data)
+            if index is not None:
+                int2b128(index, write)
                 write(SVOCAB)
+                if self.vocabManager:
+                    self.vocabManager.hit(data)
             else:
                 if self.sizeLimit < len(data):
                     raise BananaError('string is too long to send', data)
-# @todo:        self.maybeVocabizeSymbol(obj) / maybeVocabizeString
                 int2b128(len(data), write)
                 write(STRING)
                 write(data)
+                if self.vocabManager and self.vocabManager.miss(data):
+                    self.maybeVocabize(data)
             return True
 
-        # @todo: (?) NONE / BOOL / ...
+        if self.compactTokens:
+            if obj is None:
+                write(NONE)
+                return True
+            if obj is True:
+                write(TRUE)
+                return True
+            if obj is False:
+                write(FALSE)
+                return True
+
         #else:
         #   raise BananaError("could not send object: %s" % repr(obj))
 
         return False
 
     def sendClose(self, openID):
-        int2b128(openID, self.transport.write)
-        self.transport.write(CLOSE)
+        int2b128(openID, self.bufferWrite)
+        self.bufferWrite(CLOSE)
+
+    def sendPrepared(self, prepared):
+        # write a PreparedTokens recording verbatim. Its OPEN/CLOSE numbers
+        # and (reference) targets were counted from zero, so they are moved
+        # past the sequences this connection has already opened.
+        segments, openCount = prepared.getEncoding(self.compactTokens)
+        base = self.openCount
+        write = self.bufferWrite
+        for segment in segments:
+            if type(segment) is bytes:
+                write(segment)
+            else:
+                offset, typebyte = segment
+                int2b128(base + offset, write)
+                write(typebyte)
+        self.openCount = base + openCount
 
     def sendAbort(self, count=0):
-        int2b128(count, self.transport.write)
-        self.transport.write(ABORT)
+        int2b128(count, self.bufferWrite)
+        self.bufferWrite(ABORT)
 
     def sendError(self, msg):
         if not self.transport:
@@ -544,11 +850,12 @@ class Banana(protocol.Protocol):
         if len(msg) > self.sizeLimit:
             msg = msg[:self.sizeLimit-10] + "..."
         msg = msg.encode('utf8', 'replace')
-        int2b128(len(msg), self.transport.write)
-        self.transport.write(ERROR)
-        self.transport.write(msg)
+        int2b128(len(msg), self.bufferWrite)
+        self.bufferWrite(ERROR)
+        self.bufferWrite(msg)
+        self.flushWrites(force=True)
         # now you should drop the connection
-        self.transport.loseConnection()
+        self.dropConnection()
 
     def sendFailed(self, f):
         # call this if an exception is raised in transmission. The Failure
@@ -559,7 +866,7 @@ class Banana(protocol.Protocol):
         log.err(f)
         try:
             if self.transport:
-                self.transport.loseConnection()
+                self.dropConnection()
         except:
             print("exception during transport.loseConnection")
             log.err()
@@ -578,10 +885,17 @@ class Banana(protocol.Protocol):
     logViolations = False
     logReceiveErrors = True
     useKeepalives = False
+    bytesReceived = 0
+    # while this is not None, it is the number of bytes that may still
+    # arrive before the token that goes over it is rejected. An Unslicer
+    # that must take in data it cannot constrain sets it, and clears it
+    # again when it is done (see PipelineUnslicer).
+    receiveBudget = None
     keepaliveTimeout = None
     keepaliveTimer = None
     disconnectTimeout = None
     disconnectTimer = None
+    idleTimers = None # a TimerWheel
 
     def initReceive(self):
         self.inOpen   = False # set during the Index Phase of an OPEN sequence
@@ -592,7 +906,7 @@ class Banana(protocol.Protocol):
         # self.buffer with the inbound negotiation block.
         self.negotiated = False
         self.connectionAbandoned = False
-        self.buffer = BufferChain()
+        self.buffer = ReceiveBuffer()
 
         self.incomingVocabulary = {}
         self.skipBytes = 0 # used to discard a single long token
@@ -629,18 +943,26 @@ class Banana(protocol.Protocol):
     def replaceIncomingVocabulary(self, vocabDict):
         # maps small integer to string, should be called in response to a
         # OPEN(set-vocab) sequence.
+        if self.maxIncomingVocabulary < len(vocabDict):
+            raise BananaError('incoming vocab table is too large')
         self.incomingVocabulary = vocabDict
 
     def addIncomingVocabulary(self, index, value):
         # called in response to an OPEN(add-vocab) sequence
         assert type(index) is int,   type(index)
         assert type(value) is bytes, type(value)
+        if index not in self.incomingVocabulary and \
+           self.maxIncomingVocabulary <= len(self.incomingVocabulary):
+            raise BananaError('incoming vocab table is full')
         self.incomingVocabulary[index] = value
 
     def dataReceived(self, chunk):
+        self.bytesReceived += len(chunk)
         if not self.connectionAbandoned:
             if self.useKeepalives:
-                self.dataLastReceivedAt = time.time()
+                # the wheel's idea of the time is good enough for it to
+                # compare against, and cheaper than asking the clock
+                self.dataLastReceivedAt = self.idleTimers.now
 
             try:
                 self.handleData(chunk)
@@ -660,19 +982,22 @@ class Banana(protocol.Protocol):
 
     def keepaliveTimerFired(self):
         self.keepaliveTimer = None
-        age = time.time() - self.dataLastReceivedAt
-        if age > self.keepaliveTimeout:
+        age = self.idleTimers.now - self.dataLastReceivedAt
+        if age >= self.keepaliveTimeout:
             # the connection looks idle, so let's provoke a response
-            self.sendPING()
-        # we restart the timer in either case
-        t = reactor.callLater(self.keepaliveTimeout + EPSILON,
-                              self.keepaliveTimerFired)
-        self.keepaliveTimer = t
+            self.sendKeepalive()
+            wait = self.keepaliveTimeout
+        else:
+            # data arrived since we were scheduled: rather than moving the
+            # timer every time that happens, we catch up with it here
+            wait = self.keepaliveTimeout - age
+        self.keepaliveTimer = self.idleTimers.callLater(wait,
+                                                        self.keepaliveTimerFired)
 
     def disconnectTimerFired(self):
         self.disconnectTimer = None
-        age = time.time() - self.dataLastReceivedAt
-        if age > self.disconnectTimeout:
+        age = self.idleTimers.now - self.dataLastReceivedAt
+        if age >= self.disconnectTimeout:
             # the connection looks dead, so drop it
             log.msg("disconnectTimeout, no data for %d seconds" % age)
             self.connectionTimedOut()
@@ -681,11 +1006,18 @@ class Banana(protocol.Protocol):
             # be the right thing to do, perhaps we should restart it
             # unconditionally.
         else:
-            # we're still ok, so restart the timer
-            t = reactor.callLater(self.disconnectTimeout + EPSILON,
-                                  self.disconnectTimerFired)
+            # we're still ok, so wait until it would be too late
+            t = self.idleTimers.callLater(self.disconnectTimeout - age,
+                                          self.disconnectTimerFired)
             self.disconnectTimer = t
 
+    def sendKeepalive(self):
+        self.sendPING()
+
+    def pongReceived(self, number):
+        # the peer echoes the number we gave the PING
+        pass
+
     def getDataLastReceivedAt(self):
         """If keepalives are enabled, this returns the seconds-since-epoch
         when the most recent data was received on this connection. If
@@ -730,28 +1062,21 @@ class Banana(protocol.Protocol):
         self.buffer.append(chunk)
 
         # Loop through the available input data, extracting one token per
-        # pass.
+        # pass. The header is parsed in place: nothing is removed from the
+        # buffer until we know the token is complete.
 
         while self.buffer:
-            first65 = self.buffer.popleft(self.prefixLimit + 1)
-            pos = 0
+            pos = self.buffer.scanHeader(self.prefixLimit + 1)
 
-            for ch in first65:
-                if HIGH_BIT_SET <= ch:
-                    break
-
-                pos += 1
-
-                if self.prefixLimit < pos:
+            if pos is None:
+                if self.prefixLimit < len(self.buffer):
                     # drop the connection. We log more of the buffer, but not
                     # all of it, to make it harder for someone to spam our logs
-                    dump = first65 + self.buffer.popleft(200)
+                    dump = self.buffer.peek(self.prefixLimit + 1 + 200)
                     raise BananaError('token prefix is limited to {:d} bytes: but got {!r}'\
                         .format(self.prefixLimit, dump))
-            else:
                 # we've run out of buffer without seeing the high bit, which
                 # means we're still waiting for header to finish
-                self.buffer.appendleft(first65)
                 return
 
             assert pos <= self.prefixLimit, (pos, self.prefixLimit)
@@ -759,8 +1084,9 @@ class Banana(protocol.Protocol):
             # At this point, the header and type byte have been received.
             # The body may or may not be complete.
 
-            typebyte = first65[pos:pos+1]
-            header   = b1282int(first65[:pos]) if pos else 0
+            prefix   = self.buffer.peek(pos + 1)
+            typebyte = prefix[pos:pos+1]
+            header   = b1282int(prefix[:pos]) if pos else 0
 
             # rejected is set as soon as a violation is detected. It
             # indicates that this single token will be rejected.
@@ -814,6 +1140,8 @@ class Banana(protocol.Protocol):
                         top.openerCheckToken(typebyte, header, tuple(self.opentype))
                     else:
                         top.checkToken(typebyte, header)
+                    if self.receiveBudget is not None:
+                        self.spendReceiveBudget(typebyte, pos, header)
                 except Violation:
                     rejected = True
                     f = BananaFailure()
@@ -826,7 +1154,7 @@ class Banana(protocol.Protocol):
                 # drop them with extreme prejudice
                 raise BananaError('oversized ERROR token')
 
-            self.buffer.appendleft(first65[pos+1:])
+            self.buffer.skip(pos + 1)
 
             # determine what kind of token it is. Each clause finishes in
             # one of four ways:
@@ -911,7 +1239,7 @@ class Banana(protocol.Protocol):
                     self.handleError(obj)
                     return
                 else:
-                    self.buffer.appendleft(first65[:pos+1])
+                    self.buffer.rewind(pos + 1)
                     return # there is more to come
 
             elif typebyte == LIST:
@@ -930,7 +1258,7 @@ class Banana(protocol.Protocol):
                 else:
                     # this case is easier than STRING, because it is only 8
                     # bytes. We don't bother skipping anything.
-                    self.buffer.appendleft(first65[:pos+1])
+                    self.buffer.rewind(pos + 1)
                     return
 
             elif typebyte in (BYTES, STRING):
@@ -941,9 +1269,10 @@ class Banana(protocol.Protocol):
 
                 if size <= len(self.buffer):
                     # the whole string is available
-                    obj = self.buffer.popleft(size)
                     if typebyte == STRING:
-                        obj = obj.decode('utf8')
+                        obj = self.buffer.popleftText(size)
+                    else:
+                        obj = self.buffer.popleft(size)
                     # although it might be rejected
 
                 else:
@@ -955,7 +1284,7 @@ class Banana(protocol.Protocol):
                         self.skipBytes = size - len(self.buffer)
                         self.buffer.clear()
                     else:
-                        self.buffer.appendleft(first65[:pos+1])
+                        self.buffer.rewind(pos + 1)
                     return
 
             elif typebyte == BVOCAB:
@@ -967,11 +1296,15 @@ class Banana(protocol.Protocol):
             elif typebyte == SVOCAB:
                 obj = self.incomingVocabulary[header].decode('utf8')
 
+            elif typebyte in (NONE, TRUE, FALSE) and self.compactTokens:
+                obj = None if typebyte == NONE else typebyte == TRUE
+
             elif typebyte == PING:
                 self.sendPONG(header)
                 continue # otherwise ignored
 
             elif typebyte == PONG:
+                self.pongReceived(header)
                 continue # otherwise ignored
 
             else:
@@ -998,6 +1331,14 @@ class Banana(protocol.Protocol):
         # loop, and the loop exit condition is 'while len(self.buffer)'
         self.buffer.clear()
 
+    def spendReceiveBudget(self, typebyte, pos, header):
+        cost = pos + 1
+        if typebyte in (BYTES, STRING):
+            cost += header
+        if self.receiveBudget < cost:
+            raise Violation('more unconstrained data than we accept')
+        self.receiveBudget -= cost
+
     def handleOpen(self, openCount, objectCount, indexToken):
         self.opentype.append(indexToken)
 
@@ -1174,7 +1515,7 @@ class Banana(protocol.Protocol):
 
     def handleError(self, msg):
         log.msg("got banana ERROR from remote side: %s" % msg)
-        self.transport.loseConnection()
+        self.dropConnection()
 
     def describeReceive(self):
         where = []
@@ -1197,6 +1538,96 @@ class Banana(protocol.Protocol):
         return why
 
 
+class ReceiveBuffer:
+    """I hold inbound data in a single bytearray with a read cursor.
+
+    Token headers are scanned in place (scanHeader/peek), consumed bytes are
+    skipped by moving the cursor, and a token that turns out to be
+    incomplete is given back with rewind(). The consumed prefix is only
+    dropped (in append) once it has grown past compactThreshold bytes, so
+    most tokens cost a single copy: the one that turns their body into the
+    bytes object handed to the Unslicer.
+
+    I also provide the BufferChain interface, and can be used in its place.
+    """
+
+    compactThreshold = 64 * 1024
+    typeByteRE = re.compile(b'[\x80-\xff]')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.data) - self.offset
+
+    def __bool__(self):
+        return self.offset < len(self.data)
+
+    def __bytes__(self):
+        return self.peek(len(self))
+
+    def append(self, data):
+        if self.offset == len(self.data):
+            # everything has been consumed, start over
+            self.data = bytearray(data)
+            self.offset = 0
+            return
+        if self.compactThreshold <= self.offset:
+            del self.data[:self.offset]
+            self.offset = 0
+        self.data += data
+
+    def appendleft(self, data):
+        size = len(data)
+        if size <= self.offset:
+            # usually these are the bytes we just consumed
+            self.offset -= size
+            self.data[self.offset:self.offset+size] = data
+        else:
+            self.data[:self.offset] = data
+            self.offset = 0
+
+    def scanHeader(self, limit):
+        """Return the position (relative to the cursor) of the first byte
+        with the high bit set, looking no further than 'limit' bytes ahead,
+        or None if there is no such byte."""
+        m = self.typeByteRE.search(self.data, self.offset, self.offset+limit)
+        if m is None:
+            return None
+        return m.start() - self.offset
+
+    def peek(self, size):
+        """Return (up to) the next 'size' bytes without consuming them."""
+        return bytes(self.data[self.offset:self.offset+size])
+
+    def skip(self, size):
+        self.offset = min(self.offset + size, len(self.data))
+
+    def rewind(self, size):
+        """Un-consume the last 'size' bytes. They must not have been handed
+        out by popleft() since they were skipped."""
+        assert size <= self.offset, (size, self.offset)
+        self.offset -= size
+
+    def popleft(self, size):
+        start = self.offset
+        self.skip(size)
+        with memoryview(self.data) as view:
+            return view[start:self.offset].tobytes()
+
+    def popleftText(self, size, encoding='utf8'):
+        # decode straight out of the buffer, without an intermediate bytes
+        start = self.offset
+        self.skip(size)
+        with memoryview(self.data) as view:
+            return str(view[start:self.offset], encoding)
+
+    def clear(self):
+        self.data = bytearray()
+        self.offset = 0
+
+
 # Note: when changing this class, you should un-comment all the lines that say
 # "assert self._assert_invariants()".
 
@@ -0,0 +1,294 @@
+# -*- test-case-name: foolscap.test.test_blocking -*-
+
+"""Run remote_ methods that block (on the disk, on a database) in a bounded
+pool of threads, and CPU-bound ones in a pool of processes, so they do not
+stall the reactor, and with it every other connection.
+
+The Broker still hands these calls to the pool in the order they arrive, so
+each method gets control in order, but it completes asynchronously: the
+caller's answer is sent when the thread or process finishes.
+"""
+
+import time, threading, inspect
+from concurrent import futures
+from twisted.internet import reactor, defer, threads
+from twisted.python import threadpool, failure
+from foolscap import storage
+
+
+def blocking(method):
+    """Mark a remote_ method that may block, so the Broker runs it in its
+    Tub's BlockingCallPool instead of in the reactor thread::
+
+     class Database(Referenceable):
+         @blocking
+         def remote_lookup(self, key):
+             return self.db.get(key)
+
+    The method runs in a worker thread, so it must not touch the reactor or
+    return a Deferred: its return value (or exception) is the answer. When
+    the pool has more than one thread, several of these methods may run at
+    the same time. A RemoteMethodSchema can say the same thing with
+    __blocking__=True.
+    """
+    method.blocking = True
+    return method
+
+
+def cpu_bound(function):
+    """Mark a remote_ method that only computes (hashing, compression,
+    parsing), so the Broker runs it in its Tub's ProcessCallPool, where it
+    can use another CPU core::
+
+     class Compressor(Referenceable):
+         @cpu_bound
+         def remote_compress(data):
+             return zlib.compress(data, 9)
+
+    The function is sent to the worker process by name, so it must be
+    defined at the top level of a class or module, and it gets no 'self':
+    cpu_bound makes it a staticmethod, and raises TypeError if it is given
+    a bound method or a function whose first parameter is named 'self'. Its
+    arguments and return value are copied with foolscap.storage.serialize,
+    so they cannot include Referenceables or RemoteReferences. Callers see
+    an ordinary method. If the class replaces doRemoteCall(), that gets the
+    call instead, and the method runs in the reactor thread.
+    """
+    if inspect.ismethod(function):
+        raise TypeError("cpu_bound cannot be used on bound method %r"
+                        % (function,))
+    params = list(inspect.signature(function).parameters)
+    if params and params[0] == "self":
+        raise TypeError("cpu_bound method %s gets no 'self', it is run as "
+                        "a staticmethod in another process"
+                        % function.__name__)
+    function.cpu_bound = True
+    return staticmethod(function)
+
+
+def _waitInThread(f, *args, **kwargs):
+    # Run f (which waits for a pool to stop) in a new thread, and return a
+    # Deferred that fires with its result in the reactor thread. The reactor
+    # stops its own thread pool during shutdown, so this can't use
+    # deferToThread.
+    d = defer.Deferred()
+    def _run():
+        try:
+            res = f(*args, **kwargs)
+        except BaseException:
+            reactor.callFromThread(d.errback, failure.Failure())
+        else:
+            reactor.callFromThread(d.callback, res)
+    thread = threading.Thread(target=_run, name="foolscap-pool-stop")
+    thread.daemon = True
+    thread.start()
+    return d
+
+
+class PoolFullError(Exception):
+    """The BlockingCallPool already holds as many calls waiting for a thread
+    as it is allowed to."""
+
+
+class BlockingCallPool:
+    """I run functions in a pool of up to maxThreads threads, which is
+    started the first time it is needed. At most maxQueued calls may wait
+    for a free thread (None means no limit): beyond that, run() fails with
+    PoolFullError.
+    """
+
+    def __init__(self, maxThreads=10, maxQueued=None):
+        self.maxThreads = maxThreads
+        self.maxQueued = maxQueued
+        self._pool = None
+        self._shutdownTrigger = None
+        # the counters that change in the worker threads are guarded by
+        # this lock
+        self._lock = threading.Lock()
+        self.queued = 0 # waiting for a thread
+        self.running = 0 # in a thread right now
+        self.completed = 0
+        self.rejected = 0
+        self.busyTime = 0.0 # thread-seconds spent running calls
+
+    def setMaxThreads(self, maxThreads):
+        self.maxThreads = maxThreads
+        if self._pool:
+            self._pool.adjustPoolsize(maxthreads=maxThreads)
+
+    def run(self, f, *args, **kwargs):
+        """Run f(*args, **kwargs) in a thread. Returns a Deferred that fires
+        (in the reactor thread) with its result."""
+        if self.maxQueued is not None and self.queued >= self.maxQueued:
+            self.rejected += 1
+            return defer.fail(PoolFullError("%d blocking calls are already "
+                                            "waiting for a thread"
+                                            % self.queued))
+        if self._pool is None:
+            self._start()
+        with self._lock:
+            self.queued += 1
+        return threads.deferToThreadPool(reactor, self._pool,
+                                         self._work, f, args, kwargs)
+
+    def _work(self, f, args, kwargs):
+        # this runs in a worker thread
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                self.busyTime += time.time() - start
+
+    def _start(self):
+        self._pool = threadpool.ThreadPool(0, self.maxThreads,
+                                           "foolscap-blocking")
+        self._pool.start()
+        self._shutdownTrigger = reactor.addSystemEventTrigger(
+            "before", "shutdown", self._reactorShutdown)
+
+    def _reactorShutdown(self):
+        # the reactor has already forgotten this trigger. This is a
+        # "before" trigger, so the reactor keeps running until the Deferred
+        # we return has fired.
+        self._shutdownTrigger = None
+        pool = self._detach()
+        if pool:
+            return _waitInThread(pool.stop)
+
+    def _detach(self):
+        pool, self._pool = self._pool, None
+        if self._shutdownTrigger:
+            reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        return pool
+
+    def stop(self):
+        """Stop the threads, after the calls that were given to them have
+        finished. Returns a Deferred that fires when they have: the waiting
+        is done in another thread, so the reactor keeps running. The pool
+        is started again if run() is called later."""
+        pool = self._detach()
+        if pool is None:
+            return defer.succeed(None)
+        return _waitInThread(pool.stop)
+
+    def getStats(self):
+        with self._lock:
+            return {'threads': self.maxThreads,
+                    'running': self.running,
+                    'queued': self.queued,
+                    'completed': self.completed,
+                    'rejected': self.rejected,
+                    'busyTime': self.busyTime,
+                    # the fraction of the threads that are busy right now
+                    'utilization': float(self.running) / self.maxThreads,
+                    }
+
+
+def _serialized(obj):
+    # storage.serialize finishes right away when there is no Deferred in
+    # the object graph, which is all a worker process needs
+    results = []
+    storage.serialize(obj).addBoth(results.append)
+    if isinstance(results[0], failure.Failure):
+        results[0].raiseException()
+    return results[0]
+
+def _unserialized(data):
+    results = []
+    storage.unserialize(data).addBoth(results.append)
+    if isinstance(results[0], failure.Failure):
+        results[0].raiseException()
+    return results[0]
+
+def _runSerialized(f, data):
+    # this runs in a worker process
+    args, kwargs = _unserialized(data)
+    return _serialized(f(*args, **kwargs))
+
+
+class ProcessCallPool:
+    """I run functions in a concurrent.futures.ProcessPoolExecutor of up to
+    maxWorkers processes (None means one per CPU), which is started the
+    first time it is needed. The arguments and the result are copied
+    between processes with foolscap.storage, not pickle: only the function
+    itself is pickled (by name).
+    """
+
+    def __init__(self, maxWorkers=None):
+        self.maxWorkers = maxWorkers
+        self._executor = None
+        self._shutdownTrigger = None
+        self.pending = 0 # submitted, not yet finished
+        self.completed = 0
+        self.failed = 0
+
+    def run(self, f, args, kwargs):
+        """Run f(*args, **kwargs) in a worker process. Returns a Deferred
+        that fires with (a copy of) its result. Cancelling the Deferred
+        withdraws the call if no worker has started on it yet."""
+        if self._executor is None:
+            self._start()
+        data = _serialized((args, kwargs))
+        future = self._executor.submit(_runSerialized, f, data)
+        self.pending += 1
+        d = defer.Deferred(lambda d: future.cancel())
+        # the callback runs in one of the executor's threads
+        future.add_done_callback(
+            lambda future: reactor.callFromThread(self._done, future, d))
+        return d
+
+    def _done(self, future, d):
+        self.pending -= 1
+        if future.cancelled():
+            self.failed += 1
+            return # d has already been cancelled
+        try:
+            res = _unserialized(future.result())
+        except Exception:
+            self.failed += 1
+            d.errback(failure.Failure())
+        else:
+            self.completed += 1
+            d.callback(res)
+
+    def _start(self):
+        self._executor = futures.ProcessPoolExecutor(self.maxWorkers)
+        self._shutdownTrigger = reactor.addSystemEventTrigger(
+            "before", "shutdown", self._reactorShutdown)
+
+    def _reactorShutdown(self):
+        self._shutdownTrigger = None
+        executor = self._detach()
+        if executor:
+            return _waitInThread(executor.shutdown, wait=True)
+
+    def _detach(self):
+        executor, self._executor = self._executor, None
+        if self._shutdownTrigger:
+            reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        return executor
+
+    def stop(self):
+        """Shut down the worker processes, after the calls that were given
+        to them have finished. Returns a Deferred that fires when they have,
+        without blocking the reactor in the meantime. The pool is started
+        again if run() is called later."""
+        executor = self._detach()
+        if executor is None:
+            return defer.succeed(None)
+        return _waitInThread(executor.shutdown, wait=True)
+
+    def getStats(self):
+        return {'workers': self.maxWorkers,
+                'pending': self.pending,
+                'completed': self.completed,
+                'failed': self.failed,
+                }
@@ -3,22 +3,26 @@
 import six
 import types, time
 from itertools import count, chain
+from collections import deque
 from functools import partial, reduce
 
 from zope.interface import implementer
 from twisted.python import failure
-from twisted.internet import defer, error
+from twisted.internet import defer, error, reactor
 from twisted.internet import interfaces as twinterfaces
 from twisted.internet.protocol import connectionDone
 
 from foolscap import banana, tokens, ipb, vocab
 from foolscap import call, slicer, referenceable, copyable, remoteinterface
+from foolscap import tracing
 from foolscap.constraint import Any
+from foolscap.schema import ListOf, TupleOf
 from foolscap.tokens import Violation, BananaError
 from foolscap.ipb import DeadReferenceError, IBroker
 from foolscap.slicers.root import RootSlicer, RootUnslicer, ScopedRootSlicer
 from foolscap.eventual import eventually
 from foolscap.logging import log
+from foolscap.metrics import CallStats, LinkStats
 
 
 LOST_CONNECTION_ERRORS = [error.ConnectionLost, error.ConnectionDone]
@@ -29,10 +33,31 @@ except ImportError:
     pass
 
 
+# the first banana-decision-version that accepts (call-batch) and
+# (answer-batch) sequences
+CALL_BATCH_VERSION = 194
+# the first banana-decision-version that accepts (pipeline) sequences
+PIPELINE_VERSION = 195
+# the first banana-decision-version that accepts (cancel) sequences
+CANCEL_VERSION = 196
+# the first banana-decision-version whose RIBroker has decref_many
+DECREF_BATCH_VERSION = 197
+# the first banana-decision-version that accepts a trace context at the end
+# of (call) and (pipeline) sequences
+TRACE_VERSION = 198
+# stop sending numbered PINGs while this many are unanswered
+MAX_PINGS_IN_FLIGHT = 4
+# one decref_many message releases at most this many references
+MAX_DECREF_BATCH = 1000
+
 PBTopRegistry = {
-    (b'call',)  : call.CallUnslicer,
-    (b'answer',): call.AnswerUnslicer,
-    (b'error',) : call.ErrorUnslicer,
+    (b'call',)        : call.CallUnslicer,
+    (b'answer',)      : call.AnswerUnslicer,
+    (b'error',)       : call.ErrorUnslicer,
+    (b'call-batch',)  : call.CallBatchUnslicer,
+    (b'answer-batch',): call.AnswerBatchUnslicer,
+    (b'pipeline',)    : call.PipelineUnslicer,
+    (b'cancel',)      : call.CancelUnslicer,
 }
 
 PBOpenRegistry = {
@@ -62,6 +87,14 @@ class PBRootUnslicer(RootUnslicer):
     openRegistries = [slicer.UnslicerRegistry, PBOpenRegistry]
     logViolations  = False
 
+    def __init__(self, protocol):
+        if protocol.adaptiveVocab:
+            # the peer adapts its vocabulary with top-level (add-vocab) and
+            # (set-vocab) sequences
+            self.topRegistries = (self.topRegistries +
+                                  [slicer.BananaUnslicerRegistry])
+        super().__init__(protocol)
+
     def checkToken(self, typebyte, size):
         if typebyte != tokens.OPEN:
             raise BananaError('top-level must be OPEN')
@@ -106,6 +139,9 @@ class PBRootUnslicer(RootUnslicer):
     def receiveChild(self, token, ready_deferred):
         if isinstance(token, call.InboundDelivery):
             self.broker.scheduleCall(token, ready_deferred)
+        elif isinstance(token, call.CallBatchUnslicer):
+            for delivery, ready_deferred in token.deliveries:
+                self.broker.scheduleCall(delivery, ready_deferred)
 
 
 class RIBroker(remoteinterface.RemoteInterface):
@@ -119,12 +155,21 @@ class RIBroker(remoteinterface.RemoteInterface):
         """Release some references to my-reference 'clid'. I will return an
         ack when the operation has completed."""
 
+    def decref_many(decrefs=ListOf(TupleOf(int, int),
+                                   maxLength=MAX_DECREF_BATCH)):
+        """Like decref, for a list of (clid, count) pairs. I will return an
+        ack when all of them have been released."""
+
     def decgift(giftID=int, count=int):
         """Release some reference to a their-reference 'giftID' that was
         sent earlier."""
 
+    def releaseAnswer(reqID=int):
+        """Forget the result of the (pipeline) call 'reqID': its answer has
+        arrived, so no more calls will be pipelined on it."""
 
-@implementer(RIBroker, IBroker)
+
+@implementer(RIBroker, IBroker, twinterfaces.IPushProducer)
 class Broker(banana.Banana, referenceable.Referenceable):
     """I manage a connection to a remote Broker.
 
@@ -146,6 +191,28 @@ class Broker(banana.Banana, referenceable.Referenceable):
     startingTLS = False
     startedTLS = False
     use_remote_broker = True
+    coalesceWrites = True # one transport.write() per reactor turn
+    # Peers that accept decref_many get the decrefs for released
+    # RemoteReferences together, this many seconds after the first one (0
+    # means on the next reactor turn), or as soon as MAX_DECREF_BATCH of
+    # them are waiting.
+    decrefDelay = 0
+    # When batchCalls is True, the calls made during one reactor turn are
+    # sent together in a (call-batch) sequence, if the peer accepts them
+    batchCalls = False
+    # callRemote() uses this as the default _timeout=, in seconds
+    callTimeout = None
+    # the far end may ask us to keep the results of this many (pipeline)
+    # calls at a time
+    maxRetainedAnswers = 1000
+    # the arguments of a call pipelined on an unfinished one arrive before
+    # we know its target, so there is no schema to limit them: they may
+    # take at most this many bytes instead
+    maxPipelinedArgumentBytes = 1024 * 1024
+    # remote_ methods marked as blocking or cpu_bound are run in these, if
+    # we have a Tub
+    blockingPool = None
+    processPool = None
 
     def __init__(self, remote_tubref, params={},
                  keepaliveTimeout=None, disconnectTimeout=None,
@@ -158,11 +225,27 @@ class Broker(banana.Banana, referenceable.Referenceable):
         self.keepaliveTimeout = keepaliveTimeout
         self.disconnectTimeout = disconnectTimeout
         self._banana_decision_version = params.get("banana-decision-version")
+        self.canBatchCalls = CALL_BATCH_VERSION <= (self._banana_decision_version or 0)
+        self.canPipeline = PIPELINE_VERSION <= (self._banana_decision_version or 0)
+        self.canCancel = CANCEL_VERSION <= (self._banana_decision_version or 0)
+        self.canBatchDecrefs = DECREF_BATCH_VERSION <= (self._banana_decision_version or 0)
+        self.canTrace = TRACE_VERSION <= (self._banana_decision_version or 0)
 
         vocab_table_index = params.get('initial-vocab-table-index')
+        table = []
 
         if vocab_table_index:
-            table = vocab.INITIAL_VOCAB_TABLES[vocab_table_index]
+            table.extend(vocab.INITIAL_VOCAB_TABLES[vocab_table_index])
+
+        # application tables that both Tubs registered come next
+        words = set(table)
+        for app_table in params.get('app-vocab-tables', ()):
+            for word in app_table:
+                if word not in words:
+                    words.add(word)
+                    table.append(word)
+
+        if table:
             self.populateVocabTable(table)
 
         self.initBroker()
@@ -182,6 +265,11 @@ class Broker(banana.Banana, referenceable.Referenceable):
         # receiving side uses these
         self.yourReferenceByCLID = {}
         self.yourReferenceByURL = {}
+        self.pendingDecrefs = {} # maps CLID to [tracker, count], not yet sent
+        self._decrefTimer = None
+        self.decrefsInFlight = 0 # sent, but not yet acked
+        self.decrefMessages = 0
+        self.decrefsSent = 0
 
         # tracking Gifts
         self.nextGiftID = partial(next, count(1))
@@ -192,31 +280,105 @@ class Broker(banana.Banana, referenceable.Referenceable):
         # sending side uses these
         self.nextReqID = partial(next, count(1)) # 0 means "we don't want a response"
         self.waitingForAnswers = {} # we wait for the other side to answer
+        self.callBatch = None # (CallSlicer, Deferred, priority, key) to send together
         self.disconnectWatchers = []
 
         # Callables waiting to hear about connectionLost.
         self._connectionLostWatchers = []
 
         # receiving side uses these
-        self.inboundDeliveryQueue = []
+        self.inboundDeliveryQueue = deque()
         self._waiting_for_call_to_be_ready = False
+        self._deliveryScheduled = False
         self.activeLocalCalls = {} # the other side wants an answer from us
+        self.retainedAnswers = {} # reqID -> PipelineAnswer, until released
+
+        # per-method call statistics. All of a Tub's Brokers share its own.
+        self.callStats = CallStats()
+        # the tracing.Tracer, if we are to record spans
+        self.tracer = None
+
+        # round-trip times and byte rates, from numbered PINGs
+        self.linkStats = LinkStats()
+        self.nextPingNumber = partial(next, count(1))
+        self.pingsInFlight = {} # PING number -> when it was sent
+        self.rttProbeInterval = None # seconds between PINGs, if set
+        self._probeTimer = None
 
     def setTub(self, tub):
         assert ipb.ITub.providedBy(tub)
         self.tub = tub
         self.unsafeTracebacks = tub.unsafeTracebacks
         self._expose_remote_exception_types = tub._expose_remote_exception_types
+        if tub._max_write_batch is not None:
+            self.maxWriteBatch = tub._max_write_batch
+        if tub._outbound_high_watermark is not None:
+            self.highWatermark = tub._outbound_high_watermark
+        if tub._outbound_low_watermark is not None:
+            self.lowWatermark = tub._outbound_low_watermark
+        self.batchCalls = tub._batch_calls
+        self.callTimeout = tub._call_timeout
+        self.decrefDelay = tub._decref_delay
+        self.callStats = tub.callStats
+        self.tracer = tub.tracer
+        self.idleTimers = tub.idleTimers
+        self.rttProbeInterval = tub._rtt_probe_interval
+        self.blockingPool = tub.blockingPool
+        self.processPool = tub.processPool
         if tub.debugBanana:
             self.debugSend = True
             self.debugReceive = True
 
     def connectionMade(self):
+        self.registerWithTransport()
         banana.Banana.connectionMade(self)
         self.rootSlicer.broker = self
         self.rootUnslicer.broker = self
         if self.use_remote_broker:
             self._create_remote_broker()
+            # the first round-trip time, and the baseline for the byte
+            # rates. Only real links are probed: a StorageBroker's output is
+            # a serialized blob, which must not carry PINGs.
+            self.probeLink()
+            if self.rttProbeInterval:
+                self._probeTimer = reactor.callLater(self.rttProbeInterval,
+                                                     self._probeTimerFired)
+
+    def probeLink(self):
+        """Send a numbered PING. The time until its PONG arrives is a
+        round-trip time sample."""
+        now = time.monotonic()
+        self.linkStats.sampleBytes(now, self.bytesReceived,
+                                   self.writeFlushBytes)
+        if len(self.pingsInFlight) >= MAX_PINGS_IN_FLIGHT:
+            return # they are not answering, so don't pile up more
+        number = self.nextPingNumber()
+        self.pingsInFlight[number] = now
+        self.sendPING(number)
+
+    def sendKeepalive(self):
+        # keepalives measure the round-trip time too
+        self.probeLink()
+
+    def _probeTimerFired(self):
+        self._probeTimer = reactor.callLater(self.rttProbeInterval,
+                                             self._probeTimerFired)
+        self.probeLink()
+
+    def pongReceived(self, number):
+        sent = self.pingsInFlight.pop(number, None)
+        if sent is None:
+            return # an unnumbered PING, or one we sent before (re)connecting
+        now = time.monotonic()
+        self.linkStats.addRTT(now - sent)
+        self.linkStats.sampleBytes(now, self.bytesReceived,
+                                   self.writeFlushBytes)
+
+    def getLinkStats(self):
+        """Return the round-trip times and byte counts of this connection:
+        see foolscap.metrics.LinkStats.getStats for the format."""
+        return self.linkStats.getStats(time.monotonic(), self.bytesReceived,
+                                       self.writeFlushBytes)
 
     def _create_remote_broker(self):
         # create the remote_broker object. We don't use the usual
@@ -245,8 +407,11 @@ class Broker(banana.Banana, referenceable.Referenceable):
         if not fireDisconnectWatchers:
             self.disconnectWatchers = []
         self.finish(why)
-        # loseConnection eventually provokes connectionLost()
-        self.transport.loseConnection()
+        # anything already serialized goes out ahead of the close, just as
+        # if it had been written to the transport directly
+        self.flushWrites(force=True)
+        # dropConnection eventually provokes connectionLost()
+        self.dropConnection()
 
     def connectionLost(self, why):
         tubid = "?"
@@ -282,6 +447,15 @@ class Broker(banana.Banana, referenceable.Referenceable):
         self.myReferenceByCLID = {}
         self.yourReferenceByCLID = {}
         self.yourReferenceByURL = {}
+        # the trackers have been forgotten along with the references
+        self.pendingDecrefs = {}
+        if self._decrefTimer:
+            self._decrefTimer.cancel()
+            self._decrefTimer = None
+        if self._probeTimer:
+            self._probeTimer.cancel()
+            self._probeTimer = None
+        self.pingsInFlight = {}
         self.myGifts = {}
         self.myGiftsByGiftID = {}
         for (cb,args,kwargs) in self.disconnectWatchers:
@@ -322,6 +496,9 @@ class Broker(banana.Banana, referenceable.Referenceable):
             self.disconnectWatchers.remove(marker)
 
     def getConnectionInfo(self):
+        if self._connectionInfo is not None:
+            # the measurements are copied in when they are asked for
+            self._connectionInfo._set_link_stats(self.getLinkStats())
         return self._connectionInfo
 
     # methods to send my Referenceables to the other side
@@ -384,6 +561,26 @@ class Broker(banana.Banana, referenceable.Referenceable):
         if not self.remote_broker: # tests do not set this up
             self.freeYourReferenceTracker(None, tracker)
             return
+        if self.canBatchDecrefs:
+            # the tracker stays in yourReferenceByCLID until the batch is
+            # acked, so any other release of this CLID will find it again
+            first = not self.pendingDecrefs
+            pending = self.pendingDecrefs.get(tracker.clid)
+            if pending:
+                assert pending[0] is tracker
+                pending[1] += count
+            else:
+                self.pendingDecrefs[tracker.clid] = [tracker, count]
+            if len(self.pendingDecrefs) >= MAX_DECREF_BATCH:
+                self.flushDecrefs()
+            elif not self.decrefDelay:
+                # one batch per turn, without leaving a DelayedCall behind
+                if first:
+                    eventually(self.flushDecrefs)
+            elif not self._decrefTimer:
+                self._decrefTimer = reactor.callLater(self.decrefDelay,
+                                                      self.flushDecrefs)
+            return
         try:
             rb = self.remote_broker
             # TODO: do we want callRemoteOnly here? is there a way we can
@@ -405,21 +602,74 @@ class Broker(banana.Banana, referenceable.Referenceable):
             # self.freeYourReferenceTracker('bogus', tracker)
             # return
 
-            d = rb.callRemote("decref", clid=tracker.clid, count=count)
-            # if the connection was lost before we can get an ack, we're
-            # tearing this down anyway
-            def _ignore_loss(f):
-                f.trap(DeadReferenceError, *LOST_CONNECTION_ERRORS)
-                return None
-            d.addErrback(_ignore_loss)
-            # once the ack comes back, or if we know we'll never get one,
-            # release the tracker
-            d.addCallback(self.freeYourReferenceTracker, tracker)
+            # decrefs are small, don't leave them queued behind bulk data,
+            # but don't let them overtake calls to the reference they
+            # release either. They must not time out, or we would forget the
+            # tracker while the far end still holds the reference.
+            d = rb.callRemote("decref", clid=tracker.clid, count=count,
+                              _priority=tokens.PRIORITY_HIGH, _timeout=None,
+                              _key=(tracker.clid,))
+            self._decrefSent(d, [tracker])
         except:
             f = failure.Failure()
             log.msg("failure during freeRemoteReference", facility="foolscap",
                     level=log.UNUSUAL, failure=f)
 
+    def flushDecrefs(self):
+        """Send the decrefs that are waiting, in one decref_many message."""
+        if self._decrefTimer:
+            if self._decrefTimer.active():
+                self._decrefTimer.cancel()
+            self._decrefTimer = None
+        pending, self.pendingDecrefs = self.pendingDecrefs, {}
+        if not pending:
+            return
+        trackers = []
+        decrefs = []
+        for clid, (tracker, n) in pending.items():
+            trackers.append(tracker)
+            decrefs.append((clid, n))
+        try:
+            # like a single decref, the batch may not overtake calls to any
+            # of the references it releases
+            d = self.remote_broker.callRemote("decref_many", decrefs,
+                                              _priority=tokens.PRIORITY_HIGH,
+                                              _timeout=None,
+                                              _key=tuple(pending))
+            self._decrefSent(d, trackers)
+        except:
+            f = failure.Failure()
+            log.msg("failure during flushDecrefs", facility="foolscap",
+                    level=log.UNUSUAL, failure=f)
+
+    def _decrefSent(self, d, trackers):
+        self.decrefMessages += 1
+        self.decrefsSent += len(trackers)
+        self.decrefsInFlight += len(trackers)
+        # if the connection was lost before we can get an ack, we're
+        # tearing this down anyway
+        def _ignore_loss(f):
+            f.trap(DeadReferenceError, *LOST_CONNECTION_ERRORS)
+            return None
+        d.addErrback(_ignore_loss)
+        # once the ack comes back, or if we know we'll never get one,
+        # release the trackers
+        def _acked(res):
+            self.decrefsInFlight -= len(trackers)
+            for tracker in trackers:
+                self.freeYourReferenceTracker(res, tracker)
+        d.addCallback(_acked)
+
+    def getDecrefStats(self):
+        """Return a dictionary describing the decref messages that release
+        the far end's objects when our RemoteReferences go away."""
+        return {
+            'queued': len(self.pendingDecrefs),
+            'in-flight': self.decrefsInFlight,
+            'messages': self.decrefMessages,
+            'references': self.decrefsSent,
+        }
+
     def freeYourReferenceTracker(self, res, tracker):
         if tracker.received_count != 0:
             return
@@ -459,6 +709,10 @@ class Broker(banana.Banana, referenceable.Referenceable):
             del self.myReferenceByPUID[tracker.puid]
             del self.myReferenceByCLID[clid]
 
+    def remote_decref_many(self, decrefs):
+        for clid, n in decrefs:
+            self.remote_decref(clid, n)
+
     # methods to send RemoteReference 'gifts' to third-parties
 
     def makeGift(self, rref):
@@ -502,6 +756,62 @@ class Broker(banana.Banana, referenceable.Referenceable):
             raise DeadReferenceError("Calling Stale Broker")
         return self.nextReqID()
 
+    def sendCall(self, callSlicer, priority, key):
+        if self.callBatch is None:
+            if not (self.batchCalls and self.canBatchCalls):
+                return self.send(callSlicer, priority, key)
+            self.callBatch = []
+            eventually(self.flushCallBatch)
+        d = defer.Deferred()
+        self.callBatch.append((callSlicer, d, priority, key))
+        return d
+
+    def startCallBatch(self):
+        """Hold on to the calls made from now on, until flushCallBatch()
+        sends them all in one (call-batch) sequence. This does nothing if the
+        peer does not understand (call-batch)."""
+        if self.callBatch is None and self.canBatchCalls:
+            self.callBatch = []
+
+    def flushCallBatch(self):
+        calls, self.callBatch = self.callBatch, None
+        if not calls or self.disconnected:
+            # if we were disconnected, finish() has already failed the
+            # PendingRequests
+            return
+        # the far end rejects larger batches
+        for i in range(0, len(calls), call.MAX_BATCH_CALLS):
+            self._sendCallBatch(calls[i:i + call.MAX_BATCH_CALLS])
+
+    def _sendCallBatch(self, calls):
+        if len(calls) == 1:
+            callSlicer, d, priority, key = calls[0]
+            self.send(callSlicer, priority, key).chainDeferred(d)
+            return
+        priority = min([c[2] for c in calls])
+        keys = set()
+        for c in calls:
+            if type(c[3]) is tuple:
+                keys.update(c[3])
+            elif c[3] is not None:
+                keys.add(c[3])
+        keys = tuple(keys)
+        batch = call.CallBatchSlicer([(c[0], c[1]) for c in calls])
+        self.send(batch, priority, keys or None).addErrback(batch.abandon)
+
+    def cancelRequest(self, req):
+        # invoked when the caller cancels a PendingRequest, or it times out
+        for c in self.callBatch or ():
+            if c[0].reqID == req.reqID:
+                # it has not been sent yet, and now it never will be
+                self.callBatch.remove(c)
+                self.removeRequest(req)
+                return
+        if self.canCancel and not self.disconnected:
+            # ordered after the call itself, so it can't arrive first
+            self.send(call.CancelSlicer(req.reqID), tokens.PRIORITY_HIGH,
+                      req.key)
+
     def addRequest(self, req):
         req.broker = self
         self.waitingForAnswers[req.reqID] = req
@@ -546,47 +856,108 @@ class Broker(banana.Banana, referenceable.Referenceable):
                 return m
         return None
 
-    def scheduleCall(self, delivery, ready_deferred):
-        self.inboundDeliveryQueue.append((delivery, ready_deferred))
-        eventually(self.doNextCall)
-
-    def doNextCall(self):
-        if self.disconnected:
-            return
-
-        if self._waiting_for_call_to_be_ready:
-            return
-
-        if not self.inboundDeliveryQueue:
-            return
-
-        delivery, ready_deferred = self.inboundDeliveryQueue.pop(0)
-        self._waiting_for_call_to_be_ready = True
+    def retainAnswer(self, reqID):
+        # invoked by PipelineUnslicer: the result of this call must be kept
+        # for calls pipelined on it, until the other side releases it
+        if len(self.retainedAnswers) >= self.maxRetainedAnswers:
+            raise Violation("too many retained answers (%d)"
+                            % len(self.retainedAnswers))
+        answer = self.retainedAnswers[reqID] = call.PipelineAnswer(reqID)
+        return answer
 
-        if not ready_deferred:
-            ready_deferred = defer.succeed(None)
+    def getRetainedAnswer(self, reqID):
+        try:
+            return self.retainedAnswers[reqID]
+        except KeyError:
+            raise Violation("non-existent pipelined reqID '%d'" % reqID)
+
+    def remote_releaseAnswer(self, reqID):
+        self.retainedAnswers.pop(reqID, None)
+
+    def cancelCall(self, reqID):
+        # invoked by CancelUnslicer: the caller has given up on this call. If
+        # we have not started it yet, we never will. If its method returned
+        # a Deferred, that is cancelled. Either way, they get a small
+        # CancelledError instead of the answer.
+        c = self.activeLocalCalls.get(reqID)
+        if c is None:
+            return # already answered
+        c.cancelled = True
+        if c.running is not None:
+            c.running.cancel()
+
+    def getUnansweredDeliveries(self):
+        """Return the InboundDeliveries for the calls that have arrived
+        (queued or running) and still owe the caller an answer."""
+        return [c for c in self.activeLocalCalls.values()
+                if isinstance(c, call.InboundDelivery)]
 
-        d = ready_deferred
+    def scheduleCall(self, delivery, ready_deferred):
+        self.inboundDeliveryQueue.append((delivery, ready_deferred))
+        self._scheduleDelivery()
 
-        def _ready(res):
-            self._waiting_for_call_to_be_ready = False
+    def _scheduleDelivery(self):
+        # one turn delivers everything that has arrived by then
+        if not self._deliveryScheduled:
+            self._deliveryScheduled = True
             eventually(self.doNextCall)
-            return res
 
-        d.addBoth(_ready)
+    def doNextCall(self):
+        self._deliveryScheduled = False
+        queue = self.inboundDeliveryQueue
+        while queue and not self._waiting_for_call_to_be_ready:
+            if self.disconnected:
+                return
+            delivery, ready_deferred = queue.popleft()
+            self._deliverCall(delivery, ready_deferred)
+
+    def _deliverCall(self, delivery, ready_deferred):
+        if not ready_deferred:
+            d = defer.succeed(None)
+        else:
+            d = ready_deferred
+            ms = delivery.methodSchema
+            if not (ms and getattr(ms, "unordered", False)):
+                # later calls must not overtake this one, so hold them
+                # until its arguments are ready
+                self._waiting_for_call_to_be_ready = True
+                def _ready(res):
+                    self._waiting_for_call_to_be_ready = False
+                    self._scheduleDelivery()
+                    return res
+                d.addBoth(_ready)
 
         # at this point, the Deferred chain for this one delivery runs
         # independently of any other, and methods which take a long time to
-        # complete will not hold up other methods. We must call _doCall and
-        # let the remote_ method get control before we process any other
-        # message, but the eventually() above insures we'll have a chance to
-        # do that before we give up control.
-
+        # complete will not hold up other methods. Unless the arguments are
+        # still being made ready, _doCall runs (and the remote_ method gets
+        # control) right now, before the next call in the queue.
+
+        if delivery.targetAnswer:
+            # the target of a pipelined call is the result of an earlier
+            # call, which may still be running. Later calls are not held up
+            # while this one waits for it.
+            d.addCallback(lambda res: delivery.targetAnswer.whenResolved())
+            d.addCallback(self._setPipelineTarget, delivery)
         d.addCallback(lambda res: self._doCall(delivery))
         d.addCallback(self._callFinished, delivery)
         d.addErrback(self.callFailed, delivery.reqID, delivery)
         d.addErrback(log.err)
 
+    def _setPipelineTarget(self, target, delivery):
+        if ipb.IRemotelyCallable(target, None) is None:
+            raise Violation("result of request %d is not remotely callable"
+                            % delivery.targetAnswer.reqID)
+        delivery.obj = target
+        delivery.interface = target.getInterface()
+        if delivery.interface:
+            ms = delivery.interface.get(delivery.methodname)
+            if not ms:
+                raise Violation("method '%s' not defined in %s" %
+                                (delivery.methodname,
+                                 delivery.interface.__remote_name__))
+            delivery.methodSchema = ms
+
     def _doCall(self, delivery):
         # our ordering rules require that the order in which each
         # remote_foo() method gets control is exactly the same as the order
@@ -598,14 +969,34 @@ class Broker(banana.Banana, referenceable.Referenceable):
         args   = delivery.allargs.args
         kwargs = delivery.allargs.kwargs
 
+        methodname = delivery.methodname
+        if delivery.getMethod and not hasattr(obj, "remote_%s" % methodname):
+            # the call is bound to fail: don't let each name the far end
+            # makes up get its own statistics
+            methodname = None
+        stats = self.callStats.getInbound(delivery.getInterfaceName(),
+                                          methodname)
+        stats.calls += 1
+        delivery.stats = stats
+        delivery.started = time.monotonic()
+        stats.queueWait.add(delivery.started - delivery.received)
+
+        if delivery.cancelled:
+            raise defer.CancelledError()
+
         for i in chain(args, kwargs.values()):
             assert not isinstance(i, defer.Deferred)
 
-        if delivery.methodSchema:
-            # we asked about each argument on the way in, but ask again so
-            # they can look for missing arguments. TODO: see if we can remove
-            # the redundant per-argument checks.
-            delivery.methodSchema.checkAllArgs(args, kwargs, True)
+        ms = delivery.methodSchema
+        if ms:
+            checkReceivedArgs = getattr(ms, "checkReceivedArgs", None)
+            if checkReceivedArgs and getattr(delivery.allargs, "checked",
+                                             False):
+                # every argument was checked as its tokens arrived, so
+                # only the rest needs doing
+                checkReceivedArgs(args, kwargs)
+            else:
+                ms.checkAllArgs(args, kwargs, True)
 
         # interesting case: if the method completes successfully, but
         # our schema prohibits us from sending the result (perhaps the
@@ -614,19 +1005,72 @@ class Broker(banana.Banana, referenceable.Referenceable):
         # Referenceable.doRemoteCall, so the exception's traceback will be
         # attached to the object that caused it
 
+        if delivery.traceContext and self.tracer:
+            delivery.span = self.tracer.startServerSpan(
+                delivery.traceContext, delivery.getInterfaceName(),
+                delivery.methodname)
+            # calls made by the method (and its log events) join the trace
+            res = tracing.runInSpan(delivery.span, self._invoke,
+                                    delivery, obj, args, kwargs)
+        else:
+            res = self._invoke(delivery, obj, args, kwargs)
+        if isinstance(res, defer.Deferred):
+            delivery.running = res
+        return res
+
+    def _invoke(self, delivery, obj, args, kwargs):
         if delivery.methodname is None:
             assert callable(obj)
-            return obj(*args, **kwargs)
-
-        obj = ipb.IRemotelyCallable(obj)
-        return obj.doRemoteCall(delivery.methodname, args, kwargs)
+            res = obj(*args, **kwargs)
+        else:
+            if delivery.getMethod:
+                # found through the target's DispatchTable, so obj is a
+                # plain Referenceable
+                meth = delivery.getMethod(obj)
+            else:
+                obj = ipb.IRemotelyCallable(obj)
+                meth = getattr(obj, "remote_%s" % delivery.methodname, None)
+            if (self.processPool and delivery.getMethod and
+                getattr(meth, "cpu_bound", False) is True):
+                # only the function and (copies of) its arguments go to the
+                # worker process. A class that replaces doRemoteCall() has
+                # no DispatchTable, and its doRemoteCall() gets the call
+                res = self.processPool.run(meth, args, kwargs)
+            elif self.blockingPool and self._isBlocking(meth, delivery):
+                # the method gets its thread in the order it was called,
+                # but the reactor does not wait for it to finish
+                res = self.blockingPool.run(obj.doRemoteCall,
+                                            delivery.methodname, args, kwargs)
+            elif delivery.getMethod:
+                res = meth(*args, **kwargs)
+            else:
+                res = obj.doRemoteCall(delivery.methodname, args, kwargs)
+        return res
+
+    def _isBlocking(self, meth, delivery):
+        if getattr(delivery.methodSchema, "blocking", False):
+            return True
+        # or the remote_ method itself was marked with @blocking
+        return getattr(meth, "blocking", False) is True
+
+    def _recordDelivery(self, delivery, failed):
+        stats, delivery.stats = delivery.stats, None
+        if stats:
+            stats.finished(delivery.started, failed)
+        if delivery.span:
+            delivery.span.finish(failed)
+        return stats
 
     def _callFinished(self, res, delivery):
         reqID = delivery.reqID
         if reqID == 0:
+            self._recordDelivery(delivery, False)
             return
         methodSchema = delivery.methodSchema
         assert self.activeLocalCalls[reqID]
+        if delivery.cancelled:
+            # don't bother with an answer nobody wants
+            raise defer.CancelledError()
         methodName = None
         if methodSchema:
             methodName = methodSchema.name
@@ -638,10 +1082,14 @@ class Broker(banana.Banana, referenceable.Referenceable):
                 raise
 
         answer = call.AnswerSlicer(reqID, res, methodName)
+        answer.stats = self._recordDelivery(delivery, False)
         # once the answer has started transmitting, any exceptions must be
         # logged and dropped, and not turned into an Error to be sent.
         try:
-            self.send(answer)
+            if delivery.answerBatch:
+                delivery.answerBatch.add(answer)
+            else:
+                self.send(answer)
             # TODO: .send should return a Deferred that fires when the last
             # byte has been queued, and we should delete the local note then
         except:
@@ -649,6 +1097,8 @@ class Broker(banana.Banana, referenceable.Referenceable):
             log.msg("Broker._callfinished unable to send",
                     facility="foolscap", level=log.UNUSUAL, failure=f)
         del self.activeLocalCalls[reqID]
+        if delivery.retainedAnswer:
+            delivery.retainedAnswer.resolve(res)
 
     def callFailed(self, f, reqID, delivery=None):
         # this may be called either when an inbound schema is violated, or
@@ -657,15 +1107,26 @@ class Broker(banana.Banana, referenceable.Referenceable):
         # the method, we are called by CallUnslicer.reportViolation and don't
         # get a delivery= argument.
 
-        if delivery is not None:
+        if delivery is not None and not delivery.cancelled:
             if self.tub and self.tub.logLocalFailures or not self.tub:
                 # the 'not self.tub' case is for unit tests
                 delivery.logFailure(f)
 
+        stats = None
+        if delivery is not None:
+            stats = self._recordDelivery(delivery, True)
+
         if reqID != 0:
             assert self.activeLocalCalls[reqID]
-            self.send(call.ErrorSlicer(reqID, f))
+            error = call.ErrorSlicer(reqID, f)
+            error.stats = stats
+            if delivery is not None and delivery.answerBatch:
+                delivery.answerBatch.add(error)
+            else:
+                self.send(error)
             del self.activeLocalCalls[reqID]
+        if delivery is not None and delivery.retainedAnswer:
+            delivery.retainedAnswer.resolve(f)
 
 class StorageBrokerRootSlicer(ScopedRootSlicer):
     # each StorageBroker is a single serialization domain, so we inherit from
@@ -717,6 +1178,7 @@ class StorageBroker(Broker):
     violation = None
     disconnectReason = None
     use_remote_broker = False
+    coalesceWrites = False # serialize() expects the bytes right away
 
     def prepare(self):
         self.d = defer.Deferred()
@@ -751,6 +1213,7 @@ class LoopbackTransport(object):
     # we always create these in pairs, with .peer pointing at each other
 
     producer = None
+    peer = None
 
     def __init__(self):
         self.connected = True
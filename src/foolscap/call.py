@@ -1,13 +1,15 @@
 
+import time
 from twisted.python import failure, reflect, log as twlog
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 
-from foolscap import copyable, slicer, tokens
+from foolscap import copyable, slicer, tokens, tracing
 from foolscap.copyable import AttributeDictConstraint
 from foolscap.constraint import StringConstraint
 from foolscap.slicers.list import ListConstraint
 from .tokens import BananaError, Violation
 from foolscap.util import AsyncAND
+from foolscap.prepared import PreparedTokens
 from foolscap.logging import log
 
 
@@ -38,12 +40,19 @@ class PendingRequest:
     # this object is a local representation of a message we have sent to
     # someone else, that will be executed on their end.
     active = True
+    cancelled = False # the caller gave up: any answer is discarded
+    timedOut = False
+    timer = None
+    key = None # the SendQueue ordering key of the call
+    stats = None # the OutboundMethodStats to record the latency in
+    span = None # the tracing.Span, if the call is traced
 
     def __init__(self, reqID, rref, interface_name, method_name):
+        self.started = time.monotonic()
         self.reqID = reqID
-        self.rref = rref # keep it alive
+        self.rref = rref # keep it alive, until the call is retired
         self.broker = None # if set, the broker knows about us
-        self.deferred = defer.Deferred()
+        self.deferred = defer.Deferred(self._cancel)
         self.constraint = None # this constrains the results
         self.failure = None
         self.interface_name = interface_name # for error messages
@@ -55,16 +64,67 @@ class PendingRequest:
     def getMethodNameInfo(self):
         return (self.interface_name, self.method_name)
 
+    def setTimeout(self, timeout):
+        self.timer = reactor.callLater(timeout, self._timedOut)
+
+    def _stopTimer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def _timedOut(self):
+        self.timer = None
+        self.timedOut = True
+        self.deferred.cancel()
+
+    def _cancel(self, d):
+        # invoked by self.deferred.cancel(). The far end is told, so it can
+        # stop working on the call, but we still wait for its answer (or
+        # error) before retiring the reqID.
+        self.active = False
+        self.cancelled = True
+        self._stopTimer()
+        if self.broker:
+            self.broker.cancelRequest(self)
+        if self.timedOut:
+            d.errback(defer.TimeoutError("callRemote(%s) timed out"
+                                         % self.method_name))
+        # otherwise the Deferred fails with CancelledError
+
+    def _retire(self):
+        self._stopTimer()
+        # self.deferred refers back to us (through the canceller), so let
+        # go of the RemoteReference now, rather than when that cycle is
+        # collected: the decref should not wait for the garbage collector
+        self.rref = None
+
+    def _record(self, failed):
+        # only the first answer (or loss of connection) counts
+        stats, self.stats = self.stats, None
+        if stats:
+            stats.finished(self.started, failed)
+        if self.span:
+            self.span.finish(failed)
+
     def complete(self, res):
         if self.broker:
             self.broker.removeRequest(self)
+        self._retire()
+        self._record(not self.active)
         if self.active:
             self.active = False
             self.deferred.callback(res)
-        else:
+        elif not self.cancelled:
             log.msg("PendingRequest.complete called on an inactive request")
 
     def fail(self, why):
+        self._record(True)
+        if self.cancelled:
+            # we lost interest in this call already
+            if self.broker:
+                self.broker.removeRequest(self)
+            self._retire()
+            return
         if self.active:
             if self.broker:
                 self.broker.removeRequest(self)
@@ -95,8 +155,10 @@ class PendingRequest:
                 log.msg(" the REMOTE failure was:", failure=why,
                         level=log.NOISY, parent=lp)
                 #log.msg(stack, level=log.NOISY, parent=lp)
+            self._retire()
             self.deferred.errback(why)
         else:
+            self._retire()
             log.msg("WEIRD: fail() on an inactive request", traceback=True)
             if self.failure:
                 log.msg("multiple failures")
@@ -131,22 +193,54 @@ class ArgumentSlicer(slicer.ScopedSlicer):
         return "<%s>" % self.which
 
 
+class PreparedArguments(PreparedTokens):
+    """The (arguments) sequence of a call, sliced once so that it can be
+    sent to many RemoteReferences. See broadcastRemote()."""
+
+    def __init__(self, args, kwargs, methodname="?"):
+        PreparedTokens.__init__(self, ArgumentSlicer(args, kwargs, methodname))
+        self.args = args
+        self.kwargs = kwargs
+        self.checkedSchemas = []
+
+    def checkAllArgs(self, methodSchema):
+        # peers that share a RemoteInterface share the result
+        for checked in self.checkedSchemas:
+            if checked is methodSchema:
+                return
+        methodSchema.checkAllArgs(self.args, self.kwargs, False)
+        self.checkedSchemas.append(methodSchema)
+
+
 class CallSlicer(slicer.ScopedSlicer):
     opentype = (b'call',)
+    measureBytes = True
+    stats = None # the OutboundMethodStats of the call
+    traceContext = None # sent after the arguments, if the call is traced
 
-    def __init__(self, reqID, clid, methodname, args, kwargs):
+    def __init__(self, reqID, clid, methodname, args, kwargs, prepared=None):
         slicer.ScopedSlicer.__init__(self, None)
         self.reqID = reqID
         self.clid = clid
         self.methodname = methodname
         self.args = args
         self.kwargs = kwargs
+        self.prepared = prepared
 
     def sliceBody(self, streamable, banana):
         yield self.reqID
         yield self.clid
         yield self.methodname
-        yield ArgumentSlicer(self.args, self.kwargs, self.methodname)
+        if self.prepared is not None:
+            yield self.prepared
+        else:
+            yield ArgumentSlicer(self.args, self.kwargs, self.methodname)
+        if self.traceContext is not None:
+            yield self.traceContext
+
+    def sentBytes(self, size):
+        if self.stats:
+            self.stats.argumentBytes += size
 
     def describe(self):
         return "<call-%s-%s-%s>" % (self.reqID, self.clid, self.methodname)
@@ -181,9 +275,25 @@ class InboundDelivery:
     above any cycles.
     """
 
+    answerBatch = None # set if the call arrived in a (call-batch)
+    cancelled = False # set when the caller sends a (cancel)
+    running = None # the Deferred returned by the method, if any
+    targetAnswer = None # set if the call was pipelined on an earlier one
+    retainedAnswer = None # set if later calls may be pipelined on this one
+
+    # set if the Referenceable's DispatchTable found the method: getMethod(obj)
+    # returns the bound remote_ method
+    getMethod = None
+
+    stats = None # the InboundMethodStats, once the Broker takes the call
+    started = None # when the method was invoked
+    traceContext = None # (traceID, parentID), if the caller is tracing
+    span = None # our tracing.Span, while the call is served
+
     def __init__(self, broker, reqID, obj,
                  interface, methodname, methodSchema,
                  allargs):
+        self.received = time.monotonic()
         self.broker = broker
         self.reqID = reqID
         self.obj = obj
@@ -192,6 +302,12 @@ class InboundDelivery:
         self.methodSchema = methodSchema
         self.allargs = allargs
 
+    def getInterfaceName(self):
+        # the same name that callers (and their PendingRequests) use
+        if self.interface:
+            return self.interface.__remote_name__
+        return None
+
     def logFailure(self, f):
         # called if tub.logLocalFailures is True
         my_short_tubid = "??"
@@ -237,6 +353,12 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
     debug   = False
     numargs = None
     closed  = None
+    # True if every argument was checked against methodSchema, token by
+    # token, as it arrived. Shared references and placeholders (for gifts,
+    # or for tuples that were still being built) can resolve to objects that
+    # were not, so their presence means the arguments must be checked again
+    # before the method is invoked.
+    checked = False
 
     def setConstraint(self, methodSchema):
         self.methodSchema = methodSchema
@@ -253,6 +375,12 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
         self._all_children_are_referenceable_d = None
         self._ready_deferreds = []
         self.closed = False
+        self.unchecked = False
+
+    def getObject(self, counter):
+        # a (reference) is being resolved, somewhere inside our arguments
+        self.unchecked = True
+        return slicer.ScopedUnslicer.getObject(self, counter)
 
     def checkToken(self, typebyte, size):
         if self.numargs is None:
@@ -314,11 +442,13 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
                     # this may occur if the child is a gift which has not
                     # resolved yet.
                     self.num_unreferenceable_children += 1
+                    self.unchecked = True
                     argvalue.addCallback(self.updateChild, argpos)
 
                 if ready_deferred:
                     if self.debug:
                         log.msg("%s.receiveChild got an unready posarg" % self)
+                    self.unchecked = True
                     self._ready_deferreds.append(ready_deferred)
 
                 if len(self.args) < self.numargs:
@@ -347,11 +477,13 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
 
                     if isinstance(argvalue, defer.Deferred):
                         self.num_unreferenceable_children += 1
+                        self.unchecked = True
                         argvalue.addCallback(self.updateChild, self.argname)
 
                     if ready_deferred:
                         if self.debug:
                             log.msg("%s.receiveChild got an unready kwarg" % self)
+                        self.unchecked = True
                         self._ready_deferreds.append(ready_deferred)
 
                     self.argname = None
@@ -387,6 +519,7 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
             raise BananaError("'arguments' sequence ended too early")
 
         self.closed = True
+        self.checked = bool(self.methodSchema) and not self.unchecked
         dl = []
 
         if self.num_unreferenceable_children:
@@ -422,15 +555,20 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
 class CallUnslicer(slicer.ScopedUnslicer):
     debug = False
     stage = None
+    cancelled = False
 
     def start(self, count):
-        # start=0:reqID, 1:objID, 2:methodname, 3: arguments
+        # start=0:reqID, 1:objID, 2:methodname, 3: arguments,
+        # 4: optional trace context
         self.stage = 0
         self.reqID = None
         self.obj = None
         self.interface = None
         self.methodname = None
         self.methodSchema = None # will be a MethodArgumentsConstraint
+        self.dispatch = None
+        self.getMethod = None
+        self.traceContext = None
         self._ready_deferreds = []
 
     def checkToken(self, typebyte, size):
@@ -452,6 +590,12 @@ class CallUnslicer(slicer.ScopedUnslicer):
             if typebyte != tokens.OPEN:
                 raise BananaError("arguments must be an 'arguments' sequence")
 
+        elif self.stage == 4:
+            if typebyte not in (tokens.STRING, tokens.SVOCAB):
+                raise BananaError("trace context must be a STRING")
+            if size > tracing.MAX_CONTEXT_LENGTH:
+                raise BananaError("trace context too long")
+
         else:
             raise BananaError("too many objects given to CallUnslicer")
 
@@ -506,7 +650,13 @@ class CallUnslicer(slicer.ScopedUnslicer):
             if self.objID < 0:
                 self.interface = None
             else:
-                self.interface = self.obj.getInterface()
+                getDispatchTable = getattr(self.obj, "getDispatchTable", None)
+                if getDispatchTable:
+                    self.dispatch = getDispatchTable()
+                if self.dispatch:
+                    self.interface = self.dispatch.interface
+                else:
+                    self.interface = self.obj.getInterface()
             self.stage = 2
             return
 
@@ -521,13 +671,9 @@ class CallUnslicer(slicer.ScopedUnslicer):
             # flavors.Referenceable should be adapted to something which
             # always returns None
 
-            # TODO: make this faster. A likely optimization is to take a
-            # tuple of components.getInterfaces(obj) and use it as a cache
-            # key. It would be even faster to use obj.__class__, but that
-            # would probably violate the expectation that instances can
-            # define their own __implements__ (independently from their
-            # class). If this expectation were to go away, a quick
-            # obj.__class__ -> RemoteReferenceSchema cache could be built.
+            # most targets have a DispatchTable, which caches this by
+            # obj.__class__. Instances which provide interfaces of their own
+            # do not, and are looked up every time.
 
             assert ready_deferred is None
             self.stage = 3
@@ -544,7 +690,11 @@ class CallUnslicer(slicer.ScopedUnslicer):
 
             self.methodname = token
 
-            if self.interface:
+            if self.dispatch:
+                # this may raise Violation
+                self.methodSchema, self.getMethod = \
+                                   self.dispatch.getMethod(token)
+            elif self.interface:
                 # they are calling an interface+method pair
                 ms = self.interface.get(self.methodname)
                 if not ms:
@@ -566,8 +716,15 @@ class CallUnslicer(slicer.ScopedUnslicer):
             self.stage = 4
             return
 
+        if self.stage == 4: # trace context
+            assert ready_deferred is None
+            # this may raise Violation
+            self.traceContext = tracing.parseContext(token)
+            self.stage = 5
+            return
+
     def receiveClose(self):
-        if self.stage != 4:
+        if self.stage not in (4, 5):
             raise BananaError("'call' sequence ended too early")
 
         # time to create the InboundDelivery object so we can queue it
@@ -575,6 +732,12 @@ class CallUnslicer(slicer.ScopedUnslicer):
                                    self.interface, self.methodname,
                                    self.methodSchema,
                                    self.allargs)
+        delivery.getMethod = self.getMethod
+        delivery.traceContext = self.traceContext
+        if self.reqID != 0:
+            # a (cancel) may yet arrive for it
+            self.broker.activeLocalCalls[self.reqID] = delivery
+            delivery.cancelled = self.cancelled
         ready_deferred = None
 
         if self._ready_deferreds:
@@ -602,8 +765,186 @@ class CallUnslicer(slicer.ScopedUnslicer):
         return s + '>'
 
 
+class PipelineSlicer(CallSlicer):
+    """I send a (pipeline) sequence: a call whose result the far end keeps
+    until we release it, so that more calls can be addressed to that result
+    before its answer gets back to us. answerOf is the reqID of the earlier
+    (pipeline) call to invoke the method on, or 0 to invoke it on the
+    reference with the given clid."""
+
+    opentype = (b'pipeline',)
+
+    def __init__(self, reqID, answerOf, clid, methodname, args, kwargs):
+        CallSlicer.__init__(self, reqID, clid, methodname, args, kwargs)
+        self.answerOf = answerOf
+
+    def sliceBody(self, streamable, banana):
+        yield self.reqID
+        yield self.answerOf
+        yield self.clid
+        yield self.methodname
+        yield ArgumentSlicer(self.args, self.kwargs, self.methodname)
+        if self.traceContext is not None:
+            yield self.traceContext
+
+    def describe(self):
+        return "<pipeline-%s-%s-%s-%s>" % (self.reqID, self.answerOf,
+                                           self.clid, self.methodname)
+
+
+class PipelineAnswer:
+    """The result of an inbound (pipeline) call, kept until the caller
+    releases it. Calls pipelined on it wait in whenResolved() until the
+    method has finished, and are then invoked on its result (or failed with
+    its Failure) in the order they arrived."""
+
+    def __init__(self, reqID):
+        self.reqID = reqID
+        self.resolved = False
+        self.result = None
+        self.waiting = []
+
+    def resolve(self, result):
+        if self.resolved:
+            return
+        self.resolved = True
+        self.result = result
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def whenResolved(self):
+        if not self.resolved:
+            d = defer.Deferred()
+            self.waiting.append(d)
+            return d
+        if isinstance(self.result, failure.Failure):
+            return defer.fail(self.result)
+        return defer.succeed(self.result)
+
+
+class PipelineUnslicer(CallUnslicer):
+    # (pipeline reqID answerOf clid methodname (arguments)). When answerOf is
+    # not 0, the target is not known until that call has finished, so the
+    # arguments are received without a schema, and checked at delivery.
+    # Until then, only Broker.maxPipelinedArgumentBytes of them are taken.
+
+    def start(self, count):
+        CallUnslicer.start(self, count)
+        self.answerOf = None
+        self.targetAnswer = None
+        self.retainedAnswer = None
+
+    def checkToken(self, typebyte, size):
+        if self.stage == 1 and self.answerOf is None:
+            if typebyte != tokens.INT:
+                raise BananaError("answer ID must be an INT")
+            return
+        CallUnslicer.checkToken(self, typebyte, size)
+
+    def doOpen(self, opentype):
+        unslicer = CallUnslicer.doOpen(self, opentype)
+        if self.targetAnswer:
+            self.protocol.receiveBudget = self.broker.maxPipelinedArgumentBytes
+        return unslicer
+
+    def reportViolation(self, f):
+        self.protocol.receiveBudget = None
+        # calls pipelined on this one will never get a result
+        if self.retainedAnswer:
+            self.retainedAnswer.resolve(f)
+        return CallUnslicer.reportViolation(self, f)
+
+    def receiveChild(self, token, ready_deferred=None):
+        if self.stage == 0:
+            CallUnslicer.receiveChild(self, token, ready_deferred)
+            if self.reqID != 0:
+                self.retainedAnswer = self.broker.retainAnswer(self.reqID)
+            return
+
+        if self.stage == 1 and self.answerOf is None:
+            assert ready_deferred is None
+            self.answerOf = token
+            if token:
+                # this may raise Violation
+                self.targetAnswer = self.broker.getRetainedAnswer(token)
+            return
+
+        if self.targetAnswer and self.stage in (1, 2):
+            # the clid is unused, and the methodname is checked once the
+            # target is known
+            assert ready_deferred is None
+            if self.stage == 1:
+                self.objID = token
+            else:
+                self.methodname = token
+            self.stage += 1
+            return
+
+        if self.stage == 3:
+            # the arguments are complete
+            self.protocol.receiveBudget = None
+        CallUnslicer.receiveChild(self, token, ready_deferred)
+
+    def receiveClose(self):
+        delivery, ready_deferred = CallUnslicer.receiveClose(self)
+        delivery.targetAnswer = self.targetAnswer
+        delivery.retainedAnswer = self.retainedAnswer
+        return delivery, ready_deferred
+
+    def describe(self):
+        s = CallUnslicer.describe(self)
+        if self.answerOf:
+            s = s[:-1] + ' answerOf=%d>' % self.answerOf
+        return s
+
+
+class CancelSlicer(slicer.BaseSlicer):
+    """I tell the far end that we are no longer interested in the answer
+    to one of our calls."""
+
+    opentype = (b'cancel',)
+    trackReferences = False
+
+    def __init__(self, reqID):
+        slicer.BaseSlicer.__init__(self, None)
+        self.reqID = reqID
+
+    def sliceBody(self, streamable, banana):
+        yield self.reqID
+
+    def describe(self):
+        return "<cancel-%s>" % self.reqID
+
+
+class CancelUnslicer(slicer.LeafUnslicer):
+    reqID = None
+
+    def checkToken(self, typebyte, size):
+        if typebyte != tokens.INT or self.reqID is not None:
+            raise BananaError("cancel takes a single request ID")
+
+    def receiveChild(self, token, ready_deferred=None):
+        assert ready_deferred is None
+        self.reqID = token
+
+    def receiveClose(self):
+        if self.reqID is None:
+            raise BananaError("cancel without a request ID")
+        self.broker.cancelCall(self.reqID)
+        return None, None
+
+    def describe(self):
+        return "<cancel-%s>" % self.reqID
+
+
 class AnswerSlicer(slicer.ScopedSlicer):
     opentype = (b'answer',)
+    measureBytes = True
+    stats = None # the InboundMethodStats of the call being answered
 
     def __init__(self, reqID, results, methodname="?"):
         assert reqID != 0
@@ -616,6 +957,10 @@ class AnswerSlicer(slicer.ScopedSlicer):
         yield self.reqID
         yield self.results
 
+    def sentBytes(self, size):
+        if self.stats:
+            self.stats.answerBytes += size
+
     def describe(self):
         return "<answer-%s-to-%s>" % (self.reqID, self.methodname)
 
@@ -727,6 +1072,8 @@ class AnswerUnslicer(slicer.ScopedUnslicer):
 
 class ErrorSlicer(slicer.ScopedSlicer):
     opentype = (b'error',)
+    measureBytes = True
+    stats = None # the InboundMethodStats of the call that failed
 
     def __init__(self, reqID, f):
         slicer.ScopedSlicer.__init__(self, None)
@@ -738,6 +1085,10 @@ class ErrorSlicer(slicer.ScopedSlicer):
         yield self.reqID
         yield self.f
 
+    def sentBytes(self, size):
+        if self.stats:
+            self.stats.answerBytes += size
+
     def describe(self):
         return "<error-%s>" % self.reqID
 
@@ -793,6 +1144,174 @@ class ErrorUnslicer(slicer.ScopedUnslicer):
         return "<error-%s>" % self.request.reqID
 
 
+# one (call-batch) carries at most this many calls
+MAX_BATCH_CALLS = 100
+
+
+class CallBatchSlicer(slicer.BaseSlicer):
+    """I send several (call) sequences, queued within one reactor turn, as a
+    single (call-batch) sequence. Each call has its own Deferred, which fires
+    when that call has been serialized (or errbacks if it could not be), just
+    like the one returned by Broker.send()."""
+
+    opentype = (b'call-batch',)
+
+    def __init__(self, calls):
+        slicer.BaseSlicer.__init__(self, None)
+        self.calls = calls # list of (CallSlicer, Deferred)
+        self.current = None
+
+    def sliceBody(self, streamable, banana):
+        for callSlicer, d in self.calls:
+            self.current = d
+            yield callSlicer
+            if self.current is d:
+                self.current = None
+                d.callback(None)
+
+    def childAborted(self, f):
+        # one bad call does not spoil the rest of the batch
+        d, self.current = self.current, None
+        d.errback(f)
+        return None
+
+    def abandon(self, f):
+        # the batch itself could not be sent
+        for callSlicer, d in self.calls:
+            if not d.called:
+                d.errback(f)
+
+    def describe(self):
+        return "<call-batch[%d]>" % len(self.calls)
+
+
+class CallBatchUnslicer(slicer.BaseUnslicer):
+    """I receive a (call-batch) sequence. The calls are delivered in order,
+    once the whole batch has arrived, and their answers are sent back in a
+    single (answer-batch) sequence."""
+
+    # every call of a batch, and its answer, is held until the batch closes
+    maxCalls = MAX_BATCH_CALLS
+
+    def start(self, count):
+        self.deliveries = []
+        self.numCalls = 0
+        self.tooLarge = False
+
+    def checkToken(self, typebyte, size):
+        if typebyte != tokens.OPEN:
+            raise BananaError("call-batch may only contain 'call' sequences")
+
+    def doOpen(self, opentype):
+        if self.numCalls >= self.maxCalls:
+            self.tooLarge = True
+            raise Violation("too many calls in call-batch, limit is %d"
+                            % self.maxCalls)
+        self.numCalls += 1
+        if opentype == (b'call',):
+            child = CallUnslicer()
+        elif opentype == (b'pipeline',):
+            child = PipelineUnslicer()
+        else:
+            raise Violation("call-batch may only contain 'call' sequences")
+        child.broker = self.broker
+        return child
+
+    def reportViolation(self, f):
+        if self.tooLarge:
+            # reject the whole batch, failing the calls we already have
+            for delivery, ready_deferred in self.deliveries:
+                if delivery.reqID:
+                    self.broker.callFailed(f, delivery.reqID, delivery)
+            self.deliveries = []
+            return f
+        # the CallUnslicer has already sent back an error if it could
+        return None
+
+    def receiveChild(self, delivery, ready_deferred=None):
+        assert isinstance(delivery, InboundDelivery)
+        self.deliveries.append((delivery, ready_deferred))
+
+    def receiveClose(self):
+        answers = AnswerBatch(self.broker,
+                              len([1 for delivery, ready_deferred
+                                   in self.deliveries if delivery.reqID]))
+        for delivery, ready_deferred in self.deliveries:
+            if delivery.reqID:
+                delivery.answerBatch = answers
+        return self, None
+
+    def describe(self):
+        return "<call-batch[%d]>" % len(self.deliveries)
+
+
+class AnswerBatch:
+    """I collect the answer (or error) for each call of a (call-batch), and
+    send them all in one (answer-batch) once the last call is finished. A
+    slow call holds back the answers to the rest of its batch."""
+
+    def __init__(self, broker, expected):
+        self.broker = broker
+        self.expected = expected
+        self.answers = []
+
+    def add(self, answer):
+        self.answers.append(answer)
+        if len(self.answers) == self.expected:
+            self.broker.send(AnswerBatchSlicer(self.answers))
+
+
+class AnswerBatchSlicer(slicer.BaseSlicer):
+    opentype = (b'answer-batch',)
+
+    def __init__(self, answers):
+        slicer.BaseSlicer.__init__(self, None)
+        self.answers = answers # AnswerSlicers and ErrorSlicers
+
+    def sliceBody(self, streamable, banana):
+        for answer in self.answers:
+            yield answer
+
+    def childAborted(self, f):
+        # the result could not be serialized. The far end fails the request
+        # when it sees the ABORT, so the rest of the batch can carry on.
+        log.msg("unable to send answer", failure=f,
+                facility="foolscap", level=log.UNUSUAL)
+        return None
+
+    def describe(self):
+        return "<answer-batch[%d]>" % len(self.answers)
+
+
+class AnswerBatchUnslicer(slicer.BaseUnslicer):
+    def checkToken(self, typebyte, size):
+        if typebyte != tokens.OPEN:
+            raise BananaError("answer-batch may only contain answers")
+
+    def doOpen(self, opentype):
+        if opentype == (b'answer',):
+            child = AnswerUnslicer()
+        elif opentype == (b'error',):
+            child = ErrorUnslicer()
+        else:
+            raise Violation("answer-batch may only contain answers")
+        child.broker = self.broker
+        return child
+
+    def reportViolation(self, f):
+        # AnswerUnslicer and ErrorUnslicer have already failed the request
+        return None
+
+    def receiveChild(self, obj, ready_deferred=None):
+        pass
+
+    def receiveClose(self):
+        return None, None
+
+    def describe(self):
+        return "<answer-batch>"
+
+
 def truncate(s, limit):
     assert limit > 3
     if s and len(s) > limit:
@@ -82,6 +82,14 @@ class TubConnector:
     This is a single-use object. The connection attempt begins as soon as my
     connect() method is called.
 
+    The hints are tried in the order the Tub's HintStats suggests (the ones
+    that worked before, and quickly, first), one at a time: the next one is
+    started when the previous attempt fails, or when STAGGER_DELAY seconds
+    (the Tub's 'connection-stagger' option) pass without a TCP connection
+    being made. A connection that is still negotiating holds off the next
+    attempt for up to NEGOTIATION_GRACE seconds. With a stagger of 0, all
+    hints are tried at once.
+
     I live until all but one of the TCP connections I initiated have finished
     closing down. This means that connection establishment attempts in
     progress are cancelled, and established connections (the ones which did
@@ -91,7 +99,11 @@ class TubConnector:
 
     failureReason = None
     CONNECTION_TIMEOUT = 120
+    STAGGER_DELAY = 0.25
+    NEGOTIATION_GRACE = 5.0
     timer = None
+    staggerTimer = None
+    won = False
 
     def __init__(self, parent, tubref, connectionPlugins):
         self._logparent = log.msg(format="TubConnector created from %(fromtubid)s to %(totubid)s",
@@ -104,7 +116,21 @@ class TubConnector:
         self.target = tubref
         self.connectionPlugins = connectionPlugins
         self._connectionInfo = ConnectionInfo()
-        self.remainingLocations = list(self.target.getLocations())
+        self.hintStats = parent.hintStats
+        self.remainingLocations = self.hintStats.rank(
+            self.target.getLocations())
+        self.stagger = parent._connection_stagger
+        if self.stagger is None:
+            self.stagger = self.STAGGER_DELAY
+        if parent._test_options.get("debug_stall_second_connection"):
+            # for unit tests, hold off on making the second connection
+            # for a moment. This allows the first connection to get to a
+            # known state.
+            self.stagger = 0.1
+            self.NEGOTIATION_GRACE = 0
+            # the tests that use this expect the last hint to go first
+            self.remainingLocations.reverse()
+        self._negotiatingSince = None
         # attemptedLocations keeps track of where we've already tried to
         # connect, so we don't try them twice, even if they appear in the
         # hints multiple times. this isn't too clever: slight variations of
@@ -160,6 +186,12 @@ class TubConnector:
         if self.timer:
             self.timer.cancel()
             del self.timer
+        self.stopStaggerTimer()
+
+    def stopStaggerTimer(self):
+        if self.staggerTimer:
+            self.staggerTimer.cancel()
+            self.staggerTimer = None
 
     def shutdown(self):
         self.active = False
@@ -177,12 +209,16 @@ class TubConnector:
             # triggers n.connectionLost(), then self.connectorNegotiationFailed()
 
     def connectToAll(self):
+        # start the next hint, or all of them if we aren't staggering
+        self.stopStaggerTimer()
         while self.remainingLocations:
-            location = self.remainingLocations.pop()
+            location = self.remainingLocations.pop(0)
             if location in self.attemptedLocations:
                 continue
             self.attemptedLocations.append(location)
             lp = self.log("considering hint: %s" % (location,))
+            self.hintStats.attemptStarted(location)
+            started = time.time()
             d = get_endpoint(location, self.connectionPlugins,
                              self._connectionInfo)
             # no handler for this hint?: InvalidHintError thrown here
@@ -200,16 +236,36 @@ class TubConnector:
                 self.pendingConnections.remove(d)
                 return res
             d.addBoth(_remove)
-            d.addCallback(self._connectionSuccess, location, lp)
+            d.addCallback(self._connectionSuccess, location, lp, started)
             d.addErrback(self._connectionFailed, location, lp)
-            if self.tub._test_options.get("debug_stall_second_connection"):
-                # for unit tests, hold off on making the second connection
-                # for a moment. This allows the first connection to get to a
-                # known state.
-                reactor.callLater(0.1, self.connectToAll)
+            if self.stagger and self.remainingLocations and self.active:
+                # a hint that failed right away may have started the next
+                # one (and its timer) already
+                self.stopStaggerTimer()
+                self.staggerTimer = reactor.callLater(self.stagger,
+                                                      self._staggerFired)
                 return
         self.checkForFailure()
 
+    def _staggerFired(self):
+        self.staggerTimer = None
+        if not self.active:
+            return
+        if self.pendingNegotiations and self._negotiatingSince is not None:
+            # a connection was made, and it's still making progress
+            wait = (self._negotiatingSince + self.NEGOTIATION_GRACE
+                    - time.time())
+            if wait > 0:
+                self.staggerTimer = reactor.callLater(wait,
+                                                      self._staggerFired)
+                return
+        self.connectToAll()
+
+    def _tryNextHint(self):
+        # one attempt is over: don't wait for the stagger timer
+        if self.active and self.remainingLocations:
+            self.connectToAll()
+
     def connectionTimedOut(self):
         # this timer is for the overall connection attempt, not each
         # individual endpoint/TCP connector
@@ -230,6 +286,8 @@ class TubConnector:
             description = "abandoned"
             self.log("abandoned attempt to %s" % hint, level=OPERATIONAL,
                      parent=lp, umid="CC8vwg")
+            if self.won:
+                self.hintStats.attemptAbandoned(hint, negotiating=False)
         elif reason.check(InvalidHintError):
             description = "bad hint: %s" % str(reason.value)
             self.log("unable to use hint: %s: %s" % (hint, reason.value),
@@ -252,25 +310,31 @@ class TubConnector:
                          None)
         if suffix:
             description += suffix
+        if description != "abandoned":
+            self.hintStats.attemptFailed(hint)
         self._connectionInfo._set_connection_status(hint, description)
         if not self.failureReason:
             self.failureReason = reason
+        self._tryNextHint()
         self.checkForFailure()
         self.checkForIdle()
 
-    def _connectionSuccess(self, p, hint, lp):
+    def _connectionSuccess(self, p, hint, lp, started):
         # fires with the Negotiation protocol instance, after
         # p.makeConnection(transport) returns, which is after
         # p.connectionMade() returns
         self.log("connected to %s, beginning negotiation" % hint,
                  level=OPERATIONAL, parent=lp, umid="VN0XGQ")
+        now = time.time()
+        self.hintStats.attemptConnected(hint, now - started)
+        self._negotiatingSince = now
         self.pendingNegotiations[p] = hint
         self._connectionInfo._set_connection_status(hint, "negotiating")
 
     def redirectReceived(self, newLocation):
         # the redirected connection will disconnect soon, which will trigger
         # connectorNegotiationFailed(), so we don't have to do a
-        self.remainingLocations.append(newLocation)
+        self.remainingLocations.insert(0, newLocation)
         self.connectToAll()
 
     def connectorNegotiationFailed(self, n, location, reason):
@@ -281,7 +345,12 @@ class TubConnector:
 
         # abandoned connections will not have hit _connectionSuccess, so they
         # won't have been added to pendingNegotiations
-        self.pendingNegotiations.pop(n, None)
+        negotiating = self.pendingNegotiations.pop(n, None)
+        if self.won:
+            if negotiating:
+                self.hintStats.attemptAbandoned(location, negotiating=True)
+        elif self.active:
+            self.hintStats.attemptFailed(location)
         description = "negotiation failed: %s" % str(reason.value)
         self._connectionInfo._set_connection_status(location, description)
         assert isinstance(reason, Failure), \
@@ -291,6 +360,7 @@ class TubConnector:
             # don't let mundane things like ConnectionFailed override the
             # actually significant ones like NegotiationError
             self.failureReason = reason
+        self._tryNextHint()
         self.checkForFailure()
         self.checkForIdle()
 
@@ -303,10 +373,17 @@ class TubConnector:
         self._connectionInfo._set_connection_status(location, "successful")
         self._connectionInfo._set_winning_hint(location)
         self._connectionInfo._set_established_at(time.time())
+        self.hintStats.attemptSucceeded(location)
         self.active = False
+        self.won = True
         if self.timer:
             self.timer.cancel()
             self.timer = None
+        self.stopStaggerTimer()
+        # the hints we haven't got to yet will not be needed
+        self.hintStats.hintsSkipped(len([l for l in self.remainingLocations
+                                         if l not in self.attemptedLocations]))
+        self.remainingLocations = []
         self.cancelRemainingConnections() # abandon the others
         self.checkForIdle()
 
@@ -12,6 +12,7 @@ from zope.interface import implementer, Interface
 
 from .tokens import Violation, BananaError, tokenNames, SIZE_LIMIT
 from .tokens import STRING, BYTES, LIST, INT, NEG, SVOCAB, BVOCAB, FLOAT, OPEN
+from .tokens import NONE, TRUE, FALSE
 
 
 STUB = object()
@@ -28,6 +29,9 @@ everythingTaster = {
     BVOCAB: None,
     FLOAT : None,
     OPEN  : None,
+    NONE  : None,
+    TRUE  : None,
+    FALSE : None,
 }
 
 openTaster = {
@@ -107,6 +111,13 @@ class Constraint:
     name = None
     """Used to describe the Constraint in a Violation error message"""
 
+    checkShape = None
+    """Constraints that contain other constraints (ListOf, DictOf, ...)
+    provide checkShape(obj) instead of checking their members themselves.
+    It checks the container, and returns the (constraint, member) pairs that
+    are left to check, or None. See checkNested().
+    """
+
     def checkToken(self, typebyte, size):
         """Check the token type. Raise an exception if it is not accepted
         right now, or if the body-length limit is exceeded."""
@@ -180,6 +191,13 @@ class Constraint:
         # this default form passes everything
         return
 
+    def checkedByTokens(self):
+        """Return True if checkToken() and checkOpentype(), applied as the
+        object arrives, already enforce everything checkObject() would.
+        Inbound method arguments with such constraints are not checked a
+        second time. When in doubt, return False."""
+        return False
+
     COUNTERBYTES = 64 # max size of opencount
 
     def OPENBYTES(self, dummy):
@@ -202,8 +220,51 @@ class OpenerConstraint(Constraint):
     taster = openTaster
 
 
+def checkNested(constraint, obj, inbound):
+    """Check obj against a constraint that contains others, and the members
+    of obj against those, without recursing: the members still to be
+    checked are kept on an explicit stack of iterators. Members are visited
+    in the same (depth-first) order a recursive walk would use, so the same
+    Violation is raised first.
+    """
+    stack = [iter(((constraint, obj),))]
+    while stack:
+        for c, o in stack[-1]:
+            if c.checkShape is None:
+                c.checkObject(o, inbound)
+                continue
+            members = c.checkShape(o)
+            if members is not None:
+                stack.append(iter(members))
+                break
+        else:
+            stack.pop()
+
+
 class Any(Constraint):
-    pass # accept everything
+    # accept everything
+    def checkedByTokens(self):
+        return True
+
+
+def compileConstraint(constraint):
+    """Return a function(obj, inbound) that checks obj against the
+    constraint, or None if there is nothing to check."""
+    if isinstance(constraint, Optional):
+        constraint = constraint.constraint
+    if isinstance(constraint, Any):
+        return None
+    return constraint.checkObject
+
+def compileInboundConstraint(constraint):
+    """Like compileConstraint, but for an object whose tokens have already
+    been checked against the constraint as they arrived: return None if
+    that was enough."""
+    if isinstance(constraint, Optional):
+        constraint = constraint.constraint
+    if constraint.checkedByTokens():
+        return None
+    return constraint.checkObject
 
 
 # constraints which describe individual banana tokens
@@ -235,6 +296,11 @@ class ByteStringConstraint(Constraint):
         if self.regexp and not self.regexp.search(obj):
             raise Violation("regexp failed to match")
 
+    def checkedByTokens(self):
+        # the taster limits BYTES tokens, but not BVOCAB ones
+        return (self.maxLength is None and not self.minLength
+                and not self.regexp)
+
 
 class StringConstraint(Constraint):
     """The object must be a unicode object. The maxLength and minLength
@@ -283,6 +349,11 @@ class StringConstraint(Constraint):
         if self.regexp and not self.regexp.search(obj):
             raise Violation("regexp failed to match")
 
+    def checkedByTokens(self):
+        # the taster counts bytes, not characters
+        return (self.maxLength is None and not self.minLength
+                and not self.regexp)
+
 
 class IntegerConstraint(Constraint):
     opentypes = [] # redundant
@@ -295,6 +366,9 @@ class IntegerConstraint(Constraint):
         assert maxBytes == -1 or maxBytes == None or maxBytes >= 4
         self.maxBytes = maxBytes
         self.taster = {INT: None, NEG: None}
+        # computed once: 2**(8*1024) is too slow to work out for every check
+        if maxBytes is not None and maxBytes != -1:
+            self.limit = 2**(8*maxBytes)
 
     def checkObject(self, obj, inbound):
         if not isinstance(obj, int):
@@ -303,7 +377,7 @@ class IntegerConstraint(Constraint):
             if obj >= 2**31 or obj < -2**31:
                 raise Violation("number too large")
         elif self.maxBytes is not None:
-            if abs(obj) >= 2**(8*self.maxBytes):
+            if abs(obj) >= self.limit:
                 raise Violation("number too large")
 
 
@@ -9,6 +9,7 @@ class _SimpleCallQueue(object):
         self._events = []
         self._flushObservers = []
         self._timer = None
+        self._inTurn = False
 
     def append(self, cb, args, kwargs):
         self._events.append((cb, args, kwargs))
@@ -21,11 +22,15 @@ class _SimpleCallQueue(object):
         # gets added to the queue while we're doing this, those events will
         # be put off until the next turn.
         events, self._events = self._events, []
-        for cb, args, kwargs in events:
-            try:
-                cb(*args, **kwargs)
-            except:
-                log.err()
+        self._inTurn = True
+        try:
+            for cb, args, kwargs in events:
+                try:
+                    cb(*args, **kwargs)
+                except:
+                    log.err()
+        finally:
+            self._inTurn = False
         if not self._events:
             observers, self._flushObservers = self._flushObservers, []
             for o in observers:
@@ -34,7 +39,9 @@ class _SimpleCallQueue(object):
     def flush(self):
         """Return a Deferred that will fire (with None) when the call queue
         is completely empty."""
-        if not self._events:
+        # when called from inside an event, the rest of this turn's events
+        # have not run yet: wait until the end of the turn to find out
+        if not self._events and not self._inTurn:
             return defer.succeed(None)
         d = defer.Deferred()
         self._flushObservers.append(d)
@@ -8,6 +8,14 @@ class ConnectionInfo:
         self.winningHint = None
         self.establishedAt = None
         self.lostAt = None
+        # measured by the Broker, see foolscap.metrics.LinkStats
+        self.rtt = None
+        self.rttJitter = None
+        self.minRTT = None
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.bytesInRate = 0.0
+        self.bytesOutRate = 0.0
 
     def _set_connected(self, connected):
         self.connected = connected
@@ -26,3 +34,11 @@ class ConnectionInfo:
         self.listenerStatus = (self.listenerStatus[0], status)
     def _set_lost_at(self, when):
         self.lostAt = when
+    def _set_link_stats(self, stats):
+        self.rtt = stats['rtt']
+        self.rttJitter = stats['rtt-jitter']
+        self.minRTT = stats['min-rtt']
+        self.bytesIn = stats['bytes-in']
+        self.bytesOut = stats['bytes-out']
+        self.bytesInRate = stats['bytes-in-rate']
+        self.bytesOutRate = stats['bytes-out-rate']
@@ -5,7 +5,7 @@ import traceback
 import collections
 from twisted.python import log as twisted_log
 from twisted.python import failure
-from foolscap import eventual
+from foolscap import eventual, tracing
 from foolscap.logging.interfaces import IIncidentReporter
 from foolscap.logging.incident import IncidentQualifier, IncidentReporter
 from foolscap.logging import app_versions, flogfile
@@ -220,6 +220,11 @@ class FoolscapLogger:
                 event['stacktrace'] = traceback.format_stack()
 
             event['incarnation'] = self.incarnation
+            span = tracing.currentSpan()
+            if span is not None:
+                # emitted while serving a traced call
+                event['trace_id'] = span.traceID
+                event['span_id'] = span.spanID
             self.add_event(facility, level, event)
 
     def err(self, _stuff=None, _why=None, **kw):
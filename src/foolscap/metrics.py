@@ -0,0 +1,370 @@
+# -*- test-case-name: foolscap.test.test_metrics -*-
+
+"""Count, time, and measure remote calls, per (RemoteInterface, method).
+
+Every Broker records into the CallStats of its Tub. Recording is a few
+integer additions and one histogram bucket per call, so it is always on.
+Read the results with Tub.getStats(), or remotely through the
+CallStatsReporter returned by Tub.getStatsReporter().
+"""
+
+import time
+from math import frexp
+from collections import deque
+from zope.interface import implementer
+from foolscap.remoteinterface import RemoteInterface
+from foolscap.referenceable import Referenceable
+from foolscap.constraint import Any
+
+
+class Histogram:
+    """I count durations in power-of-two buckets: bucket N holds the ones
+    that took less than 2**N seconds (and at least 2**(N-1) seconds), from
+    about a microsecond up to several minutes."""
+
+    MIN_EXPONENT = -20 # 2**-20s is about 1us: everything faster goes here
+    MAX_EXPONENT = 8 # 256s: everything slower goes here
+
+    def __init__(self):
+        self.counts = [0] * (self.MAX_EXPONENT - self.MIN_EXPONENT + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        # frexp(x)[1] is the smallest N for which x < 2**N, except that
+        # frexp(0.0) is (0.0, 0)
+        exponent = frexp(seconds)[1] if seconds > 0 else self.MIN_EXPONENT
+        if exponent < self.MIN_EXPONENT:
+            exponent = self.MIN_EXPONENT
+        elif exponent > self.MAX_EXPONENT:
+            exponent = self.MAX_EXPONENT
+        self.counts[exponent - self.MIN_EXPONENT] += 1
+
+    def getStats(self):
+        buckets = [(2.0 ** (i + self.MIN_EXPONENT), n)
+                   for i, n in enumerate(self.counts) if n]
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            # (upper bound in seconds, count), for the non-empty buckets
+            'buckets': buckets,
+        }
+
+
+class OutboundMethodStats:
+    """Calls that we make with callRemote."""
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0 # errors, cancellations, lost connections
+        self.argumentBytes = 0 # the (call) sequences we wrote
+        self.latency = Histogram() # from callRemote to the answer
+
+    def finished(self, started, failed):
+        self.latency.add(time.monotonic() - started)
+        if failed:
+            self.failures += 1
+
+    def getStats(self):
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'in-flight': 0,
+            'argument-bytes': self.argumentBytes,
+            'latency': self.latency.getStats(),
+        }
+
+
+class InboundMethodStats:
+    """Calls that our remote_ methods serve."""
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0 # exceptions, Violations, cancellations
+        self.answerBytes = 0 # the (answer) and (error) sequences we wrote
+        self.queueWait = Histogram() # from arrival to invocation
+        self.execution = Histogram() # from invocation to answer
+
+    def finished(self, started, failed):
+        if started is not None: # otherwise the method never ran
+            self.execution.add(time.monotonic() - started)
+        if failed:
+            self.failures += 1
+
+    def getStats(self):
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'in-flight': 0,
+            'answer-bytes': self.answerBytes,
+            'queue-wait': self.queueWait.getStats(),
+            'execution': self.execution.getStats(),
+        }
+
+
+def methodKey(interfaceName, methodName):
+    return "%s.%s" % (interfaceName or "?", methodName or "?")
+
+
+class CallStats:
+    """I hold the per-method statistics for one Tub (or for one Broker,
+    when it has no Tub).
+
+    The inbound method names come from our peers, so at most MAX_INBOUND
+    of them get their own statistics: calls to any others are counted
+    together, under '?.?'.
+    """
+
+    MAX_INBOUND = 1000
+
+    def __init__(self):
+        # (interfaceName, methodName) -> OutboundMethodStats
+        self.outbound = {}
+        # (interfaceName, methodName) -> InboundMethodStats
+        self.inbound = {}
+
+    def getOutbound(self, interfaceName, methodName):
+        key = (interfaceName, methodName)
+        stats = self.outbound.get(key)
+        if stats is None:
+            stats = self.outbound[key] = OutboundMethodStats()
+        return stats
+
+    def getInbound(self, interfaceName, methodName):
+        key = (interfaceName, methodName)
+        stats = self.inbound.get(key)
+        if stats is None:
+            if len(self.inbound) >= self.MAX_INBOUND:
+                key = (None, None)
+                stats = self.inbound.get(key)
+            if stats is None:
+                stats = self.inbound[key] = InboundMethodStats()
+        return stats
+
+    def getStats(self, brokers=()):
+        """Return a dictionary with 'outbound' and 'inbound' dictionaries,
+        which map 'RIName.methodname' to that method's statistics. The
+        'in-flight' gauges are counted from the given Brokers' tables of
+        unanswered calls, so they are never left behind by a lost
+        connection."""
+        outbound = dict((methodKey(*key), stats.getStats())
+                        for key, stats in self.outbound.items())
+        inbound = dict((methodKey(*key), stats.getStats())
+                       for key, stats in self.inbound.items())
+        for b in brokers:
+            for req in b.waitingForAnswers.values():
+                key = methodKey(req.interface_name, req.method_name)
+                if key in outbound:
+                    outbound[key]['in-flight'] += 1
+            for delivery in b.getUnansweredDeliveries():
+                key = methodKey(delivery.getInterfaceName(),
+                                delivery.methodname)
+                if key not in inbound: # still waiting in the queue
+                    inbound[key] = InboundMethodStats().getStats()
+                inbound[key]['in-flight'] += 1
+        return {'outbound': outbound, 'inbound': inbound}
+
+
+class LinkStats:
+    """I measure one connection: round-trip times, from the numbered PINGs
+    that its Broker sends, and the rates at which bytes come and go.
+
+    The round-trip time is smoothed the way TCP does it (RFC 6298): the
+    estimate moves 1/8 of the way to each sample, and the jitter (the mean
+    deviation) 1/4 of the way to each sample's distance from it. The byte
+    rates are measured over the last RATE_SAMPLES snapshots of the
+    counters, taken at least MIN_SAMPLE_SPACING seconds apart.
+    """
+
+    RATE_SAMPLES = 8
+    MIN_SAMPLE_SPACING = 1.0
+
+    def __init__(self):
+        self.rttSamples = 0
+        self.lastRTT = None
+        self.minRTT = None
+        self.smoothedRTT = None
+        self.rttJitter = None
+        self.byteSamples = deque(maxlen=self.RATE_SAMPLES)
+
+    def addRTT(self, rtt):
+        self.rttSamples += 1
+        self.lastRTT = rtt
+        if self.smoothedRTT is None:
+            self.minRTT = self.smoothedRTT = rtt
+            self.rttJitter = rtt / 2
+            return
+        if rtt < self.minRTT:
+            self.minRTT = rtt
+        self.rttJitter += (abs(self.smoothedRTT - rtt) - self.rttJitter) / 4
+        self.smoothedRTT += (rtt - self.smoothedRTT) / 8
+
+    def sampleBytes(self, now, bytesIn, bytesOut):
+        samples = self.byteSamples
+        if samples and now - samples[-1][0] < self.MIN_SAMPLE_SPACING:
+            return
+        samples.append((now, bytesIn, bytesOut))
+
+    def getStats(self, now, bytesIn, bytesOut):
+        self.sampleBytes(now, bytesIn, bytesOut)
+        inRate = outRate = 0.0
+        started, startIn, startOut = self.byteSamples[0]
+        if now > started:
+            inRate = (bytesIn - startIn) / (now - started)
+            outRate = (bytesOut - startOut) / (now - started)
+        return {
+            # all times in seconds, None until the first PONG arrives
+            'rtt': self.smoothedRTT,
+            'rtt-jitter': self.rttJitter,
+            'min-rtt': self.minRTT,
+            'last-rtt': self.lastRTT,
+            'rtt-samples': self.rttSamples,
+            'bytes-in': bytesIn,
+            'bytes-out': bytesOut,
+            # bytes per second, recently
+            'bytes-in-rate': inRate,
+            'bytes-out-rate': outRate,
+        }
+
+
+class HintRecord:
+    __slots__ = ("successes", "failures", "lastSucceeded", "connectTime",
+                 "lastUsed")
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.lastSucceeded = None # None until it has won or failed
+        self.connectTime = None # smoothed, in seconds
+        self.lastUsed = 0
+
+
+class HintStats:
+    """I remember how connecting to each location hint has gone, so that a
+    TubConnector can try the most promising ones first, and I count the
+    connection attempts that turned out to be wasted.
+
+    A hint's connect time is measured from the start of the attempt to the
+    moment the TCP connection is made: about one round trip, plus whatever
+    it took to resolve the hint. It is smoothed like LinkStats smooths its
+    RTT. Hints whose last attempt succeeded come first, fastest first, then
+    the ones we know nothing about, and then the ones that failed last time.
+    Ties keep the order of the FURL.
+
+    At most MAX_HINTS hints are remembered: the least recently used ones
+    are forgotten first.
+    """
+
+    MAX_HINTS = 1000
+
+    def __init__(self):
+        self.hints = {} # hint -> HintRecord
+        self._used = 0
+        self.attempts = 0 # started
+        self.connections = 0 # won
+        self.failures = 0 # failed on their own
+        self.abandonedConnects = 0 # cancelled because another one won
+        self.abandonedNegotiations = 0 # connected, but another one won
+        self.skipped = 0 # never started, because another one won first
+
+    def _get(self, hint):
+        r = self.hints.get(hint)
+        if r is None:
+            if len(self.hints) >= self.MAX_HINTS:
+                oldest = min(self.hints, key=lambda h: self.hints[h].lastUsed)
+                del self.hints[oldest]
+            r = self.hints[hint] = HintRecord()
+        self._used += 1
+        r.lastUsed = self._used
+        return r
+
+    def rank(self, hints):
+        """Return these hints in the order they should be tried."""
+        def _key(i_hint):
+            i, hint = i_hint
+            r = self.hints.get(hint)
+            if r is None or r.lastSucceeded is None:
+                return (1, 0, i)
+            if r.lastSucceeded:
+                return (0, r.connectTime or 0, i)
+            return (2, 0, i)
+        return [hint for (i, hint) in sorted(enumerate(hints), key=_key)]
+
+    def attemptStarted(self, hint):
+        self.attempts += 1
+
+    def attemptConnected(self, hint, seconds):
+        r = self._get(hint)
+        if r.connectTime is None:
+            r.connectTime = seconds
+        else:
+            r.connectTime += (seconds - r.connectTime) / 8
+
+    def attemptSucceeded(self, hint):
+        self.connections += 1
+        r = self._get(hint)
+        r.successes += 1
+        r.lastSucceeded = True
+
+    def attemptFailed(self, hint):
+        self.failures += 1
+        r = self._get(hint)
+        r.failures += 1
+        r.lastSucceeded = False
+
+    def attemptAbandoned(self, hint, negotiating):
+        if negotiating:
+            self.abandonedNegotiations += 1
+        else:
+            self.abandonedConnects += 1
+
+    def hintsSkipped(self, count):
+        self.skipped += count
+
+    def getStats(self):
+        return {
+            'attempts': self.attempts,
+            'connections': self.connections,
+            'failures': self.failures,
+            'abandoned-connects': self.abandonedConnects,
+            'abandoned-negotiations': self.abandonedNegotiations,
+            # the ones that cost a socket, and maybe a handshake, for nothing
+            'wasted-attempts': (self.abandonedConnects +
+                                self.abandonedNegotiations),
+            'skipped-hints': self.skipped,
+            'hints': dict([(hint, {'successes': r.successes,
+                                   'failures': r.failures,
+                                   'connect-time': r.connectTime})
+                           for (hint, r) in self.hints.items()]),
+        }
+
+
+class RICallStats(RemoteInterface):
+    __remote_name__ = "RICallStats.foolscap.lothar.com"
+
+    def get_stats():
+        """Return the Tub's per-method call statistics, as from
+        Tub.getStats()."""
+        return Any()
+
+
+@implementer(RICallStats)
+class CallStatsReporter(Referenceable):
+    """Let a monitoring tool read a Tub's call statistics remotely::
+
+     furl = tub.registerReference(tub.getStatsReporter())
+     ...
+     stats = yield rref.callRemote('get_stats')
+    """
+
+    def __init__(self, tub):
+        self.tub = tub
+
+    def remote_get_stats(self):
+        return self.tub.getStats()
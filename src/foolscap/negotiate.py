@@ -143,7 +143,10 @@ class Negotiation(protocol.Protocol):
     forceNegotiation = None
 
     minVersion = 191
-    maxVersion = 191
+    maxVersion = 199 # 192: NONE/TRUE/FALSE tokens, 193: adaptive vocab,
+                     # 194: (call-batch)/(answer-batch), 195: (pipeline),
+                     # 196: (cancel), 197: decref_many,
+                     # 198: trace context in (call)/(pipeline), 199: (blob)
 
     brokerClass = broker.Broker
 
@@ -634,6 +637,10 @@ class Negotiation(protocol.Protocol):
         if self.tub:
             IR = self.tub.getIncarnationString()
             hello['my-incarnation'] = IR
+            if self.tub.vocabTables:
+                # peers that don't know about application vocab tables will
+                # never offer any, so they can never be chosen
+                hello['app-vocab-tables'] = ' '.join(sorted(self.tub.vocabTables))
 
         self.log("Negotiate.sendHello (isClient=%s): %s" % (self.isClient, hello))
         self.sendBlock(hello)
@@ -840,6 +847,15 @@ class Negotiation(protocol.Protocol):
             decision['initial-vocab-table-index'] = '%d %s' % (vocab_index, vocab_hash)
             decision['banana-decision-version']   = str(self.decision_version)
 
+            # application vocab tables that both Tubs have registered are
+            # appended to the initial table, in digest order
+            theirAppTables = offer.get('app-vocab-tables', '').split()
+            shared = sorted(set(theirAppTables) & set(self.tub.vocabTables))
+            if shared:
+                decision['app-vocab-tables'] = ' '.join(shared)
+                params['app-vocab-tables'] = [self.tub.vocabTables[digest]
+                                              for digest in shared]
+
             # v1: handle vocab table index
             params['banana-decision-version']   = self.decision_version
             params['initial-vocab-table-index'] = vocab_index
@@ -858,6 +874,42 @@ class Negotiation(protocol.Protocol):
             # I am not the master, I receive the decision
             self.receive_phase = DECIDING
 
+    def evaluateNegotiationVersion192(self, offer):
+        # v192 only changes how Banana encodes None/True/False, which is
+        # decided by the banana-decision-version itself
+        return self.evaluateNegotiationVersion191(offer)
+
+    def evaluateNegotiationVersion193(self, offer):
+        # v193 lets either side add to the vocab table as it goes, which is
+        # also decided by the banana-decision-version
+        return self.evaluateNegotiationVersion192(offer)
+
+    def evaluateNegotiationVersion194(self, offer):
+        # v194 adds the (call-batch) and (answer-batch) sequences, which the
+        # Broker only sends if the banana-decision-version allows them
+        return self.evaluateNegotiationVersion193(offer)
+
+    def evaluateNegotiationVersion195(self, offer):
+        # v195 adds the (pipeline) sequence and the releaseAnswer message,
+        # which are only sent if the banana-decision-version allows them
+        return self.evaluateNegotiationVersion194(offer)
+
+    def evaluateNegotiationVersion196(self, offer):
+        # v196 adds the (cancel) sequence
+        return self.evaluateNegotiationVersion195(offer)
+
+    def evaluateNegotiationVersion197(self, offer):
+        # v197 adds the decref_many message to RIBroker
+        return self.evaluateNegotiationVersion196(offer)
+
+    def evaluateNegotiationVersion198(self, offer):
+        # v198 lets a (call) or (pipeline) end with a trace context
+        return self.evaluateNegotiationVersion197(offer)
+
+    def evaluateNegotiationVersion199(self, offer):
+        # v199 adds the (blob) sequence
+        return self.evaluateNegotiationVersion198(offer)
+
     def compareOfferAndExisting(self, offer, existing, lp):
         """Compare the new offer against the existing connection, and
         decide which to keep.
@@ -1070,6 +1122,12 @@ class Negotiation(protocol.Protocol):
             vocab_index = min(self.initialVocabTableIndices.keys())
             vocab_hash  = vocab.hashVocabTable(vocab_index)
 
+        app_tables = []
+        for digest in decision.get('app-vocab-tables', '').split():
+            if digest not in self.tub.vocabTables:
+                raise NegotiationError('I have no app vocab table %s' % digest)
+            app_tables.append(self.tub.vocabTables[digest])
+
         if self.theirTubRef in self.tub.brokers:
             # we're the slave, so we need to drop our existing connection and
             # use the one picked by the master
@@ -1089,8 +1147,43 @@ class Negotiation(protocol.Protocol):
         return {
             'banana-decision-version'  : version,
             'initial-vocab-table-index': vocab_index,
+            'app-vocab-tables'         : app_tables,
         }
 
+    def acceptDecisionVersion192(self, decision):
+        # this adds the NONE, TRUE, and FALSE tokens, which Banana enables
+        # by itself, so we can use the same accept function
+        return self.acceptDecisionVersion191(decision)
+
+    def acceptDecisionVersion193(self, decision):
+        # this allows top-level (add-vocab) and (set-vocab) sequences, which
+        # doesn't change the decision either
+        return self.acceptDecisionVersion192(decision)
+
+    def acceptDecisionVersion194(self, decision):
+        # (call-batch) and (answer-batch) don't change the decision either
+        return self.acceptDecisionVersion193(decision)
+
+    def acceptDecisionVersion195(self, decision):
+        # neither does (pipeline)
+        return self.acceptDecisionVersion194(decision)
+
+    def acceptDecisionVersion196(self, decision):
+        # or (cancel)
+        return self.acceptDecisionVersion195(decision)
+
+    def acceptDecisionVersion197(self, decision):
+        # or decref_many
+        return self.acceptDecisionVersion196(decision)
+
+    def acceptDecisionVersion198(self, decision):
+        # or trace contexts
+        return self.acceptDecisionVersion197(decision)
+
+    def acceptDecisionVersion199(self, decision):
+        # or (blob)
+        return self.acceptDecisionVersion198(decision)
+
     def acceptDecisionVersion2(self, decision):
         # this only affects the interpretation of reqID=0, so we can use the
         # same accept function
@@ -12,12 +12,15 @@ from twisted.python.deprecate import deprecated
 from twisted.python.versions import Version
 
 from foolscap import ipb, base32, negotiate, broker, eventual, storage
-from foolscap import connection, util, info
+from foolscap import connection, util, info, vocab, tracing
+from foolscap.blocking import BlockingCallPool, ProcessCallPool
+from foolscap.metrics import CallStats, CallStatsReporter, HintStats
+from foolscap.timerwheel import TimerWheel
 from foolscap.connections import tcp
 from foolscap.referenceable import SturdyRef
 from .furl import BadFURLError
 from foolscap.tokens import PBError, BananaError, WrongTubIdError, WrongNameError, NoLocationError
-from foolscap.reconnector import Reconnector
+from foolscap.reconnector import Reconnector, ReconnectionScheduler
 from foolscap.logging import log as flog
 from foolscap.logging import log
 from foolscap.logging import publish as flog_publish
@@ -274,6 +277,32 @@ class Tub(service.MultiService):
         self._handle_old_duplicate_connections = False
         self._expose_remote_exception_types = True
         self.accept_gifts = True
+        self._max_write_batch = None
+        self._outbound_high_watermark = None
+        self._outbound_low_watermark = None
+        self._batch_calls = False
+        self._call_timeout = None
+        self._decref_delay = 0
+        self._rtt_probe_interval = None
+        self._connection_stagger = None
+        # blocking remote_ methods run in these threads
+        self.blockingPool = BlockingCallPool()
+        # and cpu_bound ones in these processes
+        self.processPool = ProcessCallPool()
+        # every Broker records its calls in here (see getStats)
+        self.callStats = CallStats()
+        self._statsReporter = None
+        # decides which calls are traced, and collects their spans
+        self.tracer = tracing.Tracer()
+        # the keepalive and disconnect deadlines of all our Brokers
+        self.idleTimers = TimerWheel()
+        # how our outbound connections to each location hint have gone
+        self.hintStats = HintStats()
+        # decides when our Reconnectors try again
+        self.reconnectionScheduler = ReconnectionScheduler()
+        # application vocab tables, offered to every peer (see
+        # registerVocabTable)
+        self.vocabTables = {} # maps hashVocabWords digest to list of bytes
 
     def setOption(self, name, value):
         if name == "logLocalFailures":
@@ -322,9 +351,101 @@ class Tub(service.MultiService):
             self._expose_remote_exception_types = bool(value)
         elif name == "accept-gifts":
             self.accept_gifts = bool(value)
+        elif name == "write-batch-size":
+            # each Broker collects outbound tokens and hands them to the
+            # transport in one write() per reactor turn, or earlier once
+            # this many bytes have been buffered
+            self._max_write_batch = int(value)
+        elif name == "outbound-high-watermark":
+            # while the transport is applying backpressure, each Broker
+            # stops serializing once this many bytes are waiting to be
+            # written ...
+            self._outbound_high_watermark = int(value)
+        elif name == "outbound-low-watermark":
+            # ... and starts again when the backlog drains to this size
+            self._outbound_low_watermark = int(value)
+        elif name == "batch-calls":
+            # send the calls made during one reactor turn to the same peer
+            # as one (call-batch) sequence, and get their answers back in
+            # one (answer-batch)
+            self._batch_calls = bool(value)
+        elif name == "call-timeout":
+            # callRemote() gives up after this many seconds, unless it is
+            # given a _timeout= of its own
+            self._call_timeout = value
+        elif name == "decref-delay":
+            # when RemoteReferences are released, the far end is told in
+            # one message per this many seconds (0: per reactor turn),
+            # instead of one message per reference
+            self._decref_delay = value
+        elif name == "rtt-probe-interval":
+            # every connection sends a numbered PING this often (in
+            # seconds), to keep its round-trip time current (see
+            # ConnectionInfo.rtt). Otherwise it is measured when the
+            # connection is made, and by keepalive PINGs.
+            self._rtt_probe_interval = value
+        elif name == "connection-stagger":
+            # outbound connections try one location hint at a time, moving
+            # on to the next one after this many seconds without a TCP
+            # connection (0: try them all at once)
+            self._connection_stagger = value
+        elif name == "max-reconnects-per-hint":
+            # Reconnectors make no more than this many connection attempts
+            # at a time to any one location hint. The rest wait their turn.
+            self.reconnectionScheduler.maxPerHint = int(value)
+        elif name == "trace-sample-rate":
+            # this fraction of the calls we make (other than the ones made
+            # while serving a traced call, which are always traced) start
+            # a new trace: see foolscap.tracing
+            self.tracer.sampleRate = value
+        elif name == "trace-sink":
+            # finished spans are given to this object's record() method,
+            # instead of being kept in tub.tracer.sink (a MemorySink)
+            self.tracer.sink = value
+        elif name == "blocking-threads":
+            # remote_ methods marked as blocking are run in a pool of at
+            # most this many threads
+            self.blockingPool.setMaxThreads(int(value))
+        elif name == "blocking-queue-limit":
+            # ... and at most this many calls can wait for a free thread,
+            # after which they fail with PoolFullError. None means no limit.
+            if value is not None:
+                value = int(value)
+            self.blockingPool.maxQueued = value
+        elif name == "cpu-workers":
+            # remote_ methods marked as cpu_bound are run in at most this
+            # many worker processes. None means one per CPU.
+            if value is not None:
+                value = int(value)
+            self.processPool.maxWorkers = value
         else:
             raise KeyError("unknown option name '%s'" % name)
 
+    def registerVocabTable(self, words):
+        """Register a list of strings (method names, RemoteInterface names,
+        Copyable type names, ...) that the application expects to send on
+        every connection.
+
+        The table is offered to each peer during negotiation, and if the
+        peer's Tub has registered the very same list, both ends start the
+        connection with these strings in their vocab table, so even the first
+        message uses short VOCAB tokens for them. Tables only affect
+        connections that are negotiated after they are registered.
+
+        @return: the table's digest, as used in the negotiation offer
+        """
+        table = []
+        for word in words:
+            if isinstance(word, str):
+                word = word.encode('utf8')
+            if not isinstance(word, bytes):
+                raise TypeError("vocab words must be bytes or str, not %r" % (word,))
+            if word not in table:
+                table.append(word)
+        digest = vocab.hashVocabWords(table)
+        self.vocabTables[digest] = table
+        return digest
+
     def removeAllConnectionHintHandlers(self):
         self._connectionHandlers = {}
 
@@ -534,6 +655,21 @@ class Tub(service.MultiService):
         connect to this Tub."""
         return self.listeners[:]
 
+    def getStats(self):
+        """Return the call statistics of every connection this Tub has had,
+        per RemoteInterface method: counts, failures, bytes sent, latency
+        histograms, and how many calls are in flight right now. See
+        foolscap.metrics.CallStats.getStats for the format."""
+        return self.callStats.getStats(list(self.brokers.values()))
+
+    def getStatsReporter(self):
+        """Return a Referenceable (implementing RICallStats) whose
+        get_stats() method returns getStats(). Register it to let a
+        monitoring tool collect the statistics."""
+        if not self._statsReporter:
+            self._statsReporter = CallStatsReporter(self)
+        return self._statsReporter
+
     def getTubID(self):
         return self.tubID
     def getShortTubID(self):
@@ -611,6 +747,8 @@ class Tub(service.MultiService):
 
         d = defer.DeferredList(dl)
         d.addCallback(lambda _: service.MultiService.stopService(self))
+        d.addCallback(lambda res: self.blockingPool.stop())
+        d.addCallback(lambda res: self.processPool.stop())
         d.addCallback(eventual.fireEventually)
         return d
 
@@ -922,6 +1060,8 @@ class Tub(service.MultiService):
         t1.setPeer(t2); t2.setPeer(t1)
         n = negotiate.Negotiation()
         params = n.loopbackDecision()
+        params['app-vocab-tables'] = [self.vocabTables[digest]
+                                      for digest in sorted(self.vocabTables)]
         ci = info.ConnectionInfo()
         b1 = self.brokerClass(tubref, params, connectionInfo=ci)
         b2 = self.brokerClass(tubref, params)
@@ -1007,7 +1147,7 @@ class Tub(service.MultiService):
         all_brokers = self.brokers.items()
 
         for tubref,_broker in all_brokers:
-            inbound = _broker.inboundDeliveryQueue[:]
+            inbound = list(_broker.inboundDeliveryQueue)
             outbound = [pr
                         for (reqID, pr) in
                         sorted(_broker.waitingForAnswers.items()) ]
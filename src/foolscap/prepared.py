@@ -0,0 +1,191 @@
+# -*- test-case-name: foolscap.test.test_call -*-
+
+"""Slice an object graph once, and write the tokens into many connections.
+
+Slicing (walking the object graph, finding Slicers, checking each token) is
+most of the CPU cost of sending something. When the same object has to go to
+many peers, or to one peer many times, a PreparedTokens lets that work be
+done once: the graph is run through a TokenRecorder, and the resulting bytes
+are written verbatim wherever the PreparedTokens is sent.
+"""
+
+from twisted.python.failure import Failure
+
+from foolscap import banana
+from foolscap.slicer import BaseSlicer, ReferenceSlicer
+from foolscap.slicers.root import ScopedRootSlicer
+from foolscap.tokens import INT, OPEN, CLOSE
+
+
+class TokenRecorder(banana.Banana):
+    """I serialize one object graph into a list of segments, instead of
+    writing it to a transport.
+
+    Each segment is either a bytestring to be copied verbatim, or an
+    (offset, typebyte) pair for the header of an OPEN or CLOSE token, or the
+    INT token inside a (reference) sequence. These numbers depend upon how
+    many sequences the connection has opened before, so they are recorded
+    relative to the start of the graph and filled in by
+    Banana.sendPrepared().
+
+    Nothing is vocabized, since each connection has its own vocab table.
+    Objects that only make sense on a particular connection (Referenceables,
+    RemoteReferences) are refused with a Violation, because we are not a
+    Broker. So are Deferreds, since the recording has to be complete before
+    it can be used.
+    """
+
+    slicerClass = ScopedRootSlicer
+    streamable = False
+
+    def __init__(self, compactTokens=False):
+        banana.Banana.__init__(self)
+        self.compactTokens = compactTokens
+        self.segments = []
+        self.pending = []
+        self.failure = None
+        self.initSlicer()
+        self.produce() # wait for send()
+
+    def record(self, obj):
+        """Serialize obj, and return (segments, openCount). Raises whatever
+        exception (usually a Violation) made serialization fail."""
+        results = []
+        self.send(obj).addBoth(results.append)
+        if self.failure:
+            self.failure.raiseException()
+        if isinstance(results[0], Failure):
+            results[0].raiseException()
+        self.addSegment(None)
+        return self.segments, self.openCount
+
+    def addSegment(self, segment):
+        if self.pending:
+            self.segments.append(b''.join(self.pending))
+            self.pending = []
+        if segment is not None:
+            self.segments.append(segment)
+
+    def bufferWrite(self, data):
+        self.pending.append(data)
+
+    def flushWrites(self, force=False):
+        pass
+
+    def sendOpen(self):
+        openID = self.openCount
+        self.openCount += 1
+        self.addSegment((openID, OPEN))
+        return openID
+
+    def sendClose(self, openID):
+        self.addSegment((openID, CLOSE))
+
+    def sendToken(self, obj, write=banana.STUB):
+        if type(obj) is int and isinstance(self.slicerStack[-1][0], ReferenceSlicer):
+            # the target of a (reference) is an openID too
+            self.addSegment((obj, INT))
+            return True
+        return banana.Banana.sendToken(self, obj, write)
+
+    def sendPrepared(self, prepared):
+        # a recording nested inside this one: keep its numbers relocatable
+        segments, openCount = prepared.getEncoding(self.compactTokens)
+        base = self.openCount
+        for segment in segments:
+            if type(segment) is bytes:
+                self.pending.append(segment)
+            else:
+                offset, typebyte = segment
+                self.addSegment((base + offset, typebyte))
+        self.openCount = base + openCount
+
+    def sendFailed(self, f):
+        self.failure = f
+
+
+class PreparedTokens:
+    """An object graph that is sliced only once, no matter how many times
+    (or to how many connections) it is sent.
+
+    The graph is recorded the first time it is needed, separately for peers
+    that do and do not understand the single-byte NONE/TRUE/FALSE tokens.
+    It must not be modified after that. The receiving side sees an ordinary
+    object, but object identity is not preserved between the recorded graph
+    and anything else sent alongside it.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.encodings = {}
+
+    def getEncoding(self, compactTokens):
+        encoding = self.encodings.get(compactTokens)
+        if encoding is None:
+            encoding = TokenRecorder(compactTokens).record(self.obj)
+            self.encodings[compactTokens] = encoding
+        return encoding
+
+
+class PreSerialized(PreparedTokens):
+    """Wrap a large, immutable object (a config blob, a manifest, a lookup
+    table) that is passed to callRemote over and over, or returned from a
+    remote_ method, so that it is only sliced once. The far end receives the
+    object itself.
+
+    A PreSerialized can be used as an argument or a return value, or inside
+    other arguments. Schemas can only see through it when it is an argument
+    or the return value itself: the check is done against the wrapped
+    object, and remembered for each constraint.
+
+    hits counts the sends that reused a recording, and misses counts the
+    ones that had to slice the object.
+    """
+
+    def __init__(self, obj):
+        PreparedTokens.__init__(self, obj)
+        self.hits = 0
+        self.misses = 0
+        self.checkedConstraints = []
+
+    def getEncoding(self, compactTokens):
+        if compactTokens in self.encodings:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return PreparedTokens.getEncoding(self, compactTokens)
+
+    def checkObject(self, constraint, inbound):
+        for checked in self.checkedConstraints:
+            if checked is constraint:
+                return
+        constraint.checkObject(self.obj, inbound)
+        self.checkedConstraints.append(constraint)
+
+    def getStats(self):
+        size = 0
+        for segments, openCount in self.encodings.values():
+            for segment in segments:
+                if type(segment) is bytes:
+                    size += len(segment)
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'recordings': len(self.encodings),
+                'bytes': size, # not counting OPEN/CLOSE headers
+                }
+
+    def __repr__(self):
+        return '<PreSerialized %r>' % (self.obj,)
+
+
+class PreparedSlicer(BaseSlicer):
+    slices = PreparedTokens
+    sendOpen = False
+
+    def slice(self, streamable, banana):
+        # the recording brings its own OPEN and CLOSE tokens
+        banana.sendPrepared(self.obj)
+        return iter(())
+
+    def describe(self):
+        return '<prepared>'
@@ -3,6 +3,7 @@
 from twisted.python.failure import Failure
 from twisted.internet import defer
 from foolscap.eventual import eventually
+from foolscap.ipb import IRemoteReference
 
 EVENTUAL, CHAINED, NEAR, BROKEN = range(4)
 
@@ -64,6 +65,13 @@ class Promise(object):
     The eventual-send will eventually invoke the method foo(args) on the
     promise's resolution. This will return a new Promise for the results of
     that method call.
+
+    If the promise resolves to a RemoteReference, the method is invoked with
+    callRemote, and the result is a Promise for a remote answer. Messages
+    sent to that Promise before the answer arrives are pipelined: they are
+    sent to the far end immediately, addressed to the not-yet-known result,
+    so a chain like send(send(rref).getDir()).getChild(x) costs a single
+    round trip (if the peer supports it).
     """
 
     # all our internal methods are private, to avoid a confusing lack of an
@@ -72,6 +80,10 @@ class Promise(object):
 
     _state = EVENTUAL
     _useDataflowStyle = True # enables p.foo(args)
+    # while unresolved, a Promise for a remote result (or one that is chained
+    # to such a Promise) forwards messages with _far(methname, args, kwargs)
+    # instead of queueing them
+    _far = None
 
     def __init__(self):
         self._watchers = []
@@ -111,6 +123,8 @@ class Promise(object):
         """Return a Promise (for the result of the call) when the call is
         eventually made. The call is guaranteed to not fire in this turn."""
         # this is called by send()
+        if self._far:
+            return self._far(methname, args, kwargs)
         p, resolver = makePromise()
         if self._state in (EVENTUAL, CHAINED):
             self._pendingMethods.append((methname, args, kwargs, resolver))
@@ -121,7 +135,9 @@ class Promise(object):
     def _sendOnly(self, methname, args, kwargs):
         """Send a message like _send, but discard the result."""
         # this is called by sendOnly()
-        if self._state in (EVENTUAL, CHAINED):
+        if self._far:
+            self._far(methname, args, kwargs)
+        elif self._state in (EVENTUAL, CHAINED):
             self._pendingMethods.append((methname, args, kwargs, _ignore))
         else:
             eventually(self._deliver, methname, args, kwargs, _ignore)
@@ -161,8 +177,16 @@ class Promise(object):
         # we may be called with a Promise, an immediate value, or a Failure
         if isinstance(target_or_failure, Promise):
             self._state = CHAINED
+            if target_or_failure._far:
+                # don't wait for a remote answer: let the far end have our
+                # messages now, along with any that follow
+                self._far = target_or_failure._send
+                for (methname, args, kwargs, resolver) in self._pendingMethods:
+                    resolver(self._far(methname, args, kwargs))
+                self._pendingMethods = []
             when(target_or_failure).addBoth(self._resolve2)
             return
+        self._far = None
         if isinstance(target_or_failure, Failure):
             self._break(target_or_failure)
             return
@@ -182,7 +206,7 @@ class Promise(object):
         self._target = failure
         if self._state in (EVENTUAL, CHAINED):
             self._deliver_queued_messages()
-        self._state == BROKEN
+        self._state = BROKEN
 
     def _invoke_method(self, name, args, kwargs):
         if isinstance(self._target, Failure):
@@ -202,6 +226,12 @@ class Promise(object):
             resolver(t._send(methname, args, kwargs))
         elif isinstance(t, Failure):
             resolver(t)
+        elif IRemoteReference.providedBy(t):
+            # invoke it remotely. The result can be pipelined on.
+            try:
+                resolver(t._sendPromise(methname, args, kwargs))
+            except:
+                resolver(Failure())
         else:
             d = defer.maybeDeferred(self._deliverOneMethod,
                                     methname, args, kwargs)
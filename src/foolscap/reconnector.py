@@ -1,10 +1,12 @@
 # -*- test-case-name: foolscap.test.test_reconnector -*-
 
 import random
-import time
+from collections import deque
 from twisted.internet import reactor
 from twisted.python import log
 from foolscap.tokens import NegotiationError, RemoteNegotiationError
+from foolscap.furl import BadFURLError
+from foolscap.referenceable import SturdyRef
 
 class ReconnectionInfo:
     def __init__(self):
@@ -12,6 +14,11 @@ class ReconnectionInfo:
         self.connectionInfo = None
         self.lastAttempt = None
         self.nextAttempt = None
+        # counted over the life of the Reconnector
+        self.attempts = 0 # connection attempts
+        self.coalescedAttempts = 0 # ones shared with another Reconnector
+        self.failures = 0
+        self.connects = 0
 
     def _set_state(self, state):
         self.state = state # unstarted, connecting, connected, waiting
@@ -21,6 +28,265 @@ class ReconnectionInfo:
         self.lastAttempt = when
     def _set_next_attempt(self, when):
         self.nextAttempt = when
+    def _count_attempt(self, coalesced):
+        self.attempts += 1
+        if coalesced:
+            self.coalescedAttempts += 1
+    def _count_failure(self):
+        self.failures += 1
+    def _count_connect(self):
+        self.connects += 1
+
+
+class _Target(object):
+    """The Reconnectors that want one Tub, and the backoff they share."""
+
+    def __init__(self, key, hints):
+        self.key = key
+        self.hints = hints
+        self.reconnectors = set()
+        self.waiting = set() # for the next attempt
+        self.connecting = set() # taking part in the current attempt
+        self.delay = None # the last backoff delay, None after a success
+        self.failed = False # did anything fail in the current attempt?
+        self.timer = None
+        self.reserved = False # holding a slot for each of our hints
+        self.queued = False # waiting for a slot
+
+
+class ReconnectionScheduler(object):
+    """I decide when the Reconnectors of a Tub make their attempts.
+
+    Reconnectors that want the same Tub (by TubID) are handled together:
+    they share one backoff delay and one timer, and when it expires they all
+    call getReference() in the same turn, which the Tub turns into a single
+    TubConnector. Without this, each of them would back off on its own, and
+    race the others with an attempt of its own.
+
+    The delays are randomized, so that many clients which lost a server at
+    the same moment do not all come back at the same moment. Each failure
+    multiplies the delay by 'factor', up to maxDelay, and then 'jitter' of
+    it (a fraction, 0 to 1) is chosen at random: with the default of 1, the
+    next delay lies anywhere between initialDelay and 'factor' times the
+    previous one ("decorrelated jitter"). The first attempt after a
+    disconnect waits for up to initialDelay, less a random 'jitter' of it.
+
+    A group uses the smallest initialDelay, factor, and maxDelay of its
+    Reconnectors, and the largest jitter, so it retries as eagerly as the
+    most eager of them would on its own.
+
+    No more than maxPerHint attempts (see the Tub's 'max-reconnects-per-hint'
+    option) are in flight to any one location hint at a time. Attempts that
+    would exceed it wait in line until one of the others has finished.
+    """
+
+    maxPerHint = 8
+
+    def __init__(self, clock=None):
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.targets = {} # TubRef (or Reconnector) -> _Target
+        self.inFlight = {} # hint -> number of attempts using it
+        self.queue = deque() # of _Targets waiting for a slot
+        self.attempts = 0
+        self.coalescedAttempts = 0
+        self.queuedAttempts = 0
+
+    def _getTarget(self, rc):
+        target = self.targets.get(rc._targetKey)
+        if target is None:
+            target = _Target(rc._targetKey, rc._targetHints)
+            self.targets[rc._targetKey] = target
+        return target
+
+    def add(self, rc):
+        """Start managing this Reconnector, and have it connect as soon as
+        possible: right now, unless others with the same target are backing
+        off, or are waiting for a slot, in which case it joins them."""
+        target = self._getTarget(rc)
+        target.reconnectors.add(rc)
+        if target.connecting:
+            # an attempt is underway: share it
+            self._connect(target, rc, coalesced=True)
+            return
+        target.waiting.add(rc)
+        if target.timer or target.queued:
+            self._setWaiting(target, rc)
+        else:
+            self._start(target)
+
+    def remove(self, rc):
+        target = self.targets.get(rc._targetKey)
+        if target is None or rc not in target.reconnectors:
+            return
+        target.reconnectors.discard(rc)
+        target.waiting.discard(rc)
+        if rc in target.connecting:
+            target.connecting.discard(rc)
+            if not target.connecting:
+                self._attemptFinished(target)
+        if not target.reconnectors:
+            self._forget(target)
+
+    def connected(self, rc):
+        target = self.targets[rc._targetKey]
+        target.delay = None
+        target.connecting.discard(rc)
+        if not target.connecting:
+            self._attemptFinished(target)
+
+    def failed(self, rc):
+        target = self.targets[rc._targetKey]
+        target.failed = True
+        target.connecting.discard(rc)
+        target.waiting.add(rc)
+        rc._reconnectionInfo._set_state("waiting")
+        if not target.connecting:
+            self._attemptFinished(target)
+
+    def disconnected(self, rc):
+        target = self.targets[rc._targetKey]
+        target.waiting.add(rc)
+        if target.timer or target.connecting or target.queued:
+            # the others will be back soon, and we'll go with them
+            self._setWaiting(target, rc)
+        else:
+            self._schedule(target, failed=False)
+
+    def reset(self, rc):
+        """Forget the backoff, and try again very soon."""
+        target = self.targets.get(rc._targetKey)
+        if target is None:
+            return
+        target.delay = None
+        if target.timer:
+            target.timer.reset(1.0)
+            for rc in target.waiting:
+                self._setWaiting(target, rc)
+
+    def getDelayUntilNextAttempt(self, rc):
+        target = self.targets.get(rc._targetKey)
+        if target is None or not target.timer:
+            return None
+        return target.timer.getTime() - self.clock.seconds()
+
+    def getStats(self):
+        return {"targets": len(self.targets),
+                "reconnectors": sum([len(t.reconnectors)
+                                     for t in self.targets.values()]),
+                "waiting": len([t for t in self.targets.values()
+                                if t.timer]),
+                "in-flight": len([t for t in self.targets.values()
+                                  if t.reserved]),
+                "queued": len(self.queue),
+                "attempts": self.attempts,
+                "coalesced-attempts": self.coalescedAttempts,
+                "queued-attempts": self.queuedAttempts,
+                }
+
+    # internal methods
+
+    def _nextDelay(self, target, failed):
+        rcs = target.reconnectors
+        initialDelay = min([rc.initialDelay for rc in rcs])
+        factor = min([rc.factor for rc in rcs])
+        maxDelay = min([rc.maxDelay for rc in rcs])
+        jitter = min(max([rc.jitter for rc in rcs]), 1.0)
+        if not failed:
+            delay, lowest = initialDelay, 0
+        else:
+            delay = min((target.delay or initialDelay) * factor, maxDelay)
+            lowest = min(initialDelay, delay)
+        if not jitter:
+            return delay
+        return random.uniform(max(lowest, delay * (1 - jitter)), delay)
+
+    def _schedule(self, target, failed):
+        delay = self._nextDelay(target, failed)
+        if failed:
+            target.delay = delay
+        target.timer = self.clock.callLater(delay, self._timerExpired, target)
+        for rc in target.waiting:
+            self._setWaiting(target, rc)
+
+    def _setWaiting(self, target, rc):
+        if rc.verbose:
+            log.msg("Reconnector waiting to retry for %s" % (rc._url,))
+        rc._reconnectionInfo._set_state("waiting")
+        if target.timer:
+            rc._reconnectionInfo._set_next_attempt(target.timer.getTime())
+        else:
+            rc._reconnectionInfo._set_next_attempt(None) # in line for a slot
+
+    def _timerExpired(self, target):
+        target.timer = None
+        self._start(target)
+
+    def _hasSlots(self, target):
+        for hint in target.hints:
+            if self.inFlight.get(hint, 0) >= self.maxPerHint:
+                return False
+        return True
+
+    def _start(self, target):
+        if not target.waiting:
+            return
+        if not self._hasSlots(target):
+            if not target.queued:
+                target.queued = True
+                self.queue.append(target)
+                self.queuedAttempts += 1
+                for rc in target.waiting:
+                    self._setWaiting(target, rc)
+            return
+        target.queued = False
+        target.reserved = True
+        for hint in target.hints:
+            self.inFlight[hint] = self.inFlight.get(hint, 0) + 1
+        self.attempts += 1
+        target.failed = False
+        rcs, target.waiting = list(target.waiting), set()
+        # they are all connecting before any of them can finish
+        target.connecting.update(rcs)
+        for i, rc in enumerate(rcs):
+            self._connect(target, rc, coalesced=bool(i))
+
+    def _connect(self, target, rc, coalesced):
+        target.connecting.add(rc)
+        if coalesced:
+            self.coalescedAttempts += 1
+        rc._reconnectionInfo._count_attempt(coalesced)
+        rc._connect()
+
+    def _release(self, target):
+        if not target.reserved:
+            return
+        target.reserved = False
+        for hint in target.hints:
+            self.inFlight[hint] -= 1
+            if not self.inFlight[hint]:
+                del self.inFlight[hint]
+        # give the freed slots to the ones that have been waiting longest
+        for t in list(self.queue):
+            if self._hasSlots(t):
+                self.queue.remove(t)
+                self._start(t)
+
+    def _attemptFinished(self, target):
+        self._release(target)
+        if target.waiting and not target.timer:
+            self._schedule(target, target.failed)
+
+    def _forget(self, target):
+        if target.timer:
+            target.timer.cancel()
+            target.timer = None
+        if target.queued:
+            self.queue.remove(target)
+            target.queued = False
+        self._release(target)
+        del self.targets[target.key]
 
 
 class Reconnector(object):
@@ -57,46 +323,59 @@ class Reconnector(object):
     factor = 2.7182818284590451 # (math.e)
     # Phi = 1.6180339887498948 # (Phi is acceptable for use as a
     # factor if e is too large for your application.)
-    jitter = 0.11962656492 # molar Planck constant times c, Joule meter/mole
+    # the fraction of each delay that is chosen at random (0 to 1): the
+    # ReconnectionScheduler describes how it is used
+    jitter = 1.0
     verbose = False
 
     def __init__(self, url, cb, args, kwargs):
         self._url = url
         self._active = False
         self._observer = (cb, args, kwargs)
-        self._delay = self.initialDelay
-        self._timer = None
         self._tub = None
+        self._scheduler = None
         self._last_failure = None
         self._reconnectionInfo = ReconnectionInfo()
+        # Reconnectors for the same Tub are scheduled together
+        try:
+            if isinstance(url, SturdyRef):
+                tubref = url.getTubRef()
+            else:
+                tubref = SturdyRef(url).getTubRef()
+        except (ValueError, BadFURLError):
+            tubref = None # it will fail when we try it
+        if tubref is None or tubref.getTubID() is None:
+            self._targetKey, self._targetHints = self, []
+        else:
+            self._targetKey = tubref
+            self._targetHints = list(tubref.getLocations())
 
     def startConnecting(self, tub):
         self._tub = tub
+        self._scheduler = tub.reconnectionScheduler
         if self.verbose:
             log.msg("Reconnector starting for %s" % self._url)
         self._active = True
-        self._connect()
+        self._scheduler.add(self)
 
     def stopConnecting(self):
         if self.verbose:
             log.msg("Reconnector stopping for %s" % self._url)
         self._active = False
-        if self._timer:
-            self._timer.cancel()
-            self._timer = False
+        if self._scheduler:
+            self._scheduler.remove(self)
         if self._tub:
             self._tub._removeReconnector(self)
 
     def reset(self):
         """Reset the connection timer and try again very soon."""
-        self._delay = self.initialDelay
-        if self._timer:
-            self._timer.reset(1.0)
+        if self._scheduler:
+            self._scheduler.reset(self)
 
     def getDelayUntilNextAttempt(self):
-        if not self._timer:
+        if not (self._active and self._scheduler):
             return None
-        return self._timer.getTime() - time.time()
+        return self._scheduler.getDelayUntilNextAttempt(self)
 
     def getLastFailure(self):
         return self._last_failure
@@ -105,8 +384,10 @@ class Reconnector(object):
         return self._reconnectionInfo
 
     def _connect(self):
+        # called by the scheduler
         self._reconnectionInfo._set_state("connecting")
-        self._reconnectionInfo._set_last_attempt(time.time())
+        self._reconnectionInfo._set_last_attempt(self._scheduler.clock.seconds())
+        self._reconnectionInfo._set_next_attempt(None)
         d = self._tub.getReference(self._url)
         ci = self._tub.getConnectionInfoForFURL(self._url)
         self._reconnectionInfo._set_connection_info(ci)
@@ -115,7 +396,9 @@ class Reconnector(object):
     def _connected(self, rref):
         if not self._active:
             return
+        self._scheduler.connected(self)
         self._reconnectionInfo._set_state("connected")
+        self._reconnectionInfo._count_connect()
         ci = self._tub.getConnectionInfoForFURL(self._url)
         self._reconnectionInfo._set_connection_info(ci)
         self._last_failure = None
@@ -148,27 +431,10 @@ class Reconnector(object):
             log.msg("Reconnector._failed (furl=%s): %s" % (self._url, f))
         if not self._active:
             return
-        self._delay = min(self._delay * self.factor, self.maxDelay)
-        if self.jitter:
-            self._delay = random.normalvariate(self._delay,
-                                               self._delay * self.jitter)
-        self._retry()
+        self._reconnectionInfo._count_failure()
+        self._scheduler.failed(self)
 
     def _disconnected(self):
-        self._delay = self.initialDelay
-        self._retry()
-
-    def _retry(self):
         if not self._active:
             return
-        if self.verbose:
-            log.msg("Reconnector scheduling retry in %ds for %s" %
-                    (self._delay, self._url))
-        self._reconnectionInfo._set_state("waiting")
-        self._reconnectionInfo._set_next_attempt(time.time() + self._delay)
-        self._timer = reactor.callLater(self._delay, self._timer_expired)
-
-    def _timer_expired(self):
-        self._timer = None
-        self._connect()
-
+        self._scheduler.disconnected(self)
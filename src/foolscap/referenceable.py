@@ -5,8 +5,9 @@
 # live in call.py
 
 import weakref
+from operator import attrgetter
 from zope.interface import interface
-from zope.interface import implementer
+from zope.interface import implementer, providedBy, implementedBy
 from twisted.python.components import registerAdapter
 Interface = interface.Interface
 from twisted.internet import defer
@@ -21,6 +22,7 @@ from foolscap.remoteinterface import getRemoteInterface, \
 from foolscap.schema import constraintMap
 from foolscap.copyable import Copyable, RemoteCopy
 from foolscap.eventual import eventually, fireEventually
+from foolscap.promise import makePromise
 from foolscap.furl import decode_furl
 
 
@@ -33,17 +35,49 @@ class OnlyReferenceable:
         return id(self)
 
 
+class DispatchTable:
+    """What an inbound call needs to know about a Referenceable class: its
+    RemoteInterface, and for each method name, the RemoteMethodSchema and a
+    function that fetches the remote_ method from an instance. These are
+    looked up once per class instead of once per call.
+    """
+
+    def __init__(self, klass, interface):
+        self.klass = klass
+        self.interface = interface
+        self.methods = {} # methodname -> (methodSchema, getMethod)
+
+    def getMethod(self, methodname):
+        """Return (methodSchema, getMethod) for the given method name.
+        getMethod(obj) returns the bound method, or raises AttributeError
+        just like doRemoteCall() would. Raises Violation if our
+        RemoteInterface does not define the method."""
+        try:
+            return self.methods[methodname]
+        except KeyError:
+            pass
+        methodSchema = None
+        if self.interface:
+            methodSchema = self.interface.get(methodname)
+            if not methodSchema:
+                raise Violation("method '%s' not defined in %s" %
+                                (methodname, self.interface.__remote_name__))
+        attrname = "remote_%s" % methodname
+        entry = (methodSchema, attrgetter(attrname))
+        # don't let the far end fill the table with names that don't exist
+        if methodSchema or hasattr(self.klass, attrname):
+            self.methods[methodname] = entry
+        return entry
+
+
 @implementer(ipb.IReferenceable, ipb.IRemotelyCallable)
 class Referenceable(OnlyReferenceable):
     _interface = None
     _interfaceName = None
 
-    # TODO: this code wants to be in an adapter, not a base class. Also, it
-    # would be nice to cache this across the class: if every instance has the
-    # same interfaces, they will have the same values of _interface and
-    # _interfaceName, and it feels silly to store this data separately for
-    # each instance. Perhaps we could compare the instance's interface list
-    # with that of the class and only recompute this stuff if they differ.
+    # TODO: this code wants to be in an adapter, not a base class. Inbound
+    # calls use getDispatchTable(), which is cached across the class, but
+    # _interface and _interfaceName are still stored for each instance.
 
     def getInterface(self):
         if not self._interface:
@@ -63,6 +97,25 @@ class Referenceable(OnlyReferenceable):
         res = meth(*args, **kwargs)
         return res
 
+    def getDispatchTable(self):
+        """Return the DispatchTable shared by all instances of my class, or
+        None if calls to me must go through getInterface() and
+        doRemoteCall(): because I provide interfaces of my own (with
+        zope.interface.alsoProvides), or because my class replaces one of
+        those methods."""
+        klass = self.__class__
+        if providedBy(self) is not implementedBy(klass):
+            return None
+        # kept in the class's own __dict__, so subclasses get their own
+        table = klass.__dict__.get("_dispatchTable", STUB)
+        if table is STUB:
+            table = None
+            if (klass.getInterface is Referenceable.getInterface and
+                klass.doRemoteCall is Referenceable.doRemoteCall):
+                table = DispatchTable(klass, getRemoteInterface(self))
+            klass._dispatchTable = table
+        return table
+
 constraintMap[Referenceable] = RemoteInterfaceConstraint(None)
 
 
@@ -431,6 +484,22 @@ class RemoteReference(RemoteReferenceOnly):
         del d
         return None
 
+    def _sendPromise(self, methname, args, kwargs):
+        # invoked by a Promise that was resolved to us: see promise.send()
+        if not self.tracker.broker.canPipeline:
+            p, resolver = makePromise()
+            self.callRemote(methname, *args, **kwargs).addBoth(resolver)
+            return p
+        return self._callRemote(methname, _promise=True, *args, **kwargs)
+
+    def _messageSerialized(self, res, broker, sentDeferred):
+        broker.whenWritten().chainDeferred(sentDeferred)
+        return res
+
+    def _messageFailed(self, f, sentDeferred):
+        sentDeferred.errback(f)
+        return f
+
     def _callRemote(self, _name, *args, **kwargs):
         req = None
         broker = self.tracker.broker
@@ -439,6 +508,14 @@ class RemoteReference(RemoteReferenceOnly):
         resultConstraint = kwargs.get("_resultConstraint", STUB)
         useSchema = kwargs.get("_useSchema", True)
         callOnly  = kwargs.get("_callOnly", False)
+        sentDeferred = kwargs.get("_sentDeferred", None)
+        priority = kwargs.get("_priority", tokens.PRIORITY_NORMAL)
+        prepared = kwargs.get("_prepared", None)
+        promise = kwargs.get("_promise", False)
+        timeout = kwargs.get("_timeout", broker.callTimeout)
+        # internal: more SendQueue keys (CLIDs) to keep this call in order
+        # with, besides the one of the reference it is sent to
+        extraKeys = kwargs.get("_key", ())
 
         if "_methodConstraint" in kwargs:
             del kwargs["_methodConstraint"]
@@ -448,6 +525,21 @@ class RemoteReference(RemoteReferenceOnly):
             del kwargs["_useSchema"]
         if "_callOnly" in kwargs:
             del kwargs["_callOnly"]
+        if "_sentDeferred" in kwargs:
+            del kwargs["_sentDeferred"]
+        if "_priority" in kwargs:
+            del kwargs["_priority"]
+        if "_prepared" in kwargs:
+            del kwargs["_prepared"]
+            assert not args and not kwargs
+            # the arguments were sliced ahead of time, see broadcastRemote
+            args, kwargs = prepared.args, prepared.kwargs
+        if "_promise" in kwargs:
+            del kwargs["_promise"]
+        if "_timeout" in kwargs:
+            del kwargs["_timeout"]
+        if "_key" in kwargs:
+            del kwargs["_key"]
 
         if callOnly:
             if broker.disconnected:
@@ -483,7 +575,10 @@ class RemoteReference(RemoteReferenceOnly):
             # check args against the arg constraint. This could fail if
             # any arguments are of the wrong type
             try:
-                methodSchema.checkAllArgs(args, kwargs, False)
+                if prepared is not None:
+                    prepared.checkAllArgs(methodSchema)
+                else:
+                    methodSchema.checkAllArgs(args, kwargs, False)
             except Violation as v:
                 v.setLocation("%s.%s(%s)" % (interfaceName, methodName, v.getLocation()))
                 raise
@@ -499,7 +594,33 @@ class RemoteReference(RemoteReferenceOnly):
             req.setConstraint(IConstraint(resultConstraint))
 
         clid   = self.tracker.clid
-        slicer = call.CallSlicer(reqID, clid, methodName, args, kwargs)
+        key    = clid
+        if promise:
+            # the far end keeps the result, so that calls can be pipelined
+            # on it. These are ordered by the remote Broker's clid (0),
+            # along with the releaseAnswer that follows the answer.
+            slicer = call.PipelineSlicer(reqID, 0, clid, methodName,
+                                         args, kwargs)
+            key = (clid, 0)
+        else:
+            slicer = call.CallSlicer(reqID, clid, methodName, args, kwargs,
+                                     prepared)
+        if extraKeys:
+            if type(key) is not tuple:
+                key = (key,)
+            key = key + tuple(extraKeys)
+        req.key = key
+        stats = broker.callStats.getOutbound(interfaceName, methodName)
+        stats.calls += 1
+        slicer.stats = stats
+        if not callOnly:
+            # there is no answer to measure the latency of a callOnly to
+            req.stats = stats
+        if broker.tracer is not None:
+            req.span = broker.tracer.startClientSpan(interfaceName,
+                                                     methodName)
+            if req.span and broker.canTrace:
+                slicer.traceContext = req.span.getContext()
 
         # up to this point, we are not committed to sending anything to the
         # far end. The various phases of commitment are:
@@ -537,7 +658,9 @@ class RemoteReference(RemoteReferenceOnly):
 
         try:
             # commitment point 2
-            d = broker.send(slicer)
+            # calls to the same reference stay in order, whatever their
+            # priority
+            d = broker.sendCall(slicer, priority, key)
             # d will fire when the last argument has been serialized. It will
             # errback if the arguments (or any of their children) could not
             # be serialized. We need to catch this case and errback the
@@ -548,11 +671,23 @@ class RemoteReference(RemoteReferenceOnly):
             # be flunked (because we aren't guaranteed that the far end will
             # do it).
 
+            if sentDeferred is not None:
+                # the caller wants to know when the message has left our
+                # buffers and been accepted by the transport
+                d.addCallbacks(self._messageSerialized, self._messageFailed,
+                               callbackArgs=(broker, sentDeferred,),
+                               errbackArgs=(sentDeferred,))
             d.addErrback(req.fail)
         except Exception:
             req.fail(failure.Failure())
 
-        # @todo: (!?) timeout
+        if callOnly and req.span:
+            # no answer will come, so the span ends once the call is sent
+            req.span.finish()
+
+        if timeout is not None and not callOnly:
+            # req.deferred.cancel() tells the far end to give up too
+            req.setTimeout(timeout)
 
         """ [bw] debug
         def cb(result, *args):
@@ -578,6 +713,8 @@ class RemoteReference(RemoteReferenceOnly):
         #  method result violated our results schema
         # if none of those occurred, the callback will be run
 
+        if promise:
+            return _pipelinedPromise(broker, req)
         return req.deferred
 
     def _getMethodInfo(self, name):
@@ -626,6 +763,117 @@ class RemoteMethodReference(RemoteReference):
         return interfaceName, methodName, methodSchema
 
 
+def _pipelinedPromise(broker, req):
+    """Return a Promise for the result of the PendingRequest 'req', which
+    was sent in a (pipeline) sequence. Until its answer arrives, anything
+    sent to the Promise goes out right away, as a (pipeline) sequence
+    addressed to that result."""
+    p, resolver = makePromise()
+    p._far = lambda methname, args, kwargs: \
+             _sendPipelined(broker, req.reqID, methname, args, kwargs)
+    def _answered(res):
+        # nothing more will be pipelined on this result: the Promise now
+        # refers to it directly
+        if broker.remote_broker and not broker.disconnected:
+            broker.remote_broker.callRemoteOnly("releaseAnswer",
+                                                reqID=req.reqID)
+        return res
+    req.deferred.addBoth(_answered)
+    req.deferred.addBoth(resolver)
+    return p
+
+def _sendPipelined(broker, answerOf, methname, args, kwargs):
+    # the target's RemoteInterface is not known yet, so the far end does all
+    # the schema checking
+    try:
+        reqID = broker.newRequestID()
+        req = call.PendingRequest(reqID, None, None, methname)
+        req.interfaceName = None
+        req.methodName = methname
+        req.key = 0
+        slicer = call.PipelineSlicer(reqID, answerOf, 0, methname,
+                                     args, kwargs)
+        req.stats = slicer.stats = broker.callStats.getOutbound(None,
+                                                                methname)
+        req.stats.calls += 1
+        if broker.tracer is not None:
+            req.span = broker.tracer.startClientSpan(None, methname)
+            if req.span and broker.canTrace:
+                slicer.traceContext = req.span.getContext()
+        broker.addRequest(req)
+    except Exception:
+        p, resolver = makePromise()
+        resolver(failure.Failure())
+        return p
+    try:
+        d = broker.sendCall(slicer, tokens.PRIORITY_NORMAL, 0)
+        d.addErrback(req.fail)
+    except Exception:
+        req.fail(failure.Failure())
+    if broker.callTimeout is not None:
+        req.setTimeout(broker.callTimeout)
+    return _pipelinedPromise(broker, req)
+
+
+def broadcastRemote(rrefs, _name, *args, **kwargs):
+    """Invoke the same remote method, with the same arguments, on each of
+    several RemoteReferences. Returns a list of Deferreds, one per
+    RemoteReference, which fire just like the ones from callRemote().
+
+    The arguments are serialized once, and the resulting tokens are written
+    into each connection, which makes this much cheaper than calling
+    callRemote() in a loop when there are many peers. The arguments must not
+    contain anything that is specific to a connection (Referenceables,
+    RemoteReferences), and must not be modified until the calls have been
+    sent. The _useSchema, _methodConstraint, _resultConstraint, _priority
+    and _timeout options are passed through to each call.
+    """
+    options = {}
+    for option in ("_useSchema", "_methodConstraint",
+                   "_resultConstraint", "_priority", "_timeout"):
+        if option in kwargs:
+            options[option] = kwargs.pop(option)
+    rrefs = list(rrefs)
+    prepared = call.PreparedArguments(args, kwargs, _name)
+    try:
+        # slice now, before the caller has a chance to modify the arguments
+        for rref in rrefs:
+            if not rref.tracker.broker.disconnected:
+                prepared.getEncoding(rref.tracker.broker.compactTokens)
+    except Exception:
+        f = failure.Failure()
+        return [defer.fail(f) for rref in rrefs]
+    return [rref.callRemote(_name, _prepared=prepared, **options)
+            for rref in rrefs]
+
+
+def callRemoteBatch(calls):
+    """Invoke several remote methods at once. 'calls' is a sequence of
+    (rref, methodname, args, kwargs) tuples. Returns a list of Deferreds,
+    one per call, which fire just like the ones from callRemote().
+
+    The calls that go to the same connection are sent in a single
+    (call-batch) sequence, and the far end delivers them in order and sends
+    all of their answers back in a single (answer-batch), once the last of
+    them has finished. More than MAX_BATCH_CALLS calls to one connection
+    are split into several batches. Peers that do not understand
+    (call-batch) get ordinary calls.
+    """
+    calls = list(calls)
+    brokers = []
+    for rref, methodname, args, kwargs in calls:
+        broker = rref.tracker.broker
+        if broker not in brokers:
+            brokers.append(broker)
+            broker.startCallBatch()
+    try:
+        return [rref.callRemote(methodname, *args, **kwargs)
+                for rref, methodname, args, kwargs in calls]
+    finally:
+        for broker in brokers:
+            broker.flushCallBatch()
+
+
 @implementer(ipb.IRemoteReference)
 class LocalReferenceable:
 
@@ -651,6 +899,11 @@ class LocalReferenceable:
         d.addErrback(lambda f: None)
         return None
 
+    def _sendPromise(self, methname, args, kwargs):
+        p, resolver = makePromise()
+        self.callRemote(methname, *args, **kwargs).addBoth(resolver)
+        return p
+
 registerAdapter(LocalReferenceable, ipb.IReferenceable, ipb.IRemoteReference)
 
 
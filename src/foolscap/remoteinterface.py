@@ -1,12 +1,15 @@
 
 import types
 import inspect
+from itertools import chain
 from zope.interface import interface, providedBy, implementer
 from foolscap.constraint import Constraint, OpenerConstraint, nothingTaster, \
-     IConstraint, IRemoteMethodConstraint, Optional, Any
+     IConstraint, IRemoteMethodConstraint, Optional, Any, compileConstraint, \
+     compileInboundConstraint
 from foolscap.tokens import Violation, InvalidRemoteInterface
 from foolscap.schema import addToConstraintTypeMap
 from foolscap import ipb
+from foolscap.prepared import PreSerialized
 
 
 class RemoteInterfaceClass(interface.InterfaceClass):
@@ -22,6 +25,10 @@ class RemoteInterfaceClass(interface.InterfaceClass):
                       namespace you administer. If not set, defaults to the
                       short classname.
 
+     __unordered__: if True, calls to any of these methods do not hold up
+                    the calls that arrive after them while their arguments
+                    are being made ready (see RemoteMethodSchema).
+
     RIFoo.names() returns the list of remote method names.
 
     RIFoo['bar'] is still used to get information about method 'bar', however
@@ -68,6 +75,7 @@ class RemoteInterfaceClass(interface.InterfaceClass):
         # InterfaceClass doesn't like arbitrary attributes
         if "__remote_name__" in attrs:
             del attrs["__remote_name__"]
+        unordered = attrs.pop("__unordered__", False)
 
         # determine all remotely-callable methods
         names = [name for name in attrs.keys()
@@ -83,6 +91,8 @@ class RemoteInterfaceClass(interface.InterfaceClass):
                 m = RemoteMethodSchema(method=m)
             m.name = name
             m.interface = self
+            if unordered:
+                m.unordered = True
             remote_attrs[name] = m
             # delete the methods, so zope's InterfaceClass doesn't see them.
             # Particularly necessary for things defined with IConstraints.
@@ -145,6 +155,16 @@ class RemoteMethodSchema:
     __acceptUnknown__: if True, unexpected argument names are always
     accepted without a constraint (which also makes this schema unbounded)
 
+    __unordered__: if True, a call to this method does not make later calls
+    wait for its arguments to be ready (e.g. for a gift to be resolved): it
+    is invoked when they are, possibly after methods that were called after
+    it. By default, methods are invoked in exactly the order they were
+    called.
+
+    __blocking__: if True, the method may block, so it is run in the Tub's
+    pool of threads rather than in the reactor thread (see
+    foolscap.blocking.blocking).
+
     The remotely-accesible object's .getMethodSchema() method may return one
     of these objects.
     """
@@ -154,6 +174,8 @@ class RemoteMethodSchema:
     opentypes = [] # overkill
     ignoreUnknown = False
     acceptUnknown = False
+    unordered = False
+    blocking = False
 
     name = None # method name, set when the RemoteInterface is parsed
     interface = None # points to the RemoteInterface which defines the method
@@ -180,6 +202,12 @@ class RemoteMethodSchema:
         if "__acceptUnknown__" in kwargs:
             self.acceptUnknown = kwargs["__acceptUnknown__"]
             del kwargs["__acceptUnknown__"]
+        if "__unordered__" in kwargs:
+            self.unordered = kwargs["__unordered__"]
+            del kwargs["__unordered__"]
+        if "__blocking__" in kwargs:
+            self.blocking = kwargs["__blocking__"]
+            del kwargs["__blocking__"]
 
         for argname, constraint in kwargs.items():
             self.argumentNames.append(argname)
@@ -187,6 +215,7 @@ class RemoteMethodSchema:
             self.argConstraints[argname] = constraint
             if not isinstance(constraint, Optional):
                 self.required.append(argname)
+        self.compile()
 
     def initFromMethod(self, method):
         # call this with the Interface's prototype method: the one that has
@@ -225,6 +254,30 @@ class RemoteMethodSchema:
         # call the method, its 'return' value is the return constraint
         self.responseConstraint = IConstraint(method())
         self.options = {} # return, wait, reliable, etc
+        self.compile()
+
+    def compile(self):
+        """Flatten the schema into the tables that checkAllArgs() uses on
+        every call. This must be called again if argumentNames,
+        argConstraints, or required are changed."""
+        self._positions = dict((argname, i)
+                               for i, argname in enumerate(self.argumentNames))
+        # (position, name) of each required argument
+        self._required = [(self._positions[argname], argname)
+                          for argname in self.required]
+        # name -> (constraint, checker). checker is None for Any.
+        self._checkers = {}
+        # name -> checker, for the arguments whose tokens do not tell the
+        # whole story (see checkReceivedArgs)
+        self._receivedCheckers = {}
+        for argname, constraint in self.argConstraints.items():
+            if isinstance(constraint, Optional):
+                constraint = constraint.constraint
+            self._checkers[argname] = (constraint,
+                                       compileConstraint(constraint))
+            checker = compileInboundConstraint(constraint)
+            if checker:
+                self._receivedCheckers[argname] = checker
 
 
     def getPositionalArgConstraint(self, argnum):
@@ -263,40 +316,72 @@ class RemoteMethodSchema:
         return self.responseConstraint
 
     def checkAllArgs(self, args, kwargs, inbound):
-        # first we map the positional arguments
-        allargs = {}
-        if len(args) > len(self.argumentNames):
+        names = self.argumentNames
+        numargs = len(args)
+        if numargs > len(names):
             raise Violation("method takes %d positional arguments (%d given)"
-                            % (len(self.argumentNames), len(args)))
-        for i,argvalue in enumerate(args):
-            allargs[self.argumentNames[i]] = argvalue
-        for argname,argvalue in kwargs.items():
-            if argname in allargs:
-                raise Violation("got multiple values for keyword argument '%s'"
-                                % (argname,))
-            allargs[argname] = argvalue
-
-        for argname, argvalue in allargs.items():
-            accept, constraint = self.getKeywordArgConstraint(argname)
-            if not accept:
-                # this argument will be ignored by the far end. TODO: emit a
-                # warning
-                pass
+                            % (len(names), numargs))
+        if numargs:
+            positions = self._positions
+            for argname in kwargs:
+                if positions.get(argname, numargs) < numargs:
+                    raise Violation("got multiple values for keyword "
+                                    "argument '%s'" % (argname,))
+
+        checkers = self._checkers
+        for argname, argvalue in chain(zip(names, args), kwargs.items()):
+            entry = checkers.get(argname)
+            if entry is None:
+                if self.ignoreUnknown or self.acceptUnknown:
+                    # when ignoreUnknown, this argument will be ignored by
+                    # the far end. TODO: emit a warning
+                    continue
+                raise Violation("unknown argument '%s'" % argname)
+            constraint, checker = entry
             try:
-                constraint.checkObject(argvalue, inbound)
+                if isinstance(argvalue, PreSerialized):
+                    argvalue.checkObject(constraint, inbound)
+                elif checker:
+                    checker(argvalue, inbound)
             except Violation as v:
                 v.setLocation("%s=" % argname)
                 raise
 
-        for argname in self.required:
-            if argname not in allargs:
+        self._checkRequired(args, kwargs)
+
+    def checkReceivedArgs(self, args, kwargs):
+        """Finish checking inbound arguments that were checked token by
+        token as they arrived (and which therefore have the right types,
+        number, and names). Only the values that tokens cannot vouch for
+        (integer ranges, regexps, minimum lengths, ..) are checked again,
+        and then we look for missing arguments."""
+        checkers = self._receivedCheckers
+        if checkers:
+            for argname, argvalue in chain(zip(self.argumentNames, args),
+                                           kwargs.items()):
+                checker = checkers.get(argname)
+                if checker:
+                    try:
+                        checker(argvalue, True)
+                    except Violation as v:
+                        v.setLocation("%s=" % argname)
+                        raise
+        self._checkRequired(args, kwargs)
+
+    def _checkRequired(self, args, kwargs):
+        numargs = len(args)
+        for argpos, argname in self._required:
+            if argpos >= numargs and argname not in kwargs:
                 raise Violation("missing required argument '%s'" % argname)
 
     def checkResults(self, results, inbound):
         if self.responseConstraint:
             # this might raise a Violation. The caller will annotate its
             # location appropriately: they have more information than we do.
-            self.responseConstraint.checkObject(results, inbound)
+            if isinstance(results, PreSerialized):
+                results.checkObject(self.responseConstraint, inbound)
+            else:
+                self.responseConstraint.checkObject(results, inbound)
 
 
 @implementer(IRemoteMethodConstraint)
@@ -312,6 +397,9 @@ class UnconstrainedMethod:
          not_method = UnconstrainedMethod()  # this one is not
     """
 
+    unordered = False
+    blocking = False
+
     def getPositionalArgConstraint(self, argnum):
         return (True, Any())
     def getKeywordArgConstraint(self, argname, num_posargs=0,
@@ -319,6 +407,8 @@ class UnconstrainedMethod:
         return (True, Any())
     def checkAllArgs(self, args, kwargs, inbound):
         pass # accept everything
+    def checkReceivedArgs(self, args, kwargs):
+        pass
     def getResponseConstraint(self):
         return Any()
     def checkResults(self, results, inbound):
@@ -65,12 +65,13 @@ from foolscap.slicers.list import ListConstraint
 from foolscap.slicers.set import SetConstraint
 from foolscap.slicers.tuple import TupleConstraint
 from foolscap.slicers.none import Nothing
+from foolscap.slicers.blob import Blob, BlobConstraint
 #  we don't import RemoteMethodSchema from remoteinterface.py, because
 #  remoteinterface.py needs to import us (for addToConstraintTypeMap)
 ignored = [Constraint, Any, ByteStringConstraint, StringConstraint,
            IntegerConstraint, NumberConstraint, BooleanConstraint,
            DictConstraint, ListConstraint, SetConstraint, TupleConstraint,
-           Nothing, Optional, Shared,
+           Nothing, Optional, Shared, BlobConstraint,
            ] # hush pyflakes
 
 # convenience shortcuts
@@ -134,6 +135,7 @@ constraintMap = {
     int  : IntegerConstraint(maxBytes=1024),
     float: NumberConstraint(),
     None : Nothing(),
+    Blob : BlobConstraint(),
 }
 
 # This module provides a function named addToConstraintTypeMap() which helps
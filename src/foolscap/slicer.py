@@ -28,6 +28,9 @@ class BaseSlicer(metaclass=SlicerClass):
     sendOpen = True
     opentype = ()
     trackReferences = False
+    # if True, Banana calls sentBytes() with the size of our whole
+    # sequence, OPEN to CLOSE, once it has been serialized
+    measureBytes = False
 
     def __init__(self, obj):
         # this simplifies Slicers which are adapters
@@ -13,6 +13,7 @@ from foolscap.slicers.set import SetSlicer, SetUnslicer
 from foolscap.slicers.set import FrozenSetSlicer, FrozenSetUnslicer
 #from foolscap.slicers.set import BuiltinSetSlicer
 from foolscap.slicers.dict import DictSlicer, DictUnslicer, OrderedDictSlicer
+from foolscap.slicers.blob import BlobSlicer, MemoryviewSlicer, BlobUnslicer
 from foolscap.slicers.vocab import ReplaceVocabSlicer, ReplaceVocabUnslicer
 from foolscap.slicers.vocab import ReplaceVocabularyTable, AddToVocabularyTable
 from foolscap.slicers.vocab import AddVocabSlicer, AddVocabUnslicer
@@ -29,6 +30,7 @@ unused = [
     FrozenSetSlicer, FrozenSetUnslicer,
     #from foolscap.slicers.set import BuiltinSetSlicer
     DictSlicer, DictUnslicer, OrderedDictSlicer,
+    BlobSlicer, MemoryviewSlicer, BlobUnslicer,
     ReplaceVocabSlicer, ReplaceVocabUnslicer,
     ReplaceVocabularyTable, AddToVocabularyTable,
     AddVocabSlicer, AddVocabUnslicer,
@@ -0,0 +1,198 @@
+# -*- test-case-name: foolscap.test.test_banana -*-
+
+import os, tempfile
+from twisted.internet.defer import Deferred
+from foolscap.tokens import Violation, BananaError, INT, BYTES, BVOCAB
+from foolscap.slicer import BaseSlicer, LeafUnslicer
+from foolscap.constraint import OpenerConstraint, Any
+
+
+class Blob:
+    """A large string of bytes, to be sent in bounded chunks.
+
+    A single BYTES token is limited to SIZE_LIMIT (640KiB), and has to be
+    held in memory in its entirety on both sides. Wrapping the data in a
+    Blob sends it as a (blob) sequence instead: the total size, followed by
+    BYTES tokens of at most chunkSize bytes each. The chunks are read from
+    the source one at a time, as the transport accepts them, so a file is
+    never loaded in full.
+
+    The source may be bytes, a bytearray, a memoryview, or a binary file
+    object (which is read from its current position). If the size of a file
+    is not given, it is found by seeking to the end.
+
+    The receiving side gets a bytearray, or, for blobs larger than the
+    BlobConstraint's spoolThreshold, an anonymous temporary file that has
+    been rewound to the start. It refuses blobs larger than the constraint's
+    maxSize, which is 64MiB unless the schema says otherwise.
+
+    Blobs can only be sent over connections that negotiated the (blob)
+    sequence: sending one to an older peer raises a Violation.
+    """
+
+    chunkSize = 64 * 1024
+
+    def __init__(self, source, size=None, chunkSize=None):
+        self.source = source
+        if chunkSize is not None:
+            self.chunkSize = chunkSize
+        if size is None:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                size = memoryview(source).nbytes
+            else:
+                start = source.tell()
+                size = source.seek(0, os.SEEK_END) - start
+                source.seek(start)
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return '<Blob %d bytes>' % self.size
+
+    def chunks(self):
+        source = self.source
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            data = memoryview(source).cast('B')
+            for offset in range(0, self.size, self.chunkSize):
+                yield bytes(data[offset:offset+self.chunkSize])
+            return
+
+        remaining = self.size
+        while remaining:
+            chunk = source.read(min(remaining, self.chunkSize))
+            if not chunk:
+                raise Violation('blob source ended %d bytes early' % remaining)
+            remaining -= len(chunk)
+            yield bytes(chunk)
+
+
+class BlobSlicer(BaseSlicer):
+    opentype = (b'blob',)
+    trackReferences = False
+    slices = Blob
+
+    def slice(self, streamable, banana):
+        # not a generator, so the Violation is raised before the OPEN is sent
+        if not banana.blobs:
+            raise Violation('this connection cannot carry Blobs')
+        return BaseSlicer.slice(self, streamable, banana)
+
+    def sliceBody(self, streamable, banana):
+        yield self.obj.size
+        for chunk in self.obj.chunks():
+            yield chunk
+
+
+class MemoryviewSlicer(BlobSlicer):
+    slices = memoryview
+
+    def __init__(self, obj):
+        BlobSlicer.__init__(self, Blob(obj))
+
+
+class BlobUnslicer(LeafUnslicer):
+    opentype = (b'blob',)
+    maxSize = 64 * 1024 * 1024
+    spoolThreshold = 16 * 1024 * 1024
+
+    size = None
+    received = 0
+    buffer = None
+
+    def setConstraint(self, constraint):
+        if isinstance(constraint, Any):
+            return
+        assert isinstance(constraint, BlobConstraint)
+        if constraint.maxSize is not None:
+            self.maxSize = constraint.maxSize
+        if constraint.spoolThreshold is not None:
+            self.spoolThreshold = constraint.spoolThreshold
+
+    def start(self, count):
+        if not self.protocol.blobs:
+            raise Violation('this connection did not negotiate (blob)')
+
+    def checkToken(self, typebyte, size):
+        if self.size is None:
+            if typebyte != INT:
+                raise BananaError('BlobUnslicer size must be an INT')
+            if self.maxSize < size:
+                raise Violation('blob too large: %d>%d' % (size, self.maxSize))
+        else:
+            if typebyte not in (BYTES, BVOCAB):
+                raise BananaError('BlobUnslicer only accepts BYTES chunks')
+            if typebyte == BYTES and self.size < self.received + size:
+                raise Violation('blob chunk overruns the announced size (%d)' % self.size)
+
+    def receiveChild(self, obj, ready_deferred=None):
+        assert not isinstance(obj, Deferred)
+        assert ready_deferred is None
+
+        if self.size is None:
+            self.size = obj
+            # the size is only the peer's claim: the buffer grows as the
+            # chunks actually arrive
+            if self.spoolThreshold < obj:
+                self.buffer = tempfile.TemporaryFile()
+            else:
+                self.buffer = bytearray()
+            return
+
+        end = self.received + len(obj)
+        if self.size < end:
+            # a vocabized chunk slips past checkToken
+            raise Violation('blob chunk overruns the announced size (%d)' % self.size)
+        if isinstance(self.buffer, bytearray):
+            self.buffer += obj
+        else:
+            self.buffer.write(obj)
+        self.received = end
+
+    def receiveClose(self):
+        if self.size is None:
+            raise BananaError('blob ended before its size was received')
+        if self.received != self.size:
+            raise BananaError('blob ended after %d of %d bytes' % (self.received, self.size))
+        if not isinstance(self.buffer, bytearray):
+            self.buffer.seek(0)
+        return self.buffer, None
+
+    def describe(self):
+        if self.size is None:
+            return '<blob>'
+        return '<blob>[%d/%d]' % (self.received, self.size)
+
+
+class BlobConstraint(OpenerConstraint):
+    """Accept a Blob of at most maxSize bytes. Blobs larger than
+    spoolThreshold bytes are spooled to a temporary file instead of being
+    assembled in memory. If either is None, the BlobUnslicer default is used
+    (64MiB and 16MiB respectively)."""
+
+    opentypes = [(b'blob',)]
+    name = 'BlobConstraint'
+
+    def __init__(self, maxSize=None, spoolThreshold=None):
+        self.maxSize = maxSize
+        self.spoolThreshold = spoolThreshold
+
+    def checkObject(self, obj, inbound):
+        if inbound:
+            if isinstance(obj, bytearray):
+                size = len(obj)
+            elif hasattr(obj, 'read'):
+                return
+            else:
+                raise Violation('not a blob')
+        elif isinstance(obj, (Blob, memoryview)):
+            size = len(obj) if isinstance(obj, Blob) else obj.nbytes
+        else:
+            raise Violation('not a Blob')
+
+        maxSize = self.maxSize
+        if maxSize is None:
+            maxSize = BlobUnslicer.maxSize
+        if maxSize < size:
+            raise Violation('blob too large: %d>%d' % (size, maxSize))
@@ -55,6 +55,7 @@ class BooleanUnslicer(LeafUnslicer):
 
 class BooleanConstraint(OpenerConstraint):
     strictTaster = True
+    taster = {tokens.OPEN: None, tokens.TRUE: None, tokens.FALSE: None}
     opentypes = [(b"boolean",)]
     _myint = IntegerConstraint()
     name = "BooleanConstraint"
@@ -65,6 +66,14 @@ class BooleanConstraint(OpenerConstraint):
         # imagine a possible use for this, but it made me laugh.
         self.value = value
 
+    def checkToken(self, typebyte, size):
+        # a bare TRUE/FALSE token never reaches a BooleanUnslicer, so the
+        # joke has to be enforced here
+        if self.value != None and typebyte in (tokens.TRUE, tokens.FALSE):
+            if (typebyte == tokens.TRUE) != self.value:
+                raise Violation("This boolean can only be %s" % self.value)
+        OpenerConstraint.checkToken(self, typebyte, size)
+
     def checkObject(self, obj, inbound):
         if type(obj) != bool:
             raise Violation("not a bool")
@@ -1,10 +1,12 @@
 # -*- test-case-name: foolscap.test.test_banana -*-
 
+from itertools import repeat
 from twisted.python import log
 from twisted.internet.defer import Deferred
 from foolscap.tokens import Violation, BananaError
 from foolscap.slicer import BaseSlicer, BaseUnslicer
-from foolscap.constraint import OpenerConstraint, Any, IConstraint
+from foolscap.constraint import OpenerConstraint, Any, IConstraint, \
+     checkNested
 from foolscap.util import AsyncAND
 
 
@@ -137,13 +139,24 @@ class DictConstraint(OpenerConstraint):
         self.valueConstraint = IConstraint(valueConstraint)
         self.maxKeys = maxKeys
 
-    def checkObject(self, obj, inbound):
+    def checkShape(self, obj):
         if not isinstance(obj, dict):
             raise Violation("'%s' (%s) is not a Dictionary" % (obj, type(obj)))
 
         if self.maxKeys != None and len(obj) > self.maxKeys:
             raise Violation("Dict keys=%d > maxKeys=%d" % (len(obj), self.maxKeys))
 
+        if isinstance(self.keyConstraint, Any):
+            if isinstance(self.valueConstraint, Any):
+                return None
+            return zip(repeat(self.valueConstraint), obj.values())
+        return self._members(obj)
+
+    def _members(self, obj):
+        kc, vc = self.keyConstraint, self.valueConstraint
         for key, value in obj.items():
-            self.keyConstraint.checkObject(key, inbound)
-            self.valueConstraint.checkObject(value, inbound)
+            yield kc, key
+            yield vc, value
+
+    def checkObject(self, obj, inbound):
+        checkNested(self, obj, inbound)
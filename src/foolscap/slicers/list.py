@@ -1,10 +1,12 @@
 # -*- test-case-name: foolscap.test.test_banana -*-
 
+from itertools import repeat
 from twisted.python import log
 from twisted.internet.defer import Deferred
 from foolscap.tokens import Violation
 from foolscap.slicer import BaseSlicer, BaseUnslicer
-from foolscap.constraint import OpenerConstraint, Any, IConstraint
+from foolscap.constraint import OpenerConstraint, Any, IConstraint, \
+     checkNested
 from foolscap.util import AsyncAND
 
 
@@ -145,7 +147,7 @@ class ListConstraint(OpenerConstraint):
         self.maxLength = maxLength
         self.minLength = minLength
 
-    def checkObject(self, obj, inbound):
+    def checkShape(self, obj):
         if not isinstance(obj, list):
             raise Violation("not a list")
 
@@ -155,5 +157,13 @@ class ListConstraint(OpenerConstraint):
         if len(obj) < self.minLength:
             raise Violation("list too short")
 
-        for o in obj:
-            self.constraint.checkObject(o, inbound)
+        if isinstance(self.constraint, Any):
+            return None
+        return zip(repeat(self.constraint), obj)
+
+    def checkObject(self, obj, inbound):
+        checkNested(self, obj, inbound)
+
+    def checkedByTokens(self):
+        # ListUnslicer enforces maxLength, but nothing enforces minLength
+        return not self.minLength and self.constraint.checkedByTokens()
@@ -1,6 +1,6 @@
 # -*- test-case-name: foolscap.test.test_banana -*-
 
-from foolscap.tokens import Violation, BananaError
+from foolscap.tokens import Violation, BananaError, OPEN, NONE
 from foolscap.slicer import BaseSlicer, LeafUnslicer
 from foolscap.constraint import OpenerConstraint
 
@@ -29,6 +29,7 @@ class NoneUnslicer(LeafUnslicer):
 class Nothing(OpenerConstraint):
     """Accept only 'None'."""
     strictTaster = True
+    taster = {OPEN: None, NONE: None}
     opentypes = [(b"none",)]
     name = "Nothing"
 
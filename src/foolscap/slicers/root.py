@@ -1,6 +1,7 @@
 # -*- test-case-name: foolscap.test.test_banana -*-
 
 import types
+import collections
 from functools import reduce
 
 from zope.interface import implementer
@@ -10,12 +11,82 @@ from twisted.python import log
 
 from foolscap import tokens
 from foolscap.tokens import Violation, BananaError
+from foolscap.tokens import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK
 from foolscap.slicer import BaseUnslicer, ReferenceSlicer
 from foolscap.slicer import UnslicerRegistry, BananaUnslicerRegistry
 from foolscap.slicers.vocab import ReplaceVocabularyTable, AddToVocabularyTable
 from foolscap import copyable # does this create a cycle?
 
 
+class SendQueue:
+    """I hold the (obj, Deferred) pairs waiting to be serialized by the
+    RootSlicer, in one FIFO lane per priority. The most urgent non-empty
+    lane is always served first.
+
+    Objects queued with the same key (the Broker uses the CLID of the target
+    reference) are never reordered: an object is demoted to the lane of any
+    earlier object with its key that is still waiting. An object that stands
+    for several others (a batch of calls) can be queued under a tuple of
+    keys, and is ordered with respect to each of them.
+    """
+
+    def __init__(self):
+        self.lanes = [collections.deque()
+                      for i in range(PRIORITY_HIGH, PRIORITY_BULK+1)]
+        self.keys = {} # key -> [lane of the newest entry, count]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for lane in self.lanes:
+            for item, key in lane:
+                yield item
+
+    def append(self, item, priority=PRIORITY_NORMAL, key=None):
+        if not PRIORITY_HIGH <= priority <= PRIORITY_BULK:
+            raise ValueError("unknown priority %r" % (priority,))
+        if key is None:
+            keys = ()
+        elif type(key) is tuple:
+            keys = key
+        else:
+            keys = (key,)
+        for k in keys:
+            waiting = self.keys.get(k)
+            if waiting:
+                priority = max(priority, waiting[0])
+        for k in keys:
+            waiting = self.keys.get(k)
+            if waiting:
+                waiting[0] = priority
+                waiting[1] += 1
+            else:
+                self.keys[k] = [priority, 1]
+        self.lanes[priority].append((item, keys))
+        self.size += 1
+
+    def pop(self):
+        for lane in self.lanes:
+            if lane:
+                item, keys = lane.popleft()
+                self.size -= 1
+                for k in keys:
+                    waiting = self.keys[k]
+                    waiting[1] -= 1
+                    if not waiting[1]:
+                        del self.keys[k]
+                return item
+        raise IndexError("pop from an empty SendQueue")
+
+    def clear(self):
+        for lane in self.lanes:
+            lane.clear()
+        self.keys.clear()
+        self.size = 0
+
+
 @implementer(tokens.ISlicer, tokens.IRootSlicer)
 class RootSlicer:
     streamableInGeneral = True
@@ -26,7 +97,7 @@ class RootSlicer:
 
     def __init__(self, protocol):
         self.protocol  = protocol
-        self.sendQueue = []
+        self.sendQueue = SendQueue()
 
     def allowStreaming(self, streamable):
         self.streamableInGeneral = streamable
@@ -108,13 +179,15 @@ class RootSlicer:
         self.objectSentDeferred = None
         return None
 
-    def send(self, obj):
+    def send(self, obj, priority=PRIORITY_NORMAL, key=None):
         # obj can also be a Slicer, say, a CallSlicer. We return a Deferred
-        # which fires when the object has been fully serialized.
+        # which fires when the object has been fully serialized. Objects go
+        # out in FIFO order within each priority lane, and objects with the
+        # same key are never reordered (see SendQueue).
         idle = (len(self.protocol.slicerStack) == 1) and not self.sendQueue
 
         objectSentDeferred = Deferred()
-        self.sendQueue.append((obj, objectSentDeferred))
+        self.sendQueue.append((obj, objectSentDeferred), priority, key)
 
         if idle:
             # wake up
@@ -139,11 +212,11 @@ class RootSlicer:
             self.objectSentDeferred.errback(why)
             self.objectSentDeferred = None
 
-        for obj, d in self.sendQueue:
+        queued = list(self.sendQueue)
+        self.sendQueue.clear()
+        for obj, d in queued:
             d.errback(why)
 
-        self.sendQueue = []
-
 
 class ScopedRootSlicer(RootSlicer):
     # this combines RootSlicer with foolscap.slicer.ScopedSlicer . The funny
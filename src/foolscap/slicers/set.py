@@ -1,12 +1,14 @@
 # -*- test-case-name: foolscap.test.test_banana -*-
 
+from itertools import repeat
 from twisted.internet import defer
 from twisted.python import log
 from foolscap.slicers.list import ListSlicer
 from foolscap.slicers.tuple import TupleUnslicer
 from foolscap.slicer import BaseUnslicer
 from foolscap.tokens import Violation
-from foolscap.constraint import OpenerConstraint, Any, IConstraint
+from foolscap.constraint import OpenerConstraint, Any, IConstraint, \
+     checkNested
 from foolscap.util import AsyncAND
 
 
@@ -160,7 +162,7 @@ class SetConstraint(OpenerConstraint):
         self.maxLength = maxLength
         self.mutable = mutable
 
-    def checkObject(self, obj, inbound):
+    def checkShape(self, obj):
         if not isinstance(obj, (set, frozenset)):
             raise Violation("not a set")
         if (self.mutable == True and
@@ -171,6 +173,9 @@ class SetConstraint(OpenerConstraint):
             raise Violation("obj is a set, but not an immutable one")
         if self.maxLength is not None and len(obj) > self.maxLength:
             raise Violation("set is too large")
-        if self.constraint:
-            for o in obj:
-                self.constraint.checkObject(o, inbound)
+        if not self.constraint or isinstance(self.constraint, Any):
+            return None
+        return zip(repeat(self.constraint), obj)
+
+    def checkObject(self, obj, inbound):
+        checkNested(self, obj, inbound)
@@ -4,7 +4,8 @@ from twisted.internet.defer import Deferred
 from foolscap.tokens import Violation
 from foolscap.slicer import BaseUnslicer
 from foolscap.slicers.list import ListSlicer
-from foolscap.constraint import OpenerConstraint, Any, IConstraint
+from foolscap.constraint import OpenerConstraint, Any, IConstraint, \
+     checkNested
 from foolscap.util import AsyncAND
 
 
@@ -133,10 +134,12 @@ class TupleConstraint(OpenerConstraint):
     def __init__(self, *elemConstraints):
         self.constraints = [IConstraint(e) for e in elemConstraints]
 
-    def checkObject(self, obj, inbound):
+    def checkShape(self, obj):
         if not isinstance(obj, tuple):
             raise Violation("not a tuple")
         if len(obj) != len(self.constraints):
             raise Violation("wrong size tuple")
-        for i in range(len(self.constraints)):
-            self.constraints[i].checkObject(obj[i], inbound)
+        return zip(self.constraints, obj)
+
+    def checkObject(self, obj, inbound):
+        checkNested(self, obj, inbound)
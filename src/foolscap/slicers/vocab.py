@@ -64,6 +64,7 @@ class ReplaceVocabUnslicer(LeafUnslicer):
     string) sequence."""
 
     opentype = (b'set-vocab',)
+    # None means the protocol's maxIncomingVocabulary
     maxKeys  = None
     unslicerRegistry = BananaUnslicerRegistry
     valueConstraint  = ByteStringConstraint(100)
@@ -76,6 +77,8 @@ class ReplaceVocabUnslicer(LeafUnslicer):
     def start(self, count):
         self.d   = {}
         self.key = None
+        if self.maxKeys is None:
+            self.maxKeys = self.protocol.maxIncomingVocabulary
 
     def checkToken(self, typebyte, size):
         if self.maxKeys is not None and len(self.d) >= self.maxKeys:
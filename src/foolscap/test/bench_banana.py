@@ -1,7 +1,13 @@
-from six import StringIO
+from six import BytesIO
+from twisted.internet.selectreactor import SelectReactor
 from foolscap import storage
+from foolscap.banana import BufferChain, ReceiveBuffer
+from foolscap.banana import int2b128, b1282int, HIGH_BIT_SET
+from foolscap.tokens import BYTES
+from foolscap.call import ArgumentSlicer, PreparedArguments
+from foolscap.timerwheel import TimerWheel
 
-class TestTransport(StringIO):
+class TestTransport(BytesIO):
     disconnectReason = None
     def loseConnection(self):
         pass
@@ -36,6 +42,137 @@ class B(object):
             self.banana.dataReceived(o[i:i+CHOMP])
         # print results
 
+class Buffers(object):
+    """ Feed a stream of N small BYTES tokens through each receive buffer,
+    using the access pattern that Banana.handleData has with it: BufferChain
+    is drained with popleft()/appendleft() around every header, while
+    ReceiveBuffer is scanned in place. """
+    CHOMP = 4096
+
+    def setup_small_tokens(self, N):
+        tokens = []
+        for i in range(N):
+            data = b"token-%d" % i
+            tokens.append(int2b128(len(data)) + BYTES + data)
+        self.stream = b''.join(tokens)
+
+    def bench_bufferchain(self, N):
+        buf = BufferChain()
+        s = self.stream
+        for i in range(0, len(s), self.CHOMP):
+            buf.append(s[i:i+self.CHOMP])
+            while buf:
+                first65 = buf.popleft(65)
+                pos = 0
+                for ch in first65:
+                    if HIGH_BIT_SET <= ch:
+                        break
+                    pos += 1
+                else:
+                    buf.appendleft(first65)
+                    break
+                header = b1282int(first65[:pos])
+                buf.appendleft(first65[pos+1:])
+                if first65[pos:pos+1] == BYTES:
+                    if header > len(buf):
+                        buf.appendleft(first65[:pos+1])
+                        break
+                    buf.popleft(header)
+
+    def bench_receivebuffer(self, N):
+        buf = ReceiveBuffer()
+        s = self.stream
+        for i in range(0, len(s), self.CHOMP):
+            buf.append(s[i:i+self.CHOMP])
+            while buf:
+                pos = buf.scanHeader(65)
+                if pos is None:
+                    break
+                prefix = buf.peek(pos + 1)
+                header = b1282int(prefix[:pos])
+                buf.skip(pos + 1)
+                if prefix[pos:pos+1] == BYTES:
+                    if header > len(buf):
+                        buf.rewind(pos + 1)
+                        break
+                    buf.popleft(header)
+
+class Broadcast(object):
+    """ Send the same (arguments) sequence, a state snapshot with a few
+    hundred entries, into 100 connections: once by slicing it anew for each
+    one (what a callRemote loop does), and once by slicing it a single time
+    and writing the recorded tokens into each (what broadcastRemote does). """
+    PEERS = 100
+
+    def setup_snapshot(self, N):
+        self.state = dict(("peer-%d" % i, {"addr": "10.0.%d.%d" % (i // 256, i % 256),
+                                          "seen": i * 1.5, "up": True})
+                          for i in range(N))
+        self.bananas = []
+        for i in range(self.PEERS):
+            b = storage.StorageBanana()
+            b.transport = TestTransport()
+            b.connectionMade()
+            self.bananas.append(b)
+
+    def bench_naive(self, N):
+        for b in self.bananas:
+            b.send(ArgumentSlicer((self.state,), {}, "update"))
+
+    def bench_prepared(self, N):
+        prepared = PreparedArguments((self.state,), {}, "update")
+        for b in self.bananas:
+            b.send(prepared)
+
+class SteppedReactor(SelectReactor):
+    """ A real (but not installed) reactor, so timed calls go through its
+    heap, with a clock that only moves when we advance() it. """
+    now = 1000.0
+    def seconds(self):
+        return self.now
+    def advance(self, amount):
+        self.now += amount
+        self.runUntilCurrent()
+
+class IdleTimers(object):
+    """ Keep N idle connections with 10-second keepalives and run the clock
+    through a minute: once with the deadlines on a TimerWheel, and once with
+    a DelayedCall per connection, re-armed the way each Banana used to do
+    it. """
+    KEEPALIVE = 10
+    SECONDS = 60
+
+    def setup_connections(self, N):
+        self.clock = SteppedReactor()
+        self.wheel = TimerWheel(clock=self.clock)
+        self.bananas = []
+        for i in range(N):
+            b = storage.StorageBanana()
+            b.keepaliveTimeout = self.KEEPALIVE
+            b.idleTimers = self.wheel
+            b.sendKeepalive = lambda: None
+            b.transport = TestTransport()
+            b.connectionMade()
+            self.bananas.append(b)
+
+    def _run(self):
+        for second in range(self.SECONDS):
+            self.clock.advance(1.0)
+
+    def bench_wheel(self, N):
+        self._run()
+
+    def _fired(self, b):
+        if self.clock.seconds() - b.dataLastReceivedAt > self.KEEPALIVE:
+            b.sendKeepalive()
+        self.clock.callLater(self.KEEPALIVE, self._fired, b)
+
+    def bench_delayedcalls(self, N):
+        for b in self.bananas:
+            b.keepaliveTimer.cancel()
+            self.clock.callLater(self.KEEPALIVE, self._fired, b)
+        self._run()
+
 import sys
 from twisted.internet import reactor
 from pyutil import benchutil
@@ -44,3 +181,21 @@ for N in 10**3, 10**4, 10**5, 10**6, 10**7:
     print("%8d" % N,)
     sys.stdout.flush()
     benchutil.rep_bench(b.bench_huge_string_decode, N, b.setup_huge_string)
+c = Buffers()
+for N in 10**3, 10**4, 10**5:
+    for bench in c.bench_bufferchain, c.bench_receivebuffer:
+        print("%8d %s" % (N, bench.__name__))
+        sys.stdout.flush()
+        benchutil.rep_bench(bench, N, c.setup_small_tokens)
+d = Broadcast()
+for N in 10, 10**2, 10**3:
+    for bench in d.bench_naive, d.bench_prepared:
+        print("%8d %s" % (N, bench.__name__))
+        sys.stdout.flush()
+        benchutil.rep_bench(bench, N, d.setup_snapshot)
+e = IdleTimers()
+for N in 10**3, 10**4, 5*10**4:
+    for bench in e.bench_delayedcalls, e.bench_wheel:
+        print("%8d %s" % (N, bench.__name__))
+        sys.stdout.flush()
+        benchutil.rep_bench(bench, N, e.setup_connections)
@@ -205,10 +205,10 @@ class TargetMixin(PollMixin, StallMixin):
     def setUp(self):
         self.loopbacks = []
 
-    def setupBrokers(self):
+    def setupBrokers(self, params={}):
 
-        self.targetBroker = broker.Broker(TubRef("targetBroker"))
-        self.callingBroker = broker.Broker(TubRef("callingBroker"))
+        self.targetBroker = broker.Broker(TubRef("targetBroker"), params)
+        self.callingBroker = broker.Broker(TubRef("callingBroker"), params)
 
         t1 = Loopback()
         t1.peer = self.callingBroker
@@ -8,11 +8,15 @@ from twisted.internet import defer
 from foolscap.tokens   import ISlicer, Violation, BananaError
 from foolscap.tokens   import BananaFailure, tokenNames
 from foolscap.tokens   import OPEN, CLOSE, ABORT, ERROR, INT, NEG, FLOAT, STRING, BYTES, SVOCAB, BVOCAB
-from foolscap          import slicer, schema, storage, banana, vocab
+from foolscap.tokens   import NONE, TRUE, FALSE
+from foolscap.tokens   import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK
+from foolscap          import slicer, schema, storage, banana, vocab, tokens
 from foolscap.eventual import fireEventually, flushEventualQueue
 from foolscap.slicers.allslicers import RootSlicer, DictUnslicer, TupleUnslicer
+from foolscap.slicers.vocab import ReplaceVocabularyTable, AddToVocabularyTable
 from foolscap.constraint import IConstraint
 from foolscap.banana     import int2b128, Banana
+from foolscap.slicers.blob import Blob
 
 import struct
 from io      import BytesIO
@@ -1552,6 +1556,355 @@ class ByteStream(TestBananaMixin, unittest.TestCase):
             .addCallback(self.wantEqual, expected)
 
 
+class CountingTransport(TestTransport):
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return TestTransport.write(self, data)
+
+
+class WriteBatching(TestBananaMixin, unittest.TestCase):
+    def makeBanana(self):
+        TestBananaMixin.makeBanana(self)
+        self.banana.transport = CountingTransport()
+
+    def test_one_write_per_object(self):
+        obj = {'a': [1, 2, 3], 'b': ('x', 'y'), 'c': {'d': 4.5}}
+        d = self.encode(obj)
+        def _check(data):
+            self.assertEqual(self.banana.transport.writes, 1)
+            stats = self.banana.getWriteStats()
+            self.assertEqual(stats['flushes'], 1)
+            self.assertEqual(stats['bytes'], len(data))
+            self.assertEqual(stats['buffered-bytes'], 0)
+            self.assertEqual(self.shouldDecode(data), obj)
+        d.addCallback(_check)
+        return d
+
+    def test_max_batch(self):
+        self.banana.maxWriteBatch = 10
+        obj = ['%02d' % i for i in range(20)]
+        d = self.encode(obj)
+        def _check(data):
+            self.assertTrue(self.banana.transport.writes > 1)
+            stats = self.banana.getWriteStats()
+            self.assertEqual(stats['bytes'], len(data))
+            self.assertTrue(stats['max-bytes-per-flush'] < 20)
+            self.assertEqual(self.shouldDecode(data), obj)
+        d.addCallback(_check)
+        return d
+
+    def test_coalesce(self):
+        self.banana.coalesceWrites = True
+        d1 = self.banana.send([1, 2])
+        d2 = self.banana.send([3, 4])
+        # serialized, but not yet written
+        self.assertEqual(self.banana.transport.writes, 0)
+        d = defer.DeferredList([d1, d2])
+        d.addCallback(fireEventually)
+        def _check(res):
+            self.assertEqual(self.banana.transport.writes, 1)
+            expected = join(bOPEN(b'list', 0), bINT(1), bINT(2), bCLOSE(0),
+                            bOPEN(b'list', 1), bINT(3), bINT(4), bCLOSE(1))
+            self.wantEqual(self.banana.transport.getvalue(), expected)
+        d.addCallback(_check)
+        return d
+
+
+class PausingTransport(TestTransport):
+    # while 'full', pauses its producer after every write, like a transport
+    # whose buffer is always full
+    producer = None
+    full = False
+
+    def registerProducer(self, producer, streaming):
+        assert self.producer is None
+        self.producer = producer
+
+    def unregisterProducer(self):
+        assert self.producer is not None
+        self.producer = None
+
+    def write(self, data):
+        TestTransport.write(self, data)
+        if self.full and self.producer:
+            self.producer.pauseProducing()
+
+
+class Backpressure(TestBananaMixin, unittest.TestCase):
+    def makeBanana(self):
+        TestBananaMixin.makeBanana(self)
+        self.banana.transport = PausingTransport()
+        self.banana.registerWithTransport()
+        self.banana.maxWriteBatch = 20
+        self.banana.highWatermark = 100
+        self.banana.lowWatermark = 50
+
+    def test_pause(self):
+        b = self.banana
+        obj = ['%03d' % i for i in range(100)]
+        b.pauseProducing()
+        d = b.send(obj)
+        sent = []
+        d.addCallback(sent.append)
+        # slicing stopped once the buffer reached the high watermark
+        self.assertEqual(b.transport.getvalue(), b'')
+        self.assertTrue(b.paused)
+        self.assertTrue(b.writeBufferSize >= 100)
+        self.assertTrue(b.writeBufferSize < 200)
+        self.assertEqual(len(b.slicerStack), 2)
+        self.assertEqual(sent, [])
+        # from here on, the transport pauses us after every write
+        b.transport.full = True
+        while not sent:
+            b.resumeProducing()
+            # each resume hands over a single batch
+            self.assertTrue(b.getWriteStats()['max-bytes-per-flush'] < 40)
+            # and we stay registered, to hear when to resume
+            self.assertIdentical(b.transport.producer, b)
+        b.transport.full = False
+        b.resumeProducing()
+        self.assertFalse(b.paused)
+        # the pressure is off, so we let go of the transport
+        self.assertIdentical(b.transport.producer, None)
+        self.assertEqual(b.writeBufferSize, 0)
+        self.assertEqual(self.shouldDecode(b.transport.getvalue()), obj)
+
+    def test_registered_while_paused(self):
+        # we are only the transport's producer while it pushes back, since
+        # a TLS transport won't close while a producer is registered
+        b = self.banana
+        b.send([1, 2])
+        self.assertEqual(self.shouldDecode(b.transport.getvalue()), [1, 2])
+        self.assertIdentical(b.transport.producer, None)
+        b.transport.full = True
+        b.send([3])
+        self.assertIdentical(b.transport.producer, b)
+        self.assertTrue(b.transportPaused)
+        b.transport.full = False
+        b.resumeProducing()
+        self.assertIdentical(b.transport.producer, None)
+        b.transport.full = True
+        b.send([4])
+        # dropConnection() lets go of the transport before closing it
+        b.dropConnection()
+        self.assertIdentical(b.transport.producer, None)
+
+    def test_when_written(self):
+        b = self.banana
+        b.pauseProducing()
+        b.send([1, 2])
+        fired = []
+        b.whenWritten().addCallback(fired.append)
+        self.assertEqual(fired, [])
+        self.assertEqual(b.transport.getvalue(), b'')
+        b.resumeProducing()
+        self.assertEqual(fired, [None])
+        self.assertEqual(self.shouldDecode(b.transport.getvalue()), [1, 2])
+        # nothing is outstanding, so this fires right away
+        b.whenWritten().addCallback(fired.append)
+        self.assertEqual(fired, [None, None])
+
+
+class SendScheduling(TestBananaMixin, unittest.TestCase):
+    def makeBanana(self):
+        TestBananaMixin.makeBanana(self)
+        self.banana.highWatermark = 1
+        self.banana.lowWatermark = 0
+
+    def sendAll(self, *items):
+        # hold the first object back so the rest have to queue up behind it,
+        # then let them all go and return the order they were sent in
+        b = self.banana
+        b.pauseProducing()
+        b.send([0])
+        self.assertTrue(b.paused)
+        sent = []
+        for name, priority, key in items:
+            d = b.send(name, priority, key)
+            d.addCallback(lambda res, name=name: sent.append(name))
+        self.assertEqual(sent, [])
+        b.resumeProducing()
+        return sent
+
+    def test_fifo(self):
+        sent = self.sendAll(("a", PRIORITY_NORMAL, None),
+                            ("b", PRIORITY_NORMAL, None),
+                            ("c", PRIORITY_NORMAL, None))
+        self.assertEqual(sent, ["a", "b", "c"])
+
+    def test_priority(self):
+        sent = self.sendAll(("a", PRIORITY_NORMAL, None),
+                            ("b", PRIORITY_BULK, None),
+                            ("c", PRIORITY_HIGH, None),
+                            ("d", PRIORITY_NORMAL, None))
+        self.assertEqual(sent, ["c", "a", "d", "b"])
+
+    def test_same_key(self):
+        # "b" may not overtake "a", because they share a key
+        sent = self.sendAll(("a", PRIORITY_BULK, 1),
+                            ("b", PRIORITY_HIGH, 1),
+                            ("c", PRIORITY_HIGH, 2))
+        self.assertEqual(sent, ["c", "a", "b"])
+        self.assertEqual(self.banana.rootSlicer.sendQueue.keys, {})
+
+    def test_bad_priority(self):
+        self.assertRaises(ValueError, self.banana.send, "a", 17)
+
+
+class CompactTokens(TestBananaMixin, unittest.TestCase):
+    def makeBanana(self):
+        features = {'banana-decision-version': banana.COMPACT_TOKENS_VERSION}
+        self.banana = storage.StorageBanana(features)
+        self.banana.slicerClass = storage.UnsafeStorageRootSlicer
+        self.banana.unslicerClass = storage.UnsafeStorageRootUnslicer
+        self.banana.transport = TestTransport()
+        self.banana.connectionMade()
+
+    def test_encode(self):
+        expected = join(bOPEN(b'list', 0), NONE, TRUE, FALSE, bCLOSE(0))
+        d = self.encode([None, True, False])
+        d.addCallback(self.wantEqual, expected)
+        return d
+
+    def test_decode(self):
+        self.assertIs(self.shouldDecode(NONE), None)
+        self.assertIs(self.shouldDecode(TRUE), True)
+        self.assertIs(self.shouldDecode(FALSE), False)
+        obj = self.shouldDecode(join(bOPEN(b'list', 0), TRUE, NONE, bCLOSE(0)))
+        self.assertEqual(obj, [True, None])
+
+    def test_loop(self):
+        # the OPEN counter must stay in step for the reference to resolve
+        inner = [None]
+        return self.looptest([False, inner, {'a': True}, inner])
+
+    def test_old_peer(self):
+        self.banana.compactTokens = False
+        expected = join(bOPEN(b'list', 0),
+                         bOPEN(b'none', 1), bCLOSE(1),
+                         bOPEN(b'boolean', 2), bINT(1), bCLOSE(2),
+                        bCLOSE(0))
+        d = self.encode([None, True])
+        d.addCallback(self.wantEqual, expected)
+        return d
+
+    def test_reject_from_old_peer(self):
+        self.banana.compactTokens = False
+        f = self.shouldDropConnection(TRUE)
+        self.assertTrue(f.value.args[0].startswith("Invalid Type Byte"))
+
+    def test_constraints(self):
+        IConstraint(None).checkToken(NONE, 0)
+        IConstraint(bool).checkToken(TRUE, 0)
+        IConstraint(bool).checkToken(FALSE, 0)
+        schema.BooleanConstraint(True).checkToken(TRUE, 0)
+        self.assertRaises(Violation,
+                          schema.BooleanConstraint(True).checkToken, FALSE, 0)
+        self.assertRaises(Violation, IConstraint(int).checkToken, NONE, 0)
+        self.assertRaises(BananaError, IConstraint(None).checkToken, TRUE, 0)
+
+
+class Blobs(TestBananaMixin, unittest.TestCase):
+    def makeBanana(self):
+        features = {'banana-decision-version': banana.BLOB_VERSION}
+        self.banana = storage.StorageBanana(features)
+        self.banana.slicerClass = storage.UnsafeStorageRootSlicer
+        self.banana.unslicerClass = storage.UnsafeStorageRootUnslicer
+        self.banana.transport = TestTransport()
+        self.banana.connectionMade()
+
+    def setConstraint(self, constraint):
+        self.banana.receiveStack[-1].constraint = constraint
+
+    def test_encode(self):
+        expected = join(bOPEN(b'blob', 0), bINT(6),
+                         bBYTES(b'abcd'), bBYTES(b'ef'),
+                        bCLOSE(0))
+        d = self.encode(Blob(b'abcdef', chunkSize=4))
+        d.addCallback(self.wantEqual, expected)
+        return d
+
+    def test_huge(self):
+        # bigger than a single BYTES token may be
+        data = bytes(range(256)) * (tokens.SIZE_LIMIT // 256 * 3 + 1)
+        d = self.loop(Blob(data))
+        def _check(res):
+            self.assertEqual(type(res), bytearray)
+            self.assertEqual(res, data)
+        d.addCallback(_check)
+        return d
+
+    def test_memoryview(self):
+        d = self.loop(memoryview(b'abc' * 1000))
+        d.addCallback(self.assertEqual, bytearray(b'abc' * 1000))
+        return d
+
+    def test_file(self):
+        f = BytesIO(b'header' + b'x' * 200000)
+        f.read(6)
+        blob = Blob(f)
+        self.assertEqual(len(blob), 200000)
+        d = self.loop(blob)
+        d.addCallback(self.assertEqual, bytearray(b'x' * 200000))
+        return d
+
+    def test_empty(self):
+        d = self.loop(Blob(b''))
+        d.addCallback(self.assertEqual, bytearray())
+        return d
+
+    def test_spool(self):
+        self.setConstraint(schema.BlobConstraint(spoolThreshold=1000))
+        d = self.loop(Blob(b'y' * 5000, chunkSize=1024))
+        def _check(res):
+            self.assertFalse(isinstance(res, bytearray))
+            self.assertEqual(res.read(), b'y' * 5000)
+            res.close()
+        d.addCallback(_check)
+        return d
+
+    def test_max_size(self):
+        self.setConstraint(schema.BlobConstraint(maxSize=10))
+        self.encode(Blob(b'z' * 11))
+        f = self.shouldFail(self.banana.transport.getvalue())
+        self.assertIn('blob too large: 11>10', str(f.value))
+
+    def test_default_max_size(self):
+        # the announced size is refused before any of the data arrives
+        self.setConstraint(schema.BlobConstraint())
+        f = self.shouldFail(join(bOPEN(b'blob', 0), int2b128(2 ** 30) + INT,
+                                  bCLOSE(0)))
+        self.assertIn('blob too large: %d>%d' % (2 ** 30, 64 * 1024 * 1024),
+                      str(f.value))
+
+    def test_not_negotiated(self):
+        TestBananaMixin.makeBanana(self)
+        d = self.encode(Blob(b'abc'))
+        d.addCallbacks(lambda res: self.fail("should have failed"),
+                       lambda f: f.trap(Violation))
+        f = self.shouldFail(join(bOPEN(b'blob', 0), bINT(3),
+                                  bBYTES(b'abc'), bCLOSE(0)))
+        self.assertIn('did not negotiate (blob)', str(f.value))
+        return d
+
+    def test_overrun(self):
+        f = self.shouldDropConnection(join(bOPEN(b'blob', 0), bINT(3),
+                                            bBYTES(b'ab'), bCLOSE(0)))
+        self.assertIn('ended after 2 of 3 bytes', str(f.value))
+        self.setConstraint(schema.BlobConstraint())
+        self.shouldFail(join(bOPEN(b'blob', 0), bINT(3),
+                              bBYTES(b'abcd'), bCLOSE(0)))
+
+    def test_outbound_constraint(self):
+        c = IConstraint(Blob)
+        c.checkObject(Blob(b'abc'), False)
+        self.assertRaises(Violation, c.checkObject, b'abc', False)
+        self.assertRaises(Violation, schema.BlobConstraint(2).checkObject,
+                          memoryview(b'abc'), False)
+
+
 class InboundByteStream(TestBananaMixin, unittest.TestCase):
     def check(self, obj, stream):
         # use a new Banana for each check
@@ -2126,6 +2479,122 @@ class VocabTest2(TestBananaMixin, unittest.TestCase):
         return d
 
 
+class CollectingBanana(storage.StorageBanana):
+    def __init__(self, features={}):
+        storage.StorageBanana.__init__(self, features)
+        self.received = []
+
+    def receiveChild(self, obj, ready_deferred):
+        if obj not in (ReplaceVocabularyTable, AddToVocabularyTable):
+            self.received.append(obj)
+
+
+class AdaptiveVocab(TestBananaMixin, unittest.TestCase):
+    def makeBanana(self):
+        features = {'banana-decision-version': banana.ADAPTIVE_VOCAB_VERSION}
+        self.banana = storage.StorageBanana(features)
+        self.banana.slicerClass = storage.UnsafeStorageRootSlicer
+        self.banana.unslicerClass = storage.UnsafeStorageRootUnslicer
+        self.banana.transport = TestTransport()
+        self.banana.connectionMade()
+        self.banana.populateVocabTable(vocab.vocab_v191)
+        self.vm = self.banana.vocabManager
+        self.sent = []
+
+    def sendAll(self, *objs):
+        # everything we sent so far must decode on a fresh connection, in
+        # order, with both vocab tables in step
+        for obj in objs:
+            self.banana.send(obj)
+        self.sent.extend(objs)
+        receiver = CollectingBanana()
+        receiver.populateVocabTable(vocab.vocab_v191)
+        receiver.connectionMade()
+        receiver.dataReceived(self.banana.transport.getvalue())
+        self.assertEqual(receiver.received, self.sent)
+        return receiver
+
+    def test_promote(self):
+        self.sendAll('frobnicate', 'frobnicate')
+        self.assertNotIn(b'frobnicate', self.banana.outgoingVocabulary)
+        receiver = self.sendAll('frobnicate')
+        index = self.banana.outgoingVocabulary[b'frobnicate']
+        self.assertEqual(index, len(vocab.vocab_v191))
+        self.assertEqual(receiver.incomingVocabulary[index], b'frobnicate')
+
+        self.clearOutput()
+        d = self.encode('frobnicate')
+        d.addCallback(self.wantEqual, int2b128(index) + SVOCAB)
+        return d
+
+    def test_short_strings(self):
+        self.vm.promoteAfter = 1
+        self.sendAll(b'x', 'y' * 101)
+        self.assertEqual(self.vm.promotions, 0)
+
+    def test_evict(self):
+        self.vm.promoteAfter = 1
+        self.vm.maxEntries = 2
+        self.sendAll(b'aa', b'bb', b'aa', b'aa')
+        index = self.banana.outgoingVocabulary[b'bb']
+        receiver = self.sendAll(b'cc', b'cc')
+        # 'bb' had no hits, so 'cc' took its slot
+        self.assertEqual(self.banana.outgoingVocabulary[b'cc'], index)
+        self.assertEqual(receiver.incomingVocabulary[index], b'cc')
+        self.assertNotIn(b'bb', self.banana.outgoingVocabulary)
+        self.assertEqual(self.vm.evictions, 1)
+
+    def test_reset(self):
+        self.vm.promoteAfter = 1
+        self.vm.maxEntries = 2
+        words = [b'aa', b'bb', b'cc', b'dd', b'ee', b'aa', b'ee']
+        receiver = self.sendAll(*words)
+        # 'dd' was the second eviction, which sent a (set-vocab) with the
+        # base table and one of the two adaptive entries
+        self.assertEqual(self.vm.resets, 1)
+        self.assertEqual(self.vm.evictions, 3)
+        self.assertEqual(len(self.banana.outgoingVocabulary),
+                         len(vocab.vocab_v191) + 2)
+        self.assertEqual(receiver.incomingVocabulary,
+                         dict((v, k) for (k, v) in self.banana.outgoingVocabulary.items()))
+
+    def test_stats(self):
+        self.sendAll(*['frobnicate'] * 5)
+        stats = self.vm.getStats()
+        self.assertEqual(stats['misses'], 3 + 1) # plus the (add-vocab) body
+        self.assertEqual(stats['hits'], 2 + 1)   # plus the (add-vocab) opentype
+        self.assertEqual(stats['promotions'], 1)
+        self.assertEqual(self.vm.hitRate(), 3 / 7)
+
+    def test_old_peer(self):
+        self.assertIdentical(storage.StorageBanana().vocabManager, None)
+
+    def test_incoming_limit(self):
+        self.banana.maxIncomingVocabulary = len(vocab.vocab_v191)
+        self.banana.addIncomingVocabulary(0, b'replaced')
+        self.assertRaises(BananaError,
+                          self.banana.addIncomingVocabulary, 999, b'more')
+
+    def test_replace_limit(self):
+        table = dict((i, b'word%d' % i)
+                     for i in range(self.banana.maxIncomingVocabulary + 1))
+        self.assertRaises(BananaError,
+                          self.banana.replaceIncomingVocabulary, table)
+
+    def test_large_table(self):
+        # a big application table does not eat into the room left for the
+        # peer's adaptive entries
+        table = list(vocab.vocab_v191) + [b'word%d' % i for i in range(3000)]
+        self.banana.populateVocabTable(table)
+        base = len(table)
+        for i in range(self.vm.maxEntries):
+            self.banana.addIncomingVocabulary(base + i, b'adaptive%d' % i)
+        self.assertEqual(len(self.banana.incomingVocabulary),
+                         base + self.vm.maxEntries)
+        self.assertEqual(self.banana.maxIncomingVocabulary,
+                         base + self.banana.maxAddedIncomingVocabulary)
+
+
 class SliceableByItself(slicer.BaseSlicer):
     def __init__(self, value):
         self.value = value
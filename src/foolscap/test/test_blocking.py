@@ -0,0 +1,273 @@
+import os, threading, hashlib, time
+from zope.interface import implementer
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from foolscap.api import Referenceable, RemoteInterface, Tub, blocking, \
+     cpu_bound
+from foolscap.blocking import BlockingCallPool, PoolFullError, \
+     ProcessCallPool
+from foolscap.remoteinterface import RemoteMethodSchema
+from foolscap.test.common import TargetMixin, ShouldFailMixin
+
+
+class RIBlocking(RemoteInterface):
+    slow = RemoteMethodSchema(_response=bool, __blocking__=True)
+    def fast(): return bool
+
+@implementer(RIBlocking)
+class BlockingTarget(Referenceable):
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = []
+    def remote_slow(self):
+        # returns True if we ran in a thread other than the reactor's
+        self.release.wait(10)
+        self.calls.append("slow")
+        return threading.current_thread() is not self.reactorThread
+    def remote_fast(self):
+        self.calls.append("fast")
+        return threading.current_thread() is not self.reactorThread
+
+class DecoratedTarget(Referenceable):
+    @blocking
+    def remote_lookup(self, key):
+        return (key, threading.current_thread().name)
+    def remote_ping(self):
+        return threading.current_thread().name
+
+class CPUTarget(Referenceable):
+    @cpu_bound
+    def remote_digest(data, rounds=1):
+        for i in range(rounds):
+            data = hashlib.sha256(data).digest()
+        return (data, os.getpid())
+
+class DispatchingCPUTarget(CPUTarget):
+    def __init__(self):
+        self.dispatched = []
+    def doRemoteCall(self, methodname, args, kwargs):
+        self.dispatched.append(methodname)
+        return CPUTarget.doRemoteCall(self, methodname, args, kwargs)
+
+def _fail(why):
+    raise ValueError(why)
+
+def _sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+class Pool(ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        self.pool = BlockingCallPool(maxThreads=1, maxQueued=1)
+        self.addCleanup(self.pool.stop)
+
+    def test_run(self):
+        d = self.pool.run(lambda a, b: a + b, 1, b=2)
+        def _check(res):
+            self.assertEqual(res, 3)
+            stats = self.pool.getStats()
+            self.assertEqual(stats["completed"], 1)
+            self.assertEqual(stats["running"], 0)
+            self.assertEqual(stats["queued"], 0)
+            self.assertEqual(stats["utilization"], 0.0)
+        d.addCallback(_check)
+        return d
+
+    def test_failure(self):
+        def _fail():
+            raise ValueError("oops")
+        return self.shouldFail(ValueError, "test_failure", "oops",
+                               self.pool.run, _fail)
+
+    def test_queue_limit(self):
+        release = threading.Event()
+        started = threading.Event()
+        def _hold():
+            started.set()
+            release.wait(10)
+            return "held"
+        d1 = self.pool.run(_hold)
+        started.wait(10)
+        d2 = self.pool.run(lambda: "queued") # waits for the only thread
+        d3 = self.shouldFail(PoolFullError, "test_queue_limit",
+                             "1 blocking calls are already waiting",
+                             self.pool.run, lambda: "rejected")
+        def _check(ign):
+            stats = self.pool.getStats()
+            self.assertEqual(stats["running"], 1)
+            self.assertEqual(stats["queued"], 1)
+            self.assertEqual(stats["rejected"], 1)
+            self.assertEqual(stats["utilization"], 1.0)
+            release.set()
+            return defer.gatherResults([d1, d2])
+        d3.addCallback(_check)
+        d3.addCallback(lambda res: self.assertEqual(res, ["held", "queued"]))
+        return d3
+
+    def test_stop(self):
+        # stopping waits for the running call without blocking the reactor
+        release = threading.Event()
+        started = threading.Event()
+        def _hold():
+            started.set()
+            release.wait(10)
+            return "held"
+        d1 = self.pool.run(_hold)
+        started.wait(10)
+        d2 = self.pool.stop()
+        self.assertFalse(d2.called)
+        release.set()
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(lambda res: self.assertEqual(res, ["held", None]))
+        return d
+
+
+class Processes(ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        self.pool = ProcessCallPool(maxWorkers=1)
+        self.addCleanup(self.pool.stop)
+
+    def test_run(self):
+        d = self.pool.run(CPUTarget.remote_digest, (b"data",), {"rounds": 2})
+        def _check(res):
+            data, pid = res
+            expected = hashlib.sha256(hashlib.sha256(b"data").digest())
+            self.assertEqual(data, expected.digest())
+            self.assertNotEqual(pid, os.getpid())
+            self.assertEqual(self.pool.getStats(),
+                             {"workers": 1, "pending": 0,
+                              "completed": 1, "failed": 0})
+        d.addCallback(_check)
+        return d
+
+    def test_failure(self):
+        d = self.shouldFail(ValueError, "test_failure", "oops",
+                            self.pool.run, _fail, ("oops",), {})
+        d.addCallback(lambda ign:
+                      self.assertEqual(self.pool.getStats()["failed"], 1))
+        return d
+
+    def test_stop(self):
+        d = self.pool.run(CPUTarget.remote_digest, (b"data",), {})
+        d2 = self.pool.stop()
+        self.assertIsInstance(d2, defer.Deferred)
+        d = defer.gatherResults([d, d2])
+        d.addCallback(lambda res: self.assertEqual(res[1], None))
+        d.addCallback(lambda ign:
+                      self.assertEqual(self.pool.getStats()["completed"], 1))
+        return d
+
+    def test_reactor_shutdown(self):
+        # the reactor waits for the workers to finish, but its thread does
+        # not: the shutdown trigger returns a Deferred
+        d = self.pool.run(_sleep, (0.5,), {})
+        started = time.time()
+        d2 = self.pool._reactorShutdown()
+        self.assertLess(time.time() - started, 0.5)
+        self.assertFalse(d2.called)
+        d = defer.gatherResults([d, d2])
+        d.addCallback(lambda res: self.assertEqual(res, [0.5, None]))
+        return d
+
+
+class Calls(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        self.pool = BlockingCallPool(maxThreads=1)
+        self.addCleanup(self.pool.stop)
+        self.targetBroker.blockingPool = self.pool
+        self.processPool = ProcessCallPool(maxWorkers=1)
+        self.addCleanup(self.processPool.stop)
+        self.targetBroker.processPool = self.processPool
+
+    def test_schema(self):
+        rr, target = self.setupTarget(BlockingTarget(), True)
+        target.reactorThread = threading.current_thread()
+        # the slow call holds its thread, but the reactor keeps going, so
+        # the fast call that was made after it finishes first
+        d1 = rr.callRemote("slow")
+        d2 = rr.callRemote("fast")
+        def _fast_done(res):
+            self.assertEqual(res, False) # in the reactor thread
+            self.assertEqual(target.calls, ["fast"])
+            target.release.set()
+            return d1
+        d2.addCallback(_fast_done)
+        def _slow_done(res):
+            self.assertEqual(res, True)
+            self.assertEqual(target.calls, ["fast", "slow"])
+            self.assertEqual(self.pool.getStats()["completed"], 1)
+        d2.addCallback(_slow_done)
+        return d2
+
+    def test_decorator(self):
+        rr, target = self.setupTarget(DecoratedTarget())
+        d = rr.callRemote("lookup", "key")
+        def _check(res):
+            key, thread = res
+            self.assertEqual(key, "key")
+            self.assertIn("foolscap-blocking", thread)
+            return rr.callRemote("ping")
+        d.addCallback(_check)
+        d.addCallback(lambda thread: self.assertEqual(
+            thread, threading.current_thread().name))
+        return d
+
+    def test_cpu_bound(self):
+        rr, target = self.setupTarget(CPUTarget())
+        d = rr.callRemote("digest", b"data")
+        def _check(res):
+            data, pid = res
+            self.assertEqual(data, hashlib.sha256(b"data").digest())
+            self.assertNotEqual(pid, os.getpid())
+        d.addCallback(_check)
+        return d
+
+    def test_cpu_bound_override(self):
+        # a class that replaces doRemoteCall() gets the call, in place
+        rr, target = self.setupTarget(DispatchingCPUTarget())
+        d = rr.callRemote("digest", b"data")
+        def _check(res):
+            self.assertEqual(target.dispatched, ["digest"])
+            self.assertEqual(res[1], os.getpid())
+        d.addCallback(_check)
+        return d
+
+    def test_no_pool(self):
+        # without a Tub, there is no pool, and the method runs in place
+        self.targetBroker.blockingPool = None
+        self.targetBroker.processPool = None
+        rr, target = self.setupTarget(DecoratedTarget())
+        d = rr.callRemote("lookup", "key")
+        d.addCallback(lambda res: self.assertEqual(
+            res, ("key", threading.current_thread().name)))
+        rr2, target2 = self.setupTarget(CPUTarget())
+        d.addCallback(lambda ign: rr2.callRemote("digest", b"data"))
+        d.addCallback(lambda res: self.assertEqual(res[1], os.getpid()))
+        return d
+
+
+class Decorators(unittest.TestCase):
+    def test_cpu_bound_self(self):
+        # the method runs as a staticmethod in another process
+        def remote_digest(self, data):
+            return data
+        e = self.assertRaises(TypeError, cpu_bound, remote_digest)
+        self.assertIn("gets no 'self'", str(e))
+        self.assertRaises(TypeError, cpu_bound, DecoratedTarget().remote_ping)
+
+
+class Options(unittest.TestCase):
+    def test_options(self):
+        t = Tub()
+        t.setOption("blocking-threads", 3)
+        t.setOption("blocking-queue-limit", 50)
+        self.assertEqual(t.blockingPool.maxThreads, 3)
+        self.assertEqual(t.blockingPool.maxQueued, 50)
+        t.setOption("blocking-queue-limit", None)
+        self.assertEqual(t.blockingPool.maxQueued, None)
+        t.setOption("cpu-workers", 2)
+        self.assertEqual(t.processPool.maxWorkers, 2)
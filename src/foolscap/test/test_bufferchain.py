@@ -1,11 +1,13 @@
 
 from twisted.trial import unittest
-from foolscap.banana import BufferChain
+from foolscap.banana import BufferChain, ReceiveBuffer
 
 
 class T(unittest.TestCase):
+    bufferClass = BufferChain
+
     def test_al(self):
-        c = BufferChain()
+        c = self.bufferClass()
         c.append(b'ab')
         self.assertEqual(len(c), 2)
         c.append(b'')
@@ -14,13 +16,13 @@ class T(unittest.TestCase):
         self.assertEqual(len(c), 3)
 
     def test_bytes(self):
-        c = BufferChain()
+        c = self.bufferClass()
         c.append(b'ab')
         c.append(b'c')
         self.assertEqual(bytes(c), b'abc')
 
     def test_popleft(self):
-        c = BufferChain()
+        c = self.bufferClass()
         c.append(b'ab')
         s = c.popleft(1)
         self.assertEqual(s, b'a')
@@ -72,7 +74,7 @@ class T(unittest.TestCase):
         self.assertEqual(bytes(c), b'')
 
     def test_appendleft(self):
-        c1 = BufferChain()
+        c1 = self.bufferClass()
         c1.append(b'abcd')
         c1.appendleft(b'ef')
         self.assertEqual(bytes(c1),b'efabcd')
@@ -83,7 +85,7 @@ class T(unittest.TestCase):
         s = c1.popleft(3)
         self.assertEqual(s, b'bcd')
 
-        c1 = BufferChain()
+        c1 = self.bufferClass()
         c1.append(b'abcd')
         c1.popleft(1)
         c1.appendleft(b'ef')
@@ -96,7 +98,48 @@ class T(unittest.TestCase):
         self.assertEqual(s, b'cd')
 
     def test_clear(self):
-        c1 = BufferChain()
+        c1 = self.bufferClass()
         c1.append(b'abcd')
         c1.clear()
         self.assertEqual(bytes(c1), b'')
+
+
+class R(T):
+    bufferClass = ReceiveBuffer
+
+    def test_scan(self):
+        c = ReceiveBuffer()
+        c.append(b'\x01\x02')
+        self.assertEqual(c.scanHeader(65), None)
+        c.append(b'\x81rest')
+        self.assertEqual(c.scanHeader(65), 2)
+        self.assertEqual(c.scanHeader(2), None)
+        self.assertEqual(c.peek(3), b'\x01\x02\x81')
+        self.assertEqual(len(c), 7)
+
+    def test_skip_rewind(self):
+        c = ReceiveBuffer()
+        c.append(b'\x05\x91hello')
+        c.skip(2)
+        self.assertEqual(bytes(c), b'hello')
+        c.rewind(2)
+        self.assertEqual(bytes(c), b'\x05\x91hello')
+        c.skip(2)
+        self.assertEqual(c.popleftText(5), u'hello')
+        self.assertFalse(c)
+
+    def test_compact(self):
+        c = ReceiveBuffer()
+        c.compactThreshold = 4
+        c.append(b'abcdef')
+        self.assertEqual(c.popleft(3), b'abc')
+        c.append(b'gh')
+        # not enough has been consumed to be worth moving the rest
+        self.assertEqual(c.offset, 3)
+        self.assertEqual(c.popleft(2), b'de')
+        c.append(b'ij')
+        self.assertEqual(c.offset, 0)
+        self.assertEqual(bytes(c), b'fghij')
+        c.skip(5)
+        c.append(b'k')
+        self.assertEqual(c.data, bytearray(b'k'))
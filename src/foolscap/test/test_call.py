@@ -9,6 +9,7 @@ if False:
 
 from twisted.python import log
 from twisted.trial import unittest
+from twisted.internet import defer, protocol
 from twisted.internet.main import CONNECTION_LOST, CONNECTION_DONE
 from twisted.python.failure import Failure
 from twisted.application import service
@@ -21,10 +22,34 @@ from foolscap.test.common import RIMyTarget, Target, TargetWithoutInterfaces, \
 from foolscap.api import RemoteException, DeadReferenceError
 from foolscap.call import CopiedFailure
 from foolscap.logging import log as flog
+from foolscap import broker
+from foolscap.broker import Broker, LoopbackTransport
+from foolscap.referenceable import TubRef
+from foolscap.tokens import PRIORITY_HIGH, PRIORITY_NORMAL
+from foolscap.api import Blob, broadcastRemote, PreSerialized, callRemoteBatch
+from foolscap.banana import BLOB_VERSION
+from foolscap.call import CallSlicer, CallBatchSlicer, AnswerSlicer, \
+     ErrorSlicer, AnswerBatchSlicer, PipelineSlicer, InboundDelivery, \
+     CallBatchUnslicer
+from foolscap.remoteinterface import RemoteMethodSchema
+from foolscap.promise import send, when
+from foolscap.api import RemoteInterface, Referenceable
+from foolscap.schema import ByteStringConstraint, ListOf
+from zope.interface import implementer, alsoProvides
 
 class Unsendable:
     pass
 
+class RIChecked(RemoteInterface):
+    def put(name=ByteStringConstraint(regexp=b"^[a-z]+$"),
+            items=ListOf(bytes, minLength=1), extra=ListOf(bytes)):
+        return int
+
+@implementer(RIChecked)
+class CheckedTarget(Referenceable):
+    def remote_put(self, name, items, extra=[]):
+        return len(items) + len(extra)
+
 
 class TestCall(TargetMixin, ShouldFailMixin, unittest.TestCase):
     def setUp(self):
@@ -82,6 +107,142 @@ class TestCall(TargetMixin, ShouldFailMixin, unittest.TestCase):
         return d
     testCall1b.timeout = 2
 
+    def test_sent_deferred(self):
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        events = []
+        sent = defer.Deferred()
+        sent.addCallback(lambda res: events.append("sent"))
+        d = rr.callRemote("add", 1, 2, _sentDeferred=sent)
+        d.addCallback(events.append)
+        d.addCallback(lambda res: self.assertEqual(events, ["sent", 3]))
+        return d
+
+    def test_priority(self):
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        d = rr.callRemote("add", 1, 2, _priority=PRIORITY_HIGH)
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        return d
+
+    def test_blob(self):
+        self.setupBrokers({"banana-decision-version": BLOB_VERSION})
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        data = b'\x01\x02' * 1024 * 1024
+        d = rr.callRemote("free", Blob(data), name="data")
+        def _check(res):
+            ((blob,), kwargs) = target.calls[0]
+            self.assertEqual(kwargs, {"name": "data"})
+            self.assertEqual(blob, data)
+        d.addCallback(_check)
+        return d
+
+    def test_broadcast(self):
+        targets = [TargetWithoutInterfaces() for i in range(3)]
+        rrefs = [self.setupTarget(t)[0] for t in targets]
+        shared = [1, 2]
+        state = {"members": shared, "leader": shared, "epoch": None}
+        dl = broadcastRemote(rrefs, "free", "snap", state, flag=True)
+        self.assertEqual(len(dl), 3)
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.assertEqual(res, ["bird"] * 3)
+            for t in targets:
+                ((name, got), kwargs) = t.calls[0]
+                self.assertEqual(name, "snap")
+                self.assertEqual(kwargs, {"flag": True})
+                self.assertEqual(got, state)
+                # the (reference) was moved along with the rest of the call
+                self.assertIdentical(got["members"], got["leader"])
+            # and the next call on the connection is numbered correctly
+            return rrefs[0].callRemote("add", 1, 2)
+        d.addCallback(_check)
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        return d
+
+    def test_broadcast_schema(self):
+        rr1, target1 = self.setupTarget(Target(), True)
+        rr2, target2 = self.setupTarget(TargetWithoutInterfaces())
+        dl = broadcastRemote([rr1, rr2], "add1", a=1, b="two")
+        d1 = self.shouldFail(Violation, "test_broadcast_schema", None,
+                             lambda: dl[0])
+        # the peer without a schema gets the bad arguments
+        d2 = self.shouldFail(TypeError, "test_broadcast_schema",
+                             "unsupported operand", lambda: dl[1])
+        return defer.gatherResults([d1, d2])
+
+    def test_broadcast_unsendable(self):
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        dl = broadcastRemote([rr, rr], "free", Target())
+        d = defer.gatherResults([
+            self.shouldFail(Violation, "test_broadcast_unsendable",
+                            "can only be serialized by a broker",
+                            lambda d=d: d)
+            for d in dl])
+        d.addCallback(lambda res: self.assertEqual(target.calls, []))
+        return d
+
+    def test_preserialized(self):
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        manifest = {"files": ["a", "b"] * 50, "sizes": list(range(100))}
+        ps = PreSerialized(manifest)
+        d = rr.callRemote("free", ps, name=ps)
+        d.addCallback(lambda res: rr.callRemote("free", ps))
+        def _check(res):
+            self.assertEqual(target.calls, [((manifest,), {"name": manifest}),
+                                            ((manifest,), {})])
+            stats = ps.getStats()
+            self.assertEqual(stats["misses"], 1)
+            self.assertEqual(stats["hits"], 2)
+            self.assertEqual(stats["recordings"], 1)
+        d.addCallback(_check)
+        return d
+
+    def test_preserialized_schema(self):
+        rr, target = self.setupTarget(Target(), True)
+        one = PreSerialized(1)
+        d = rr.callRemote("add1", a=one, b=2)
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        d.addCallback(lambda res:
+                      self.shouldFail(Violation, "test_preserialized_schema",
+                                      "a=",
+                                      rr.callRemote, "add1",
+                                      a=PreSerialized("one"), b=2))
+        d.addCallback(lambda res: self.assertEqual(target.calls, [(1, 2)]))
+        return d
+
+    def test_preserialized_answer(self):
+        rr, target = self.setupTarget(HelperTarget())
+        target.obj = PreSerialized([1, (2, None)])
+        d = rr.callRemote("get")
+        d.addCallback(lambda res: self.assertEqual(res, [1, (2, None)]))
+        return d
+
+    def test_preserialized_broadcast(self):
+        targets = [TargetWithoutInterfaces() for i in range(2)]
+        rrefs = [self.setupTarget(t)[0] for t in targets]
+        table = PreSerialized({"k%d" % i: [i] for i in range(10)})
+        d = defer.gatherResults(broadcastRemote(rrefs, "free", [table, table]))
+        def _check(res):
+            for t in targets:
+                self.assertEqual(t.calls, [(([table.obj, table.obj],), {})])
+            # both copies are spliced into the one recording of the arguments
+            self.assertEqual(table.misses, 1)
+            self.assertEqual(table.hits, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_registers_producer(self):
+        b = Broker(TubRef("producer"))
+        b.transport = t = LoopbackTransport()
+        far = LoopbackTransport()
+        far.protocol = protocol.Protocol()
+        t.setPeer(far)
+        b.connectionMade()
+        self.assertTrue(b.useBackpressure)
+        # the transport took the connect-time PING without pushing back,
+        # so we are not holding on to it
+        self.assertIdentical(t.producer, None)
+        return flushEventualQueue()
+
     def testFail1(self):
         # this is done without interfaces
         rr, target = self.setupTarget(TargetWithoutInterfaces())
@@ -333,6 +494,29 @@ class TestCall(TargetMixin, ShouldFailMixin, unittest.TestCase):
         self.assertIn(" methodname=add", f.value)
         self.assertIn("<arguments arg[b]>", f.value)
 
+    def testReceivedArgs(self):
+        # arguments that were checked token by token as they arrived are
+        # not checked all over again, but what the tokens cannot say
+        # (regexps, minimum lengths) is still enforced
+        rr, target = self.setupTarget(CheckedTarget(), True)
+        def _checkAllArgs(*args):
+            self.fail("checkAllArgs should not have been used")
+        self.patch(RIChecked["put"], "checkAllArgs", _checkAllArgs)
+        d = rr.callRemote("put", b"name", [b"a"], extra=[b"b", b"c"],
+                          _useSchema=False)
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        d.addCallback(lambda ign:
+                      self.shouldFail(Violation, "testReceivedArgs",
+                                      "regexp failed to match",
+                                      rr.callRemote, "put", b"NAME", [b"a"],
+                                      _useSchema=False))
+        d.addCallback(lambda ign:
+                      self.shouldFail(Violation, "testReceivedArgs",
+                                      "list too short",
+                                      rr.callRemote, "put", b"name", [],
+                                      _useSchema=False))
+        return d
+
     def testFailWrongReturnRemote(self):
         rr, target = self.setupTarget(BrokenTarget(), True)
         d = rr.callRemote("add", 3, 4) # violates return constraint
@@ -518,6 +702,599 @@ class TestCall(TargetMixin, ShouldFailMixin, unittest.TestCase):
         return d
 
 
+class CallBatch(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers({"banana-decision-version": 194})
+        self.sent = {self.callingBroker: [], self.targetBroker: []}
+        for b in self.sent:
+            b.send = self._recordSend(b, b.send)
+
+    def _recordSend(self, b, send):
+        # the adaptive vocab messages of v193 are sent too, ignore them
+        def _send(obj, *args):
+            if isinstance(obj, (CallSlicer, CallBatchSlicer, AnswerSlicer,
+                                ErrorSlicer, AnswerBatchSlicer)):
+                self.sent[b].append(obj)
+            return send(obj, *args)
+        return _send
+
+    def test_explicit(self):
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        rr2, target2 = self.setupTarget(HelperTarget())
+        dl = callRemoteBatch([(rr, "add", (1, 2), {}),
+                              (rr2, "set", (), {"obj": 12}),
+                              (rr, "fail", (), {}),
+                              (rr, "add", (), {"a": 3, "b": 4})])
+        d = defer.DeferredList(dl, consumeErrors=True)
+        def _check(res):
+            self.assertEqual(res[0], (True, 3))
+            self.assertEqual(res[1], (True, True))
+            self.assertFalse(res[2][0])
+            self.assertIn("you asked me to fail", str(res[2][1]))
+            self.assertEqual(res[3], (True, 7))
+            self.assertEqual(target.calls, [(1, 2), (3, 4)])
+            self.assertEqual(target2.obj, 12)
+            [batch] = self.sent[self.callingBroker]
+            self.assertIsInstance(batch, CallBatchSlicer)
+            [answers] = self.sent[self.targetBroker]
+            self.assertIsInstance(answers, AnswerBatchSlicer)
+            self.assertEqual(len(answers.answers), 4)
+        d.addCallback(_check)
+        return d
+
+    def test_auto(self):
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        self.callingBroker.batchCalls = True
+        dl = [rr.callRemote("add", i, 1) for i in range(20)]
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.assertEqual(res, [i + 1 for i in range(20)])
+            self.assertEqual(target.calls, [(i, 1) for i in range(20)])
+            self.assertEqual(len(self.sent[self.callingBroker]), 1)
+            self.assertEqual(len(self.sent[self.targetBroker]), 1)
+            # a call made in a later turn goes in a new batch
+            return rr.callRemote("add", 5, 5)
+        d.addCallback(_check)
+        d.addCallback(lambda res: self.assertEqual(res, 10))
+        return d
+
+    def test_remote_violation(self):
+        # the bogus call is rejected by its CallUnslicer, before it is
+        # delivered. It gets its own error, the rest of the batch carries on
+        rr, target = self.setupTarget(Target(), False)
+        dl = callRemoteBatch([(rr, "add", (1, 2), {}),
+                              (rr, "bogus", (), {}),
+                              (rr, "add", (3, 4), {})])
+        d = defer.DeferredList(dl, consumeErrors=True)
+        def _check(res):
+            self.assertEqual(res[0], (True, 3))
+            self.assertTrue(res[1][1].check(Violation))
+            self.assertIn("method 'bogus' not defined", str(res[1][1]))
+            self.assertEqual(res[2], (True, 7))
+            self.assertEqual(target.calls, [(1, 2), (3, 4)])
+        d.addCallback(_check)
+        return d
+
+    def test_unsendable(self):
+        rr, target = self.setupTarget(HelperTarget())
+        rr2, target2 = self.setupTarget(HelperTarget())
+        dl = callRemoteBatch([(rr, "set", (Unsendable(),), {}),
+                              (rr2, "set", (1,), {})])
+        d1 = self.shouldFail(Violation, "test_unsendable", "cannot serialize",
+                             lambda: dl[0])
+        d = defer.gatherResults([d1, dl[1]])
+        d.addCallback(lambda res: self.assertEqual(res[1], True))
+        d.addCallback(lambda res: self.assertEqual(target2.obj, 1))
+        return d
+
+    def test_old_peer(self):
+        # without v194, the same calls go out one at a time
+        self.callingBroker.canBatchCalls = False
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        dl = callRemoteBatch([(rr, "add", (1, 2), {}),
+                              (rr, "add", (3, 4), {})])
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.assertEqual(res, [3, 7])
+            self.assertEqual(len(self.sent[self.callingBroker]), 2)
+        d.addCallback(_check)
+        return d
+
+    def test_split(self):
+        self.patch(broker.call, "MAX_BATCH_CALLS", 3)
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        dl = callRemoteBatch([(rr, "add", (i, 1), {}) for i in range(7)])
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.assertEqual(res, [i + 1 for i in range(7)])
+            sent = self.sent[self.callingBroker]
+            self.assertEqual([type(s) for s in sent],
+                             [CallBatchSlicer, CallBatchSlicer, CallSlicer])
+            self.assertEqual([len(s.calls) for s in sent[:2]], [3, 3])
+        d.addCallback(_check)
+        return d
+
+    def test_too_large(self):
+        # the far end rejects the whole batch: the calls it already read
+        # get errors, the rest are dropped
+        self.patch(CallBatchUnslicer, "maxCalls", 2)
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        dl = callRemoteBatch([(rr, "add", (i, 1), {}) for i in range(3)])
+        dl[2].addErrback(lambda f: None) # it fails when we disconnect
+        d = defer.DeferredList(dl[:2], consumeErrors=True)
+        def _check(res):
+            for success, f in res:
+                self.assertFalse(success)
+                self.assertTrue(f.check(Violation))
+                self.assertIn("too many calls in call-batch", str(f))
+            self.assertFalse(dl[2].called)
+            self.assertEqual(target.calls, [])
+        d.addCallback(_check)
+        return d
+
+
+class Pipelining(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers({"banana-decision-version": 195})
+        self.pipelined = []
+        brokerSend = self.callingBroker.send
+        def _send(obj, *args):
+            if isinstance(obj, PipelineSlicer):
+                self.pipelined.append(obj)
+            return brokerSend(obj, *args)
+        self.callingBroker.send = _send
+
+    def _checkReleased(self, res):
+        d = flushEventualQueue()
+        d.addCallback(lambda ign:
+                      self.assertEqual(self.targetBroker.retainedAnswers, {}))
+        return d
+
+    def test_pipeline(self):
+        rr, target = self.setupTarget(HelperTarget("outer"))
+        inner = target.obj = HelperTarget("inner")
+        d = when(send(send(rr).get()).echo(12))
+        def _check(res):
+            self.assertEqual(res, 12)
+            self.assertEqual(inner.obj, 12)
+            # the second call was sent before the first one was answered
+            first, second = self.pipelined
+            self.assertEqual((first.answerOf, first.methodname), (0, "get"))
+            self.assertEqual((second.answerOf, second.methodname),
+                             (first.reqID, "echo"))
+        d.addCallback(_check)
+        d.addCallback(self._checkReleased)
+        return d
+
+    def test_chain(self):
+        rr, target = self.setupTarget(HelperTarget("outer"))
+        middle = target.obj = HelperTarget("middle")
+        inner = middle.obj = HelperTarget("inner")
+        d = when(send(send(send(rr).get()).get()).echo("hi"))
+        def _check(res):
+            self.assertEqual(res, "hi")
+            self.assertEqual(inner.obj, "hi")
+            self.assertEqual([p.answerOf for p in self.pipelined],
+                             [0, self.pipelined[0].reqID,
+                              self.pipelined[1].reqID])
+        d.addCallback(_check)
+        d.addCallback(self._checkReleased)
+        return d
+
+    def test_slow_target(self):
+        # a call pipelined on a method that has not finished yet waits for
+        # it, without holding up anything else
+        rr, target = self.setupTarget(HelperTarget("outer"))
+        inner = HelperTarget("inner")
+        p = send(send(rr).hang()).echo(3)
+        d = self.poll(lambda: target.d is not None)
+        d.addCallback(lambda ign: rr.callRemote("echo", 4))
+        def _check(res):
+            self.assertEqual(res, 4)
+            self.assertFalse(hasattr(inner, "obj"))
+            target.d.callback(inner)
+            return when(p)
+        d.addCallback(_check)
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        d.addCallback(self._checkReleased)
+        return d
+
+    def test_failure(self):
+        # calls pipelined on a call that fails get the same failure
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        p = send(send(rr).fail()).add(1, 2)
+        d = self.shouldFail(ValueError, "test_failure", "you asked me to fail",
+                            when, p)
+        d.addCallback(self._checkReleased)
+        return d
+
+    def test_not_callable(self):
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        p = send(send(rr).add(1, 2)).add(3, 4)
+        d = self.shouldFail(Violation, "test_not_callable",
+                            "is not remotely callable", when, p)
+        d.addCallback(self._checkReleased)
+        return d
+
+    def test_schema(self):
+        # the schema of the target is applied once it is known
+        rr, target = self.setupTarget(HelperTarget("outer"))
+        target.obj = HelperTarget("inner")
+        p = send(send(rr).get()).bogus()
+        d = self.shouldFail(Violation, "test_schema",
+                            "method 'bogus' not defined", when, p)
+        d.addCallback(self._checkReleased)
+        return d
+
+    def test_argument_limit(self):
+        # arguments that arrive before their target is known are limited in
+        # size, and the limit is lifted once they are complete
+        self.targetBroker.maxPipelinedArgumentBytes = 100
+        rr, target = self.setupTarget(HelperTarget("outer"))
+        target.obj = HelperTarget("inner")
+        p = send(send(rr).get()).echo(b"x" * 1000)
+        d = self.shouldFail(Violation, "test_argument_limit",
+                            "more unconstrained data than we accept", when, p)
+        d.addCallback(lambda ign: when(send(send(rr).get()).echo(b"x" * 50)))
+        d.addCallback(self.assertEqual, b"x" * 50)
+        d.addCallback(lambda ign: rr.callRemote("echo", b"x" * 1000))
+        d.addCallback(self.assertEqual, b"x" * 1000)
+        d.addCallback(self._checkReleased)
+        return d
+
+    def test_retained_limit(self):
+        self.targetBroker.maxRetainedAnswers = 1
+        rr, target = self.setupTarget(HelperTarget("outer"))
+        target.obj = HelperTarget("inner")
+        p = send(send(rr).get()).echo(12)
+        d = self.shouldFail(Violation, "test_retained_limit",
+                            "too many retained answers", when, p)
+        d.addCallback(self._checkReleased)
+        return d
+
+    def test_old_peer(self):
+        # without v195, each call waits for the answer it is made on
+        self.callingBroker.canPipeline = False
+        rr, target = self.setupTarget(HelperTarget("outer"))
+        inner = target.obj = HelperTarget("inner")
+        d = when(send(send(rr).get()).echo(12))
+        def _check(res):
+            self.assertEqual(res, 12)
+            self.assertEqual(inner.obj, 12)
+            self.assertEqual(self.pipelined, [])
+        d.addCallback(_check)
+        return d
+
+
+class Cancellation(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers({"banana-decision-version": 196})
+
+    def _checkRetired(self, res):
+        # both ends have forgotten about the call
+        d = flushEventualQueue()
+        def _check(ign):
+            self.assertEqual(self.callingBroker.waitingForAnswers, {})
+            self.assertEqual(self.targetBroker.activeLocalCalls, {})
+        d.addCallback(_check)
+        return d
+
+    def test_cancel_running(self):
+        rr, target = self.setupTarget(HelperTarget())
+        d1 = rr.callRemote("hang")
+        d = self.poll(lambda: target.d is not None)
+        def _cancel(ign):
+            d1.cancel()
+            return self.shouldFail(defer.CancelledError, "test_cancel_running",
+                                   None, lambda: d1)
+        d.addCallback(_cancel)
+        d.addCallback(self._checkRetired)
+        # the Deferred returned by remote_hang was cancelled too
+        d.addCallback(lambda ign: self.assertTrue(target.d.called))
+        return d
+
+    def test_cancel_queued(self):
+        # the (cancel) arrives before the call is delivered, so the method
+        # is never invoked
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        d1 = rr.callRemote("add", 1, 2)
+        d1.cancel()
+        d = self.shouldFail(defer.CancelledError, "test_cancel_queued", None,
+                            lambda: d1)
+        d.addCallback(self._checkRetired)
+        d.addCallback(lambda ign: self.assertEqual(target.calls, []))
+        return d
+
+    def test_cancel_batched(self):
+        # a call that is still waiting for its batch is never sent
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        self.callingBroker.batchCalls = True
+        d1 = rr.callRemote("add", 1, 2)
+        d2 = rr.callRemote("add", 3, 4)
+        d1.cancel()
+        d = self.shouldFail(defer.CancelledError, "test_cancel_batched", None,
+                            lambda: d1)
+        d.addCallback(lambda ign: d2)
+        d.addCallback(lambda res: self.assertEqual(res, 7))
+        d.addCallback(self._checkRetired)
+        d.addCallback(lambda ign: self.assertEqual(target.calls, [(3, 4)]))
+        return d
+
+    def test_timeout(self):
+        rr, target = self.setupTarget(HelperTarget())
+        d = self.shouldFail(defer.TimeoutError, "test_timeout", "timed out",
+                            rr.callRemote, "hang", _timeout=0.1)
+        d.addCallback(self._checkRetired)
+        d.addCallback(lambda ign: self.assertTrue(target.d.called))
+        return d
+
+    def test_default_timeout(self):
+        rr, target = self.setupTarget(HelperTarget())
+        self.callingBroker.callTimeout = 0.1
+        d = self.shouldFail(defer.TimeoutError, "test_default_timeout",
+                            "timed out", rr.callRemote, "hang")
+        d.addCallback(self._checkRetired)
+        return d
+
+    def test_answered_in_time(self):
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        d = rr.callRemote("add", 1, 2, _timeout=10)
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        # and the timer is gone, or the reactor would be left dirty
+        return d
+
+    def test_old_peer(self):
+        # without v196, the far end runs the method anyway, and its answer
+        # is thrown away when it arrives
+        self.callingBroker.canCancel = False
+        rr, target = self.setupTarget(HelperTarget())
+        d1 = rr.callRemote("hang")
+        d = self.poll(lambda: target.d is not None)
+        def _cancel(ign):
+            d1.cancel()
+            self.assertFalse(target.d.called)
+            self.assertEqual(len(self.callingBroker.waitingForAnswers), 1)
+            target.d.callback("late")
+            return self.shouldFail(defer.CancelledError, "test_old_peer",
+                                   None, lambda: d1)
+        d.addCallback(_cancel)
+        d.addCallback(self._checkRetired)
+        return d
+
+
+class _Arguments:
+    def __init__(self, *args):
+        self.args = args
+        self.kwargs = {}
+
+class Delivery(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def deliver(self, target, ready_deferred, a, b, methodSchema=None):
+        # what a CallUnslicer does with a call-only message, once the
+        # arguments have arrived (but possibly before they are ready)
+        delivery = InboundDelivery(self.targetBroker, 0, target, None, "add",
+                                   methodSchema, _Arguments(a, b))
+        self.targetBroker.scheduleCall(delivery, ready_deferred)
+
+    def test_burst(self):
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        dl = [rr.callRemote("add", i, 0) for i in range(500)]
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.assertEqual(res, list(range(500)))
+            self.assertEqual(target.calls, [(i, 0) for i in range(500)])
+            self.assertEqual(len(self.targetBroker.inboundDeliveryQueue), 0)
+        d.addCallback(_check)
+        return d
+
+    def test_ordered(self):
+        # a call whose arguments are not ready yet holds up the later ones
+        target = TargetWithoutInterfaces()
+        ready = defer.Deferred()
+        self.deliver(target, ready, 1, 2)
+        self.deliver(target, None, 3, 4)
+        d = flushEventualQueue()
+        def _check1(res):
+            self.assertEqual(target.calls, [])
+            ready.callback(None)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        d.addCallback(lambda res:
+                      self.assertEqual(target.calls, [(1, 2), (3, 4)]))
+        return d
+
+    def test_unordered(self):
+        target = TargetWithoutInterfaces()
+        ms = RemoteMethodSchema(a=int, b=int, __unordered__=True)
+        ready = defer.Deferred()
+        self.deliver(target, ready, 1, 2, ms)
+        self.deliver(target, None, 3, 4, ms)
+        d = flushEventualQueue()
+        def _check1(res):
+            self.assertEqual(target.calls, [(3, 4)])
+            ready.callback(None)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        d.addCallback(lambda res:
+                      self.assertEqual(target.calls, [(3, 4), (1, 2)]))
+        return d
+
+
+class OverridingTarget(Target):
+    def doRemoteCall(self, methodname, args, kwargs):
+        self.calls.append(methodname)
+        return Target.doRemoteCall(self, methodname, args, kwargs)
+
+class Dispatch(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def test_shared(self):
+        # every instance of a class uses the same DispatchTable
+        rr1, target1 = self.setupTarget(Target())
+        rr2, target2 = self.setupTarget(Target())
+        table = target1.getDispatchTable()
+        self.assertIs(target2.getDispatchTable(), table)
+        self.assertIs(table.interface, RIMyTarget)
+        d = rr1.callRemote("add", 1, 2)
+        d.addCallback(lambda res: rr2.callRemote("add", a=3, b=4))
+        def _check(res):
+            self.assertEqual(res, 7)
+            self.assertEqual(target1.calls, [(1, 2)])
+            self.assertEqual(target2.calls, [(3, 4)])
+            self.assertIn("add", table.methods)
+            self.assertIs(table.methods["add"][0], RIMyTarget["add"])
+        d.addCallback(_check)
+        d.addCallback(lambda res:
+                      self.shouldFail(Violation, "test_shared",
+                                      "method 'bogus' not defined in",
+                                      rr1.callRemote, "bogus",
+                                      _useSchema=False))
+        return d
+
+    def test_unknown_method(self):
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        table = target.getDispatchTable()
+        self.assertIs(table.interface, None)
+        d = self.shouldFail(AttributeError, "test_unknown_method",
+                            "remote_bogus", rr.callRemote, "bogus")
+        # names that do not exist are not remembered
+        d.addCallback(lambda res: self.assertNotIn("bogus", table.methods))
+        return d
+
+    def test_instance_interfaces(self):
+        # an instance which provides interfaces of its own is looked up
+        # every time
+        target = TargetWithoutInterfaces()
+        alsoProvides(target, RIMyTarget)
+        self.assertIs(target.getDispatchTable(), None)
+        self.assertIsNot(TargetWithoutInterfaces().getDispatchTable(), None)
+        rr, target = self.setupTarget(target)
+        d = self.shouldFail(Violation, "test_instance_interfaces",
+                            "STRING token rejected by IntegerConstraint",
+                            rr.callRemote, "add", 1, "two",
+                            _useSchema=False)
+        d.addCallback(lambda res: rr.callRemote("add", 1, 2))
+        d.addCallback(lambda res: self.assertEqual(target.calls, [(1, 2)]))
+        return d
+
+    def test_override(self):
+        # a class which replaces doRemoteCall() still has it called
+        rr, target = self.setupTarget(OverridingTarget())
+        self.assertIs(target.getDispatchTable(), None)
+        d = rr.callRemote("add", 1, 2)
+        d.addCallback(lambda res:
+                      self.assertEqual(target.calls, ["add", (1, 2)]))
+        return d
+
+
+class Decrefs(TargetMixin, unittest.TestCase):
+    def release(self, count, version):
+        # hand out 'count' references, then drop them all at once
+        self.setupBrokers({"banana-decision-version": version})
+        rrs = [self.setupTarget(Target())[0] for i in range(count)]
+        clids = [rr.tracker.clid for rr in rrs]
+        del rrs
+        gc.collect()
+        def _released():
+            for clid in clids:
+                if (clid in self.callingBroker.yourReferenceByCLID or
+                    clid in self.targetBroker.myReferenceByCLID):
+                    return False
+            return True
+        d = self.poll(_released)
+        d.addCallback(lambda res: self.callingBroker.getDecrefStats())
+        return d
+
+    def test_batched(self):
+        d = self.release(50, 197)
+        d.addCallback(self.assertEqual, {'queued': 0, 'in-flight': 0,
+                                         'messages': 1, 'references': 50})
+        return d
+
+    def test_threshold(self):
+        self.patch(broker, "MAX_DECREF_BATCH", 10)
+        d = self.release(25, 197)
+        d.addCallback(self.assertEqual, {'queued': 0, 'in-flight': 0,
+                                         'messages': 3, 'references': 25})
+        return d
+
+    def test_delay(self):
+        self.setupBrokers({"banana-decision-version": 197})
+        self.callingBroker.decrefDelay = 60
+        rr, target = self.setupTarget(Target())
+        clid = rr.tracker.clid
+        del rr
+        gc.collect()
+        d = flushEventualQueue()
+        def _queued(res):
+            stats = self.callingBroker.getDecrefStats()
+            self.assertEqual(stats["queued"], 1)
+            self.assertEqual(stats["messages"], 0)
+            self.assertIn(clid, self.callingBroker.yourReferenceByCLID)
+            self.assertIn(clid, self.targetBroker.myReferenceByCLID)
+            self.callingBroker.flushDecrefs()
+            return self.poll(lambda: clid not in
+                             self.targetBroker.myReferenceByCLID)
+        d.addCallback(_queued)
+        d.addCallback(lambda res: self.assertNotIn(
+            clid, self.callingBroker.yourReferenceByCLID))
+        return d
+
+    def test_ordered(self):
+        # a decref is ordered after the calls to the reference it releases,
+        # even though it is sent with a higher priority
+        self.setupBrokers({"banana-decision-version": 196})
+        rr, target = self.setupTarget(Target())
+        clid = rr.tracker.clid
+        keys = []
+        send = self.callingBroker.send
+        def _send(obj, priority=PRIORITY_NORMAL, key=None):
+            keys.append(key)
+            return send(obj, priority, key)
+        self.callingBroker.send = _send
+        del rr
+        gc.collect()
+        d = self.poll(lambda: clid not in self.targetBroker.myReferenceByCLID)
+        d.addCallback(lambda res: self.assertEqual(keys, [(0, clid)]))
+        return d
+
+    def test_ordered_batch(self):
+        self.setupBrokers({"banana-decision-version": 197})
+        rrs = [self.setupTarget(Target())[0] for i in range(3)]
+        clids = tuple(rr.tracker.clid for rr in rrs)
+        keys = []
+        send = self.callingBroker.send
+        def _send(obj, priority=PRIORITY_NORMAL, key=None):
+            keys.append(key)
+            return send(obj, priority, key)
+        self.callingBroker.send = _send
+        del rrs
+        gc.collect()
+        d = self.poll(lambda: not any(clid in self.targetBroker.myReferenceByCLID
+                                      for clid in clids))
+        def _check(res):
+            # the broker's own clid, then every clid in the batch
+            self.assertEqual(keys[0][0], 0)
+            self.assertEqual(sorted(keys[0][1:]), sorted(clids))
+        d.addCallback(_check)
+        return d
+
+    def test_old_peer(self):
+        # peers without decref_many get one decref per reference
+        d = self.release(5, 196)
+        d.addCallback(self.assertEqual, {'queued': 0, 'in-flight': 0,
+                                         'messages': 5, 'references': 5})
+        return d
+
+
 class TestCallOnly(TargetMixin, unittest.TestCase):
     def setUp(self):
         TargetMixin.setUp(self)
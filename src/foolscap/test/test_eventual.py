@@ -40,3 +40,19 @@ class TestEventual(unittest.TestCase):
         d = flushEventualQueue()
         d.addCallback(_check)
         return d
+
+    def testFlushFromEvent(self):
+        # flushing from inside an event must wait for the events queued
+        # behind it in the same turn, and whatever those queue up
+        results = []
+        flushed = []
+        def _flush():
+            flushEventualQueue().addCallback(lambda res: flushed.append(list(results)))
+        eventually(_flush)
+        eventually(lambda: eventually(results.append, 1))
+        d = fireEventually()
+        d.addCallback(flushEventualQueue)
+        def _check(res):
+            self.assertEqual(flushed, [[1]])
+        d.addCallback(_check)
+        return d
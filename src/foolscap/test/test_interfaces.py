@@ -41,6 +41,18 @@ class TestInterface(TargetMixin, unittest.TestCase):
         else:
             self.fail("duplicate registration not caught")
 
+    def testUnordered(self):
+        class RIUnordered(RemoteInterface):
+            __unordered__ = True
+            def foo(bar=int): return int
+            baz = RemoteMethodSchema(_response=int)
+        self.assertTrue(RIUnordered["foo"].unordered)
+        self.assertTrue(RIUnordered["baz"].unordered)
+        self.assertFalse(RIMyTarget["add"].unordered)
+        ms = RemoteMethodSchema(__unordered__=True, bar=int)
+        self.assertTrue(ms.unordered)
+        self.assertEqual(ms.argumentNames, ["bar"])
+
     def testInterface1(self):
         # verify that we extract the right interfaces from a local object.
         # also check that the registry stuff works.
@@ -0,0 +1,313 @@
+from zope.interface import implementer
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from foolscap.api import Referenceable, RemoteInterface, Tub
+from foolscap.metrics import (Histogram, CallStats, RICallStats, LinkStats,
+                              HintStats)
+from foolscap.info import ConnectionInfo
+from foolscap import broker
+from foolscap.test.common import TargetMixin, ShouldFailMixin, \
+     TargetWithoutInterfaces
+
+
+class RIMeasured(RemoteInterface):
+    def echo(data=bytes): return bytes
+    def fail(): return None
+    def hang(): return None
+
+@implementer(RIMeasured)
+class MeasuredTarget(Referenceable):
+    def __init__(self):
+        self.hanging = []
+    def remote_echo(self, data):
+        return data
+    def remote_fail(self):
+        raise ValueError("you asked me to fail")
+    def remote_hang(self):
+        d = defer.Deferred()
+        self.hanging.append(d)
+        return d
+
+RIMEASURED = RIMeasured.__remote_name__
+
+
+class Histograms(unittest.TestCase):
+    def test_buckets(self):
+        h = Histogram()
+        for seconds in [0.0, 1e-9, 0.3, 0.4, 3.0, 1e6]:
+            h.add(seconds)
+        stats = h.getStats()
+        self.assertEqual(stats["count"], 6)
+        self.assertEqual(stats["max"], 1e6)
+        self.assertAlmostEqual(stats["mean"], (0.7 + 3.0 + 1e6) / 6)
+        self.assertEqual(stats["buckets"],
+                         [(2.0**Histogram.MIN_EXPONENT, 2), # clamped
+                          (0.5, 2), (4.0, 1),
+                          (2.0**Histogram.MAX_EXPONENT, 1)]) # clamped
+
+    def test_empty(self):
+        self.assertEqual(Histogram().getStats(),
+                         {"count": 0, "mean": 0.0, "max": 0.0,
+                          "buckets": []})
+
+
+class Links(unittest.TestCase):
+    def test_rtt(self):
+        ls = LinkStats()
+        for rtt in [0.8, 1.2, 0.4]:
+            ls.addRTT(rtt)
+        stats = ls.getStats(0.0, 0, 0)
+        self.assertEqual(stats["rtt-samples"], 3)
+        self.assertEqual(stats["min-rtt"], 0.4)
+        self.assertEqual(stats["last-rtt"], 0.4)
+        # 0.8, then 0.8+0.4/8 = 0.85, then 0.85-0.45/8
+        self.assertAlmostEqual(stats["rtt"], 0.79375)
+        # 0.4, then 0.4+(0.4-0.4)/4 = 0.4, then 0.4+(0.45-0.4)/4
+        self.assertAlmostEqual(stats["rtt-jitter"], 0.4125)
+
+    def test_rates(self):
+        ls = LinkStats()
+        self.assertEqual(ls.getStats(10.0, 0, 0)["rtt"], None)
+        ls.sampleBytes(10.5, 500, 500) # too soon after the last one
+        for i in range(1, 20):
+            ls.sampleBytes(10.0 + i, 1000 * i, 100 * i)
+        stats = ls.getStats(30.0, 20000, 2000)
+        self.assertEqual((stats["bytes-in"], stats["bytes-out"]),
+                         (20000, 2000))
+        # measured over the last RATE_SAMPLES snapshots
+        self.assertAlmostEqual(stats["bytes-in-rate"], 1000.0)
+        self.assertAlmostEqual(stats["bytes-out-rate"], 100.0)
+
+
+class Hints(unittest.TestCase):
+    def test_rank(self):
+        hs = HintStats()
+        hints = ["a", "b", "c", "d", "e"]
+        self.assertEqual(hs.rank(hints), hints)
+        hs.attemptFailed("a")
+        for hint, seconds in [("c", 0.5), ("d", 0.1)]:
+            hs.attemptStarted(hint)
+            hs.attemptConnected(hint, seconds)
+            hs.attemptSucceeded(hint)
+        hs.attemptConnected("e", 0.01) # but it didn't win
+        # the winners, fastest first, then the unknown, then the failed
+        self.assertEqual(hs.rank(hints), ["d", "c", "b", "e", "a"])
+        hs.attemptConnected("c", 0.1) # moves 1/8 of the way there
+        self.assertAlmostEqual(hs.getStats()["hints"]["c"]["connect-time"],
+                               0.45)
+        hs.attemptFailed("d")
+        self.assertEqual(hs.rank(hints), ["c", "b", "e", "a", "d"])
+
+    def test_wasted(self):
+        hs = HintStats()
+        hs.attemptAbandoned("a", negotiating=False)
+        hs.attemptAbandoned("b", negotiating=True)
+        hs.hintsSkipped(3)
+        stats = hs.getStats()
+        self.assertEqual((stats["abandoned-connects"],
+                          stats["abandoned-negotiations"],
+                          stats["wasted-attempts"], stats["skipped-hints"]),
+                         (1, 1, 2, 3))
+
+    def test_forget(self):
+        hs = HintStats()
+        hs.MAX_HINTS = 3
+        for hint in ["a", "b", "c"]:
+            hs.attemptFailed(hint)
+        hs.attemptFailed("a")
+        hs.attemptFailed("d") # "b" was used least recently
+        self.assertEqual(sorted(hs.hints), ["a", "c", "d"])
+
+    def test_option(self):
+        t = Tub()
+        self.assertIsInstance(t.hintStats, HintStats)
+        t.setOption("connection-stagger", 0.5)
+        self.assertEqual(t._connection_stagger, 0.5)
+
+
+class Probes(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def test_connection_info(self):
+        self.callingBroker._connectionInfo = ConnectionInfo()
+        rr, target = self.setupTarget(MeasuredTarget(), True)
+        # a PING is sent when the connection is made
+        d = self.poll(lambda: self.callingBroker.linkStats.rttSamples)
+        d.addCallback(lambda ign: rr.callRemote("echo", b"x" * 1000))
+        def _check(res):
+            ci = rr.getConnectionInfo()
+            self.assertTrue(ci.rtt > 0, ci.rtt)
+            self.assertEqual(ci.minRTT, ci.rtt)
+            self.assertTrue(ci.rttJitter > 0)
+            self.assertTrue(ci.bytesOut > 1000, ci.bytesOut)
+            self.assertTrue(ci.bytesIn > 1000, ci.bytesIn)
+            self.callingBroker.probeLink()
+            return self.poll(lambda:
+                             self.callingBroker.linkStats.rttSamples == 2)
+        d.addCallback(_check)
+        return d
+
+    def test_unanswered(self):
+        self.targetBroker.sendPONG = lambda number: None
+        for i in range(broker.MAX_PINGS_IN_FLIGHT + 2):
+            self.callingBroker.probeLink()
+        self.assertEqual(len(self.callingBroker.pingsInFlight),
+                         broker.MAX_PINGS_IN_FLIGHT)
+        # an unsolicited PONG is ignored
+        self.callingBroker.pongReceived(999)
+        self.assertEqual(self.callingBroker.linkStats.rttSamples, 0)
+
+    def test_option(self):
+        t = Tub()
+        t.setOption("rtt-probe-interval", 30)
+        self.assertEqual(t._rtt_probe_interval, 30)
+
+
+class Calls(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        self.rr, self.target = self.setupTarget(MeasuredTarget(), True)
+
+    def outbound(self, methodname):
+        stats = self.callingBroker.callStats.getStats([self.callingBroker])
+        return stats["outbound"][RIMEASURED + "." + methodname]
+
+    def inbound(self, methodname):
+        stats = self.targetBroker.callStats.getStats([self.targetBroker])
+        return stats["inbound"][RIMEASURED + "." + methodname]
+
+    def test_echo(self):
+        d = self.rr.callRemote("echo", b"x" * 1000)
+        def _check(res):
+            out = self.outbound("echo")
+            self.assertEqual(out["calls"], 1)
+            self.assertEqual(out["failures"], 0)
+            self.assertEqual(out["in-flight"], 0)
+            self.assertEqual(out["latency"]["count"], 1)
+            # the (call) sequence holds the argument, plus a little framing
+            self.assertTrue(1000 < out["argument-bytes"] < 1100,
+                            out["argument-bytes"])
+            inb = self.inbound("echo")
+            self.assertEqual(inb["calls"], 1)
+            self.assertEqual(inb["failures"], 0)
+            self.assertEqual(inb["in-flight"], 0)
+            self.assertEqual(inb["queue-wait"]["count"], 1)
+            self.assertEqual(inb["execution"]["count"], 1)
+            self.assertTrue(1000 < inb["answer-bytes"] < 1100,
+                            inb["answer-bytes"])
+            return self.rr.callRemote("echo", b"")
+        d.addCallback(_check)
+        def _check2(res):
+            self.assertEqual(self.outbound("echo")["calls"], 2)
+            self.assertEqual(self.inbound("echo")["calls"], 2)
+            self.assertEqual(self.inbound("echo")["execution"]["count"], 2)
+        d.addCallback(_check2)
+        return d
+
+    def test_failure(self):
+        d = self.shouldFail(ValueError, "test_failure", "you asked me to fail",
+                            self.rr.callRemote, "fail")
+        def _check(res):
+            out = self.outbound("fail")
+            self.assertEqual((out["calls"], out["failures"]), (1, 1))
+            inb = self.inbound("fail")
+            self.assertEqual((inb["calls"], inb["failures"]), (1, 1))
+            self.assertTrue(inb["answer-bytes"] > 0) # the (error) sequence
+        d.addCallback(_check)
+        return d
+
+    def test_in_flight(self):
+        d = self.rr.callRemote("hang")
+        def _hanging():
+            return self.target.hanging
+        d2 = self.poll(_hanging)
+        def _check(res):
+            self.assertEqual(self.outbound("hang")["in-flight"], 1)
+            self.assertEqual(self.outbound("hang")["latency"]["count"], 0)
+            self.assertEqual(self.inbound("hang")["in-flight"], 1)
+            self.assertEqual(self.inbound("hang")["execution"]["count"], 0)
+            self.target.hanging[0].callback(None)
+            return d
+        d2.addCallback(_check)
+        def _done(res):
+            self.assertEqual(self.outbound("hang")["in-flight"], 0)
+            self.assertEqual(self.outbound("hang")["latency"]["count"], 1)
+            self.assertEqual(self.inbound("hang")["in-flight"], 0)
+            self.assertEqual(self.inbound("hang")["execution"]["count"], 1)
+        d2.addCallback(_done)
+        return d2
+
+    def test_callOnly(self):
+        self.rr.callRemoteOnly("echo", b"data")
+        def _served():
+            return "echo" in [key[1] for key in
+                              self.targetBroker.callStats.inbound]
+        d = self.poll(_served)
+        def _check(res):
+            out = self.outbound("echo")
+            self.assertEqual(out["calls"], 1)
+            self.assertTrue(out["argument-bytes"] > 0)
+            # there is no answer to wait for
+            self.assertEqual(out["latency"]["count"], 0)
+            inb = self.inbound("echo")
+            self.assertEqual(inb["execution"]["count"], 1)
+            self.assertEqual(inb["answer-bytes"], 0)
+        d.addCallback(_check)
+        return d
+
+
+class Unknown(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def test_unknown_method(self):
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        d = defer.DeferredList([rr.callRemote("bogus%d" % i)
+                                for i in range(5)],
+                               consumeErrors=True)
+        def _check(res):
+            self.assertFalse(any(success for (success, _) in res))
+            inbound = self.targetBroker.callStats.getStats()["inbound"]
+            self.assertEqual(list(inbound), ["?.?"])
+            self.assertEqual(inbound["?.?"]["calls"], 5)
+            self.assertEqual(inbound["?.?"]["failures"], 5)
+        d.addCallback(_check)
+        return d
+
+    def test_limit(self):
+        stats = CallStats()
+        stats.MAX_INBOUND = 3
+        for i in range(10):
+            stats.getInbound("RIFoo", "m%d" % i).calls += 1
+        self.assertEqual(len(stats.inbound), 4)
+        inbound = stats.getStats()["inbound"]
+        self.assertEqual(inbound["RIFoo.m2"]["calls"], 1)
+        self.assertEqual(inbound["?.?"]["calls"], 7)
+
+
+class Reporter(TargetMixin, unittest.TestCase):
+    def test_get_stats(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        tub = Tub()
+        self.assertEqual(tub.getStats(), {"outbound": {}, "inbound": {}})
+        self.assertIsInstance(tub.callStats, CallStats)
+        self.targetBroker.callStats = tub.callStats
+        reporter = tub.getStatsReporter()
+        self.assertIs(tub.getStatsReporter(), reporter)
+        self.assertTrue(RICallStats.providedBy(reporter))
+        rr, target = self.setupTarget(reporter, True)
+        d = rr.callRemote("get_stats")
+        def _check(stats):
+            inb = stats["inbound"][RICallStats.__remote_name__ + ".get_stats"]
+            # the call that is asking has been counted already
+            self.assertEqual(inb["calls"], 1)
+            self.assertEqual(inb["execution"]["count"], 0)
+            self.assertEqual(stats["outbound"], {})
+        d.addCallback(_check)
+        return d
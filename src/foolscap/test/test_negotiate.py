@@ -1,12 +1,13 @@
 
 from twisted.trial import unittest
 
+from zope.interface import implementer
 from twisted.internet import protocol, defer, reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.application import internet
 from twisted.web.client import Agent
 
-from foolscap      import negotiate, tokens
+from foolscap      import negotiate, tokens, vocab, ipb
 from foolscap.api  import Referenceable, Tub, BananaError
 from foolscap.util import allocate_tcp_port
 from foolscap.test.common import BaseMixin, PollMixin, tubid_low, certData_low, certData_high
@@ -20,6 +21,11 @@ class Target(Referenceable):
         self.calls += 1
 
 
+class Tripler(Referenceable):
+    def remote_triple(self, words):
+        return words * 3
+
+
 class OneTimeDeferred(defer.Deferred):
     def callback(self, res):
         if self.called:
@@ -42,6 +48,85 @@ class Basic(BaseMixin, unittest.TestCase):
     testAuthenticated.timeout = 10
 
 
+class VocabTables(BaseMixin, unittest.TestCase):
+    TABLE_A = [b'RIFoo', b'get_foo']
+    TABLE_B = ['RIBar', 'get_bar', 'put_bar']
+    TABLE_C = [b'RIBaz']
+
+    def test_register(self):
+        tub = Tub()
+        digest = tub.registerVocabTable(self.TABLE_B + ['RIBar'])
+        self.assertEqual(digest, vocab.hashVocabWords([b'RIBar', b'get_bar', b'put_bar']))
+        self.assertEqual(tub.vocabTables[digest], [b'RIBar', b'get_bar', b'put_bar'])
+        self.assertRaises(TypeError, tub.registerVocabTable, [1])
+
+    @inlineCallbacks
+    def test_shared(self):
+        url, portnum = self.makeServer()
+        self.tub.registerVocabTable(self.TABLE_A)
+        self.tub.registerVocabTable(self.TABLE_B)
+        client = Tub()
+        client.registerVocabTable(self.TABLE_B)
+        client.registerVocabTable(self.TABLE_C)
+        client.startService()
+        self.services.append(client)
+        rref = yield client.getReference(url)
+
+        # only the table both sides know is used, after the initial one
+        base = vocab.INITIAL_VOCAB_TABLES[max(vocab.getVocabIndices())]
+        expected = dict(enumerate(base + [b'RIBar', b'get_bar', b'put_bar']))
+        client_broker = rref.tracker.broker
+        server_broker = list(self.tub.brokers.values())[0]
+        for b in client_broker, server_broker:
+            self.assertEqual(b.incomingVocabulary, expected)
+            self.assertEqual(b.outgoingVocabulary,
+                             dict((v, k) for (k, v) in expected.items()))
+
+        res = yield rref.callRemote("add", a=1, b=2)
+        self.assertEqual(res, 3)
+    test_shared.timeout = 10
+
+    @inlineCallbacks
+    def test_unshared(self):
+        url, portnum = self.makeServer()
+        self.tub.registerVocabTable(self.TABLE_A)
+        client = Tub()
+        client.startService()
+        self.services.append(client)
+        rref = yield client.getReference(url)
+        base = vocab.INITIAL_VOCAB_TABLES[max(vocab.getVocabIndices())]
+        self.assertEqual(rref.tracker.broker.incomingVocabulary,
+                         dict(enumerate(base)))
+    test_unshared.timeout = 10
+
+    @inlineCallbacks
+    def test_large(self):
+        # a big shared table leaves the peer the usual room for its adaptive
+        # entries, so they can't fill the table up and drop the connection
+        table = ['word%04d' % i for i in range(1500)]
+        url, portnum = self.makeServer()
+        self.tub.registerVocabTable(table)
+        url = self.tub.registerReference(Tripler())
+        client = Tub()
+        client.registerVocabTable(table)
+        client.startService()
+        self.services.append(client)
+        rref = yield client.getReference(url)
+        b = rref.tracker.broker
+        self.assertTrue(len(b.incomingVocabulary) > 1500)
+        # every string comes back three times, so the server adds each one to
+        # its vocabulary
+        words = [b'other%04d' % i for i in range(1100)]
+        res = yield rref.callRemote("triple", words)
+        self.assertEqual(res, words * 3)
+        # the (add-vocab) sequences may trail the answer: another round trip
+        # makes sure they have all arrived
+        yield rref.callRemote("triple", [])
+        self.assertTrue(len(b.incomingVocabulary) > 2048,
+                        len(b.incomingVocabulary))
+    test_large.timeout = 20
+
+
 class Versus(BaseMixin, unittest.TestCase):
     def testVersusHTTPServerAuthenticated(self):
         portnum = self.makeHTTPServer()
@@ -293,6 +378,89 @@ class ThreeInParallel(BaseMixin, unittest.TestCase):
         return d
     test1.timeout = 10
 
+@implementer(ipb.IConnectionHintHandler)
+class StalledHints:
+    # hints of type "stalled:" are never resolved
+    def hint_to_endpoint(self, hint, reactor, update_status):
+        return defer.Deferred()
+
+class Staggered(BaseMixin, unittest.TestCase):
+    # hints are tried one at a time, best first, and the counters in
+    # tub.hintStats say how it went
+
+    def makeServers(self, *hints):
+        self.tub = tub = Tub()
+        tub.startService()
+        self.services.append(tub)
+        port = allocate_tcp_port()
+        tub.listenOn("tcp:%d:interface=127.0.0.1" % port)
+        self.goodHint = "tcp:127.0.0.1:%d" % port
+        self.deadHint = "tcp:127.0.0.1:%d" % allocate_tcp_port()
+        tub.setLocation(*[getattr(self, h) for h in hints])
+        return tub.registerReference(Target())
+
+    def makeClient(self):
+        client = Tub()
+        client.addConnectionHintHandler("stalled", StalledHints())
+        client.startService()
+        self.services.append(client)
+        return client
+
+    @inlineCallbacks
+    def test_failed_first(self):
+        url = self.makeServers("deadHint", "goodHint")
+        client = self.makeClient()
+        # the failure starts the next attempt, without waiting for this
+        client.setOption("connection-stagger", 5)
+        yield client.getReference(url)
+        stats = client.hintStats.getStats()
+        self.assertEqual((stats["attempts"], stats["failures"],
+                          stats["connections"], stats["wasted-attempts"]),
+                         (2, 1, 1, 0))
+        self.assertTrue(stats["hints"][self.goodHint]["connect-time"] > 0)
+        # next time, the one that worked goes first
+        self.assertEqual(client.hintStats.rank([self.deadHint, self.goodHint]),
+                         [self.goodHint, self.deadHint])
+    test_failed_first.timeout = 10
+
+    @inlineCallbacks
+    def test_skipped(self):
+        url = self.makeServers("goodHint", "deadHint")
+        client = self.makeClient()
+        yield client.getReference(url)
+        stats = client.hintStats.getStats()
+        # the second hint was never needed
+        self.assertEqual((stats["attempts"], stats["skipped-hints"]), (1, 1))
+    test_skipped.timeout = 10
+
+    @inlineCallbacks
+    def test_stalled(self):
+        self.stalledHint = "stalled:foo"
+        url = self.makeServers("stalledHint", "goodHint")
+        client = self.makeClient()
+        rref = yield client.getReference(url)
+        # the second hint was started when the first made no progress, and
+        # the first was abandoned when the second won
+        ci = rref.getConnectionInfo()
+        self.assertEqual(ci.connectorStatuses,
+                         {self.stalledHint: "abandoned",
+                          self.goodHint: "successful"})
+        stats = client.hintStats.getStats()
+        self.assertEqual((stats["attempts"], stats["abandoned-connects"],
+                          stats["wasted-attempts"]), (2, 1, 1))
+    test_stalled.timeout = 10
+
+    def test_no_stagger(self):
+        self.stalledHint = "stalled:foo"
+        url = self.makeServers("stalledHint", "goodHint")
+        client = self.makeClient()
+        client.setOption("connection-stagger", 0)
+        d = client.getReference(url)
+        # they both start right away
+        self.assertEqual(client.hintStats.getStats()["attempts"], 2)
+        return d
+    test_no_stagger.timeout = 10
+
 class SharedConnections(BaseMixin, unittest.TestCase):
     def makeServers(self):
         self.tub = tub = Tub(certData=certData_high)
@@ -544,7 +712,7 @@ class Existing(CrossfireMixin, unittest.TestCase):
 # this test will have to change when the regular Negotiation starts using
 # different decision blocks. The version numbers must be updated each time
 # the negotiation version is changed.
-assert negotiate.Negotiation.maxVersion == 191
+assert negotiate.Negotiation.maxVersion == 199
 MAX_HANDLED_VERSION = negotiate.Negotiation.maxVersion
 #UNHANDLED_VERSION = 3
 UNHANDLED_VERSION = MAX_HANDLED_VERSION + 1
@@ -557,12 +725,12 @@ class NegotiationVbig(negotiate.Negotiation):
         negotiate.Negotiation.__init__(self, logparent)
         self.negotiationOffer["extra"] = "new value"
 
-    def evaluateNegotiationVersion192(self, offer):
+    def evaluateNegotiationVersion200(self, offer):
         # just like v1, but different
-        return self.evaluateNegotiationVersion191(offer)
+        return self.evaluateNegotiationVersion199(offer)
 
-    def acceptDecisionVersion192(self, decision):
-        return self.acceptDecisionVersion191(decision)
+    def acceptDecisionVersion200(self, decision):
+        return self.acceptDecisionVersion199(decision)
 
 
 class NegotiationVbigOnly(NegotiationVbig):
@@ -1,6 +1,7 @@
 # -*- test-case-name: foolscap.test.test_pb -*-
 
 import re
+from io import BytesIO
 
 if False:
     import sys
@@ -15,7 +16,7 @@ from twisted.trial import unittest
 from foolscap import referenceable
 from foolscap.tokens import BananaError, Violation, INT, STRING, OPEN
 from foolscap.tokens import BananaFailure
-from foolscap import broker, call
+from foolscap import broker, call, banana, storage, vocab
 from foolscap.constraint import IConstraint
 from foolscap.logging import log
 from foolscap.api import Tub
@@ -92,6 +93,49 @@ class TestReferenceUnslicer(unittest.TestCase):
         self.assertEqual(rr2.tracker.clid, 12)
         self.assertEqual(rr2.tracker.interfaceName, "IBar")
 
+class TestVocab(unittest.TestCase):
+    # top-level (set-vocab) sequences, as an AdaptiveVocabulary sends them
+    def makeBroker(self, version):
+        b = broker.Broker(None, {'banana-decision-version': version,
+                                 'initial-vocab-table-index': 191})
+        b.transport = NullTransport()
+        b.connectionMade()
+        return b
+
+    def tearDown(self):
+        return flushEventualQueue()
+
+    def sendVocab(self, b, words):
+        sender = storage.StorageBanana()
+        sender.transport = BytesIO()
+        sender.connectionMade()
+        sender.setOutgoingVocabulary(words)
+        b.dataReceived(sender.transport.getvalue())
+
+    def testAccept(self):
+        b = self.makeBroker(banana.ADAPTIVE_VOCAB_VERSION)
+        self.sendVocab(b, [b'one', b'two'])
+        self.assertEqual(b.incomingVocabulary, {0: b'one', 1: b'two'})
+
+    def testOldPeer(self):
+        # a peer that did not negotiate adaptive vocabulary may not change
+        # the table
+        b = self.makeBroker(banana.ADAPTIVE_VOCAB_VERSION - 1)
+        self.sendVocab(b, [b'one', b'two'])
+        self.assertEqual(b.incomingVocabulary,
+                         dict(enumerate(vocab.vocab_v191)))
+
+    def testTooLarge(self):
+        b = self.makeBroker(banana.ADAPTIVE_VOCAB_VERSION)
+        words = [b'word%d' % i for i in range(b.maxIncomingVocabulary + 1)]
+        self.sendVocab(b, words)
+        self.assertEqual(b.incomingVocabulary,
+                         dict(enumerate(vocab.vocab_v191)))
+        # and the connection survives the rejected sequence
+        self.sendVocab(b, words[:3])
+        self.assertEqual(b.incomingVocabulary, dict(enumerate(words[:3])))
+
+
 class TestAnswer(unittest.TestCase):
     # OPEN(answer), INT(reqID), [answer], CLOSE
     def setUp(self):
@@ -250,3 +250,13 @@ class Chained(unittest.TestCase):
             self.assertEqual(c.count, expected)
         p1.add(2).add(3)._then(_check, 6)
         r(Counter(1))
+
+    def testSendToBrokenPromise(self):
+        p1,r = makePromise()
+        r(Failure(KaboomError("foom")))
+        d = when(p1.add(2))
+        def _check(res):
+            self.assertTrue(isinstance(res, Failure))
+            self.assertTrue(res.check(KaboomError))
+        d.addBoth(_check)
+        return d
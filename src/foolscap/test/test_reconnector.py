@@ -5,8 +5,8 @@ from twisted.trial import unittest
 from foolscap.api import Tub, eventually, flushEventualQueue
 from foolscap.test.common import HelperTarget, MakeTubsMixin, PollMixin
 from foolscap.util import allocate_tcp_port
-from twisted.internet import defer, reactor, error
-from foolscap import negotiate, referenceable
+from twisted.internet import defer, reactor, error, task
+from foolscap import negotiate, referenceable, reconnector
 
 class AlwaysFailNegotiation(negotiate.Negotiation):
     def sendHello(self):
@@ -213,8 +213,9 @@ class Reconnector(MakeTubsMixin, PollMixin, unittest.TestCase):
         # wait for at least one retry
         yield self.poll(lambda: rc.getReconnectionInfo().state == "waiting")
 
-        # and a bit more, for good measure
+        # and a bit more, for good measure, until it is waiting again
         yield self.stall(2)
+        yield self.poll(lambda: rc.getReconnectionInfo().state == "waiting")
 
         self.assertEqual(len(connects), 0)
         f = rc.getLastFailure()
@@ -242,6 +243,169 @@ class Unstarted(MakeTubsMixin, unittest.TestCase):
         ri = rc.getReconnectionInfo()
         self.assertEqual(ri.state, "unstarted")
 
+TUB1 = "q5l37rle6pojjnllrwjyryulavpqdlq5"
+TUB2 = "u5vgfpug7qhkxdtj76tcfh6bmzyo6w5s"
+
+class FakeTub:
+    def __init__(self, clock):
+        self.reconnectionScheduler = reconnector.ReconnectionScheduler(clock)
+        self.attempts = [] # (url, Deferred)
+    def getReference(self, url):
+        d = defer.Deferred()
+        self.attempts.append((url, d))
+        return d
+    def getConnectionInfoForFURL(self, url):
+        return None
+    def _removeReconnector(self, rc):
+        pass
+
+class FakeRemoteReference:
+    def __init__(self):
+        self.observers = []
+    def notifyOnDisconnect(self, cb):
+        self.observers.append(cb)
+    def disconnect(self):
+        for cb in self.observers:
+            cb()
+
+class Scheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.tub = FakeTub(self.clock)
+        self.scheduler = self.tub.reconnectionScheduler
+        self.connected = []
+
+    def connectTo(self, url):
+        rc = reconnector.Reconnector(url, self.connected.append, (), {})
+        rc.startConnecting(self.tub)
+        self.addCleanup(rc.stopConnecting)
+        return rc
+
+    def answer(self, result):
+        attempts, self.tub.attempts = self.tub.attempts, []
+        for (url, d) in attempts:
+            if result is None:
+                d.callback(FakeRemoteReference())
+            else:
+                d.errback(result)
+        return len(attempts)
+
+    def test_coalesce(self):
+        rc1 = self.connectTo("pb://%s@tcp:host1:1234/one" % TUB1)
+        self.assertEqual(len(self.tub.attempts), 1)
+        # a second one for the same Tub joins the attempt in flight
+        rc2 = self.connectTo("pb://%s@tcp:host1:1234/two" % TUB1)
+        self.assertEqual(len(self.tub.attempts), 2)
+        self.assertEqual(self.scheduler.getStats()["targets"], 1)
+        self.assertEqual(self.scheduler.getStats()["attempts"], 1)
+        self.assertEqual(self.scheduler.getStats()["coalesced-attempts"], 1)
+        self.answer(error.ConnectionRefusedError())
+        # they wait, and try again, together
+        self.assertEqual(rc1.getReconnectionInfo().state, "waiting")
+        self.assertEqual(rc1.getDelayUntilNextAttempt(),
+                         rc2.getDelayUntilNextAttempt())
+        self.clock.advance(rc1.getDelayUntilNextAttempt())
+        self.assertEqual(self.answer(None), 2)
+        self.assertEqual(len(self.connected), 2)
+        ri = rc2.getReconnectionInfo()
+        self.assertEqual((ri.attempts, ri.failures, ri.connects), (2, 1, 1))
+        # one of them led each attempt, and the other followed
+        self.assertEqual(rc1.getReconnectionInfo().coalescedAttempts +
+                         ri.coalescedAttempts, 2)
+        self.assertEqual(self.scheduler.getStats()["attempts"], 2)
+
+    def test_backoff(self):
+        rc = self.connectTo("pb://%s@tcp:host1:1234/one" % TUB1)
+        delays = []
+        for i in range(20):
+            self.answer(error.ConnectionRefusedError())
+            delay = rc.getDelayUntilNextAttempt()
+            delays.append(delay)
+            self.clock.advance(delay)
+        for previous, delay in zip([rc.initialDelay] + delays, delays):
+            self.assertTrue(rc.initialDelay <= delay <= rc.maxDelay, delay)
+            self.assertTrue(delay <= previous * rc.factor, (previous, delay))
+        self.assertEqual(rc.getReconnectionInfo().failures, 20)
+        # a connection forgets the backoff, and a disconnect is followed by
+        # a quick retry
+        self.answer(None)
+        self.assertEqual(rc.getDelayUntilNextAttempt(), None)
+        self.connected[0].disconnect()
+        self.assertEqual(rc.getReconnectionInfo().state, "waiting")
+        self.assertTrue(0 <= rc.getDelayUntilNextAttempt() <= rc.initialDelay)
+
+    def test_no_jitter(self):
+        rc = self.connectTo("pb://%s@tcp:host1:1234/one" % TUB1)
+        rc.jitter = 0
+        self.answer(error.ConnectionRefusedError())
+        self.assertAlmostEqual(rc.getDelayUntilNextAttempt(), rc.factor)
+        self.clock.advance(rc.factor)
+        self.answer(error.ConnectionRefusedError())
+        self.assertAlmostEqual(rc.getDelayUntilNextAttempt(), rc.factor**2)
+        rc.reset()
+        self.assertAlmostEqual(rc.getDelayUntilNextAttempt(), 1.0)
+
+    def test_jitter(self):
+        # jitter is the fraction of each delay that is random
+        rc = self.connectTo("pb://%s@tcp:host1:1234/one" % TUB1)
+        rc.jitter = 0.1
+        for i in range(10):
+            self.answer(error.ConnectionRefusedError())
+            delay = rc.getDelayUntilNextAttempt()
+            self.assertTrue(0.9 * rc.factor <= delay <= rc.factor, delay)
+            rc.reset()
+            self.clock.advance(1.0)
+
+    def test_group_parameters(self):
+        # the group retries as eagerly as its most eager member, whichever
+        # of them happens to lead
+        rc1 = self.connectTo("pb://%s@tcp:host1:1234/one" % TUB1)
+        rc2 = self.connectTo("pb://%s@tcp:host1:1234/two" % TUB1)
+        rc1.jitter = rc2.jitter = 0
+        rc1.factor, rc2.factor = 3, 2
+        rc1.maxDelay, rc2.maxDelay = 5, 3600
+        delays = []
+        for i in range(3):
+            self.answer(error.ConnectionRefusedError())
+            delays.append(rc1.getDelayUntilNextAttempt())
+            self.assertEqual(rc2.getDelayUntilNextAttempt(), delays[-1])
+            self.clock.advance(delays[-1])
+        self.assertEqual(delays, [2, 4, 5])
+
+    def test_per_hint_limit(self):
+        self.scheduler.maxPerHint = 1
+        rc1 = self.connectTo("pb://%s@tcp:host1:1234/one" % TUB1)
+        rc2 = self.connectTo("pb://%s@tcp:host1:1234,tcp:host2:1234/two"
+                             % TUB2)
+        # TUB2 shares a hint with TUB1, so it waits for that attempt
+        self.assertEqual(len(self.tub.attempts), 1)
+        ri = rc2.getReconnectionInfo()
+        self.assertEqual((ri.state, ri.nextAttempt), ("waiting", None))
+        self.assertEqual(self.scheduler.getStats()["queued"], 1)
+        self.answer(None)
+        self.assertEqual(len(self.tub.attempts), 1)
+        self.assertEqual(ri.state, "connecting")
+        self.assertEqual(self.scheduler.getStats()["queued-attempts"], 1)
+        rc2.stopConnecting()
+        self.assertEqual(self.scheduler.inFlight, {})
+        rc1.stopConnecting()
+        self.assertEqual(self.scheduler.getStats()["targets"], 0)
+
+    def test_stop(self):
+        rc = self.connectTo("pb://%s@tcp:host1:1234/one" % TUB1)
+        rc.stopConnecting()
+        # the attempt that was in flight is ignored
+        self.answer(None)
+        self.assertEqual(self.connected, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_bad_furl(self):
+        rc = self.connectTo("this is not a FURL")
+        self.answer(ValueError())
+        self.assertEqual(rc.getReconnectionInfo().state, "waiting")
+        rc.stopConnecting()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
 # TODO: look at connections that succeed because of a listener, and also
 # loopback
 class Failed(PollMixin, unittest.TestCase):
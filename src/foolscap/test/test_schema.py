@@ -204,6 +204,27 @@ class ConformTest(unittest.TestCase):
         self.violates(l4, [b"but", b"four", b"is", b"bad"])
         self.violates(l4, [b"two", b"too"])
 
+    def testNested(self):
+        # nested containers are checked without recursion, so depth is only
+        # limited by the constraints themselves
+        c = schema.IntegerConstraint()
+        for i in range(2000):
+            c = schema.ListOf(c)
+        obj = 5
+        for i in range(2000):
+            obj = [obj]
+        self.conforms(c, obj)
+        inner = obj
+        for i in range(1999):
+            inner = inner[0]
+        inner[0] = b"not a number"
+        self.violates(c, obj)
+
+        d = schema.DictOf(bytes, schema.ListOf(schema.TupleOf(int, bytes)))
+        self.conforms(d, {b"a": [(1, b"one")], b"b": []})
+        self.violates(d, {b"a": [(1, b"one"), (2, 2)]})
+        self.violates(d, {b"a": [(1, b"one")], 2: []})
+
     def testSet(self):
         l = schema.SetOf(schema.IntegerConstraint(), 3)
         self.conforms(l, set([]))
@@ -368,6 +389,32 @@ class Arguments(unittest.TestCase):
         self.assertRaises(schema.Violation,
                           r.checkResults, 12, False)
 
+    def test_received_arguments(self):
+        # inbound arguments are checked token by token as they arrive, so
+        # checkReceivedArgs only checks what the tokens could not
+        def foo(a=int, b=schema.ListOf(bytes), c=schema.ByteStringConstraint(
+                regexp=b"^[a-z]+$"), d=schema.ListOf(bytes, minLength=1)):
+            return None
+        r = RemoteMethodSchema(method=foo)
+        self.assertEqual(sorted(r._receivedCheckers), ["a", "c", "d"])
+        r.checkReceivedArgs((1, [b"x"]), {"c": b"abc", "d": [b"y"]})
+        self.assertRaises(schema.Violation, # out of range
+                          r.checkReceivedArgs, (2**70, []), {}, )
+        self.assertRaises(schema.Violation, # regexp
+                          r.checkReceivedArgs, (1, []), {"c": b"ABC"})
+        self.assertRaises(schema.Violation, # too short
+                          r.checkReceivedArgs, (1, [], b"abc", []), {})
+        self.assertRaises(schema.Violation, # missing required "b"
+                          r.checkReceivedArgs, (1,), {})
+
+    def test_unknown_arguments(self):
+        def foo(a=int): return None
+        r = RemoteMethodSchema(method=foo)
+        self.assertRaises(schema.Violation,
+                          r.checkAllArgs, (1,), {"b": 2}, False)
+        r.acceptUnknown = True
+        r.checkAllArgs((1,), {"b": 2}, False)
+
     def test_bad_arguments(self):
         def foo(nodefault): return str
         self.assertRaises(InvalidRemoteInterface,
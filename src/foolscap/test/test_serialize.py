@@ -32,6 +32,9 @@ class Serialize(unittest.TestCase, ShouldFailMixin):
 
     def tearDown(self):
         d = self.s.stopService()
+        # RemoteReferences left in cycles would otherwise be collected (and
+        # decref'ed, eventually) during some later test
+        d.addCallback(lambda res: gc.collect())
         d.addCallback(flushEventualQueue)
         return d
 
@@ -150,6 +153,15 @@ class Serialize(unittest.TestCase, ShouldFailMixin):
         return d.addCallback(_check)
     test_referenceable.timeout = 5
 
+    def test_tub_encoding(self):
+        # Tub.serialize must produce the same bytes as plain serialize(): a
+        # StorageBroker is not a network link, so it must not send PINGs
+        t1 = Tub()
+        d = t1.serialize({'a': 1})
+        d.addCallback(self.assertEqual,
+                      b'\x00\x87\x04\x90dict\x01\x91a\x01\x81\x00\x88')
+        return d
+
     def test_referenceables_die(self):
         # serialized data will not keep the referenceable alive
         t1 = Tub()
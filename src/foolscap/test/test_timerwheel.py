@@ -0,0 +1,146 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from foolscap.timerwheel import TimerWheel
+from foolscap.banana import Banana
+from foolscap.broker import LoopbackTransport
+from foolscap.api import Tub
+
+
+class Wheel(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000.0)
+        self.wheel = TimerWheel(tick=1.0, clock=self.clock)
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append((name, self.clock.seconds()))
+
+    def test_fire(self):
+        self.wheel.callLater(2.5, self.fire, "b")
+        self.wheel.callLater(0.2, self.fire, "a")
+        self.wheel.callLater(700.0, self.fire, "c") # more than one turn
+        # one DelayedCall, however many timers
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0.9)
+        self.assertEqual(self.fired, []) # never early
+        self.clock.advance(0.1)
+        self.assertEqual(self.fired, [("a", 1001.0)])
+        self.clock.advance(2.0)
+        self.assertEqual(self.fired[1:], [("b", 1003.0)])
+        self.clock.pump([1.0] * 697)
+        self.assertEqual(self.fired[2:], [("c", 1700.0)])
+        # and it stops ticking when there is nothing left to do
+        self.assertEqual(self.wheel.count, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancel(self):
+        t1 = self.wheel.callLater(1.0, self.fire, "a")
+        t2 = self.wheel.callLater(1.0, self.fire, "b")
+        self.assertTrue(t1.active())
+        t1.cancel()
+        t1.cancel()
+        self.assertFalse(t1.active())
+        self.assertEqual(self.wheel.count, 1)
+        self.clock.advance(1.0)
+        self.assertEqual(self.fired, [("b", 1001.0)])
+        self.assertFalse(t2.active())
+        t2.cancel() # harmless once it has fired
+        t3 = self.wheel.callLater(5.0, self.fire, "c")
+        t3.cancel()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_bulk(self):
+        # the ones that come due on the same tick fire together, in order,
+        # and may cancel each other or schedule more
+        later = []
+        def first():
+            self.fire("a")
+            t.cancel()
+            later.append(self.wheel.callLater(0, self.fire, "c"))
+        self.wheel.callLater(0.5, first)
+        t = self.wheel.callLater(0.7, self.fire, "b")
+        self.clock.advance(1.0)
+        self.assertEqual(self.fired, [("a", 1001.0)])
+        self.assertEqual(self.wheel.count, 1)
+        self.clock.advance(1.0)
+        self.assertEqual(self.fired[1:], [("c", 1002.0)])
+
+    def test_late(self):
+        # a reactor that was busy for a long time catches up all at once
+        for i in range(10):
+            self.wheel.callLater(i * 100, self.fire, i)
+        self.clock.advance(5000.0)
+        self.assertEqual([name for (name, when) in self.fired], list(range(10)))
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_fit(self):
+        self.wheel.callLater(0.3, self.fire, "a")
+        self.wheel.fitTimeout(60) # already fine enough
+        self.assertEqual(self.wheel.tick, 1.0)
+        self.wheel.fitTimeout(1.0)
+        self.assertEqual(self.wheel.tick, 0.1)
+        self.assertEqual(self.wheel.count, 1)
+        self.clock.pump([0.1] * 4)
+        [(name, when)] = self.fired
+        # within a tick of when it asked for, not a second
+        self.assertTrue(1000.3 <= when < 1000.41, when)
+
+
+class IdleBanana(Banana):
+    pings = 0
+    timedOut = False
+    def sendPING(self, number=0):
+        self.pings += 1
+    def connectionTimedOut(self):
+        self.timedOut = True
+
+
+class Idle(unittest.TestCase):
+    def makeBanana(self, keepalive=None, disconnect=None):
+        self.clock = task.Clock()
+        b = IdleBanana()
+        b.keepaliveTimeout = keepalive
+        b.disconnectTimeout = disconnect
+        b.idleTimers = TimerWheel(clock=self.clock)
+        b.transport = LoopbackTransport()
+        b.connectionMade()
+        self.addCleanup(b.connectionLost, None)
+        return b
+
+    def test_keepalive(self):
+        b = self.makeBanana(keepalive=10)
+        self.assertEqual(b.idleTimers.tick, 1.0)
+        self.clock.advance(9)
+        self.assertEqual(b.pings, 0)
+        b.dataReceived(b"") # the activity moves the deadline to 19
+        self.clock.pump([1] * 9)
+        self.assertEqual(b.pings, 0)
+        self.clock.pump([1])
+        self.assertEqual(b.pings, 1)
+        self.clock.pump([1] * 10)
+        self.assertEqual(b.pings, 2)
+        self.assertFalse(b.timedOut)
+
+    def test_disconnect(self):
+        b = self.makeBanana(disconnect=3)
+        self.assertAlmostEqual(b.idleTimers.tick, 0.3)
+        self.clock.pump([0.5] * 4)
+        b.dataReceived(b"")
+        self.clock.pump([0.5] * 4)
+        self.assertFalse(b.timedOut)
+        self.clock.pump([0.5] * 4)
+        self.assertTrue(b.timedOut)
+        self.assertIdentical(b.disconnectTimer, None)
+
+    def test_lost(self):
+        b = self.makeBanana(keepalive=10, disconnect=30)
+        self.assertEqual(b.idleTimers.count, 2)
+        b.connectionLost(None)
+        self.assertEqual(b.idleTimers.count, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_tub(self):
+        t = Tub()
+        self.assertIsInstance(t.idleTimers, TimerWheel)
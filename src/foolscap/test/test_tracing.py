@@ -0,0 +1,158 @@
+from zope.interface import implementer
+from twisted.trial import unittest
+
+from foolscap.api import Referenceable, RemoteInterface, Tub
+from foolscap import tracing
+from foolscap.tracing import Tracer, MemorySink, parseContext
+from foolscap.tokens import Violation
+from foolscap.logging import log
+from foolscap.test.common import TargetMixin
+
+
+class RIPing(RemoteInterface):
+    def ping(): return int
+
+class RITraced(RemoteInterface):
+    def work(other=RIPing): return int
+
+@implementer(RIPing)
+class PingTarget(Referenceable):
+    def remote_ping(self):
+        return 1
+
+@implementer(RITraced)
+class TracedTarget(Referenceable):
+    span = None
+    def remote_work(self, other):
+        self.span = tracing.currentSpan()
+        log.msg("working")
+        return other.callRemote("ping")
+
+
+class Contexts(unittest.TestCase):
+    def test_parse(self):
+        span = Tracer(1.0).startClientSpan("RIFoo", "bar")
+        self.assertEqual(span.name, "RIFoo.bar")
+        self.assertEqual(parseContext(span.getContext()),
+                         (span.traceID, span.spanID))
+        for bad in ["", "x", "-", span.traceID,
+                    span.traceID.upper() + "-" + span.spanID.upper(),
+                    span.traceID + "-" + span.spanID + "0",
+                    span.traceID + "-" + span.spanID + "-" + span.spanID,
+                    " " + span.traceID[1:] + "-" + span.spanID]:
+            self.assertRaises(Violation, parseContext, bad)
+
+    def test_sampling(self):
+        self.assertIdentical(Tracer(0.0).startClientSpan("RIFoo", "bar"),
+                             None)
+        root = Tracer(1.0).startClientSpan("RIFoo", "bar")
+        self.assertEqual(root.kind, "client")
+        self.assertIdentical(root.parentID, None)
+        # once a trace has started, the rate does not matter
+        server = Tracer(0.0).startServerSpan(parseContext(root.getContext()),
+                                             "RIFoo", "bar")
+        child = tracing.runInSpan(server, Tracer(0.0).startClientSpan,
+                                  None, "baz")
+        self.assertEqual(child.traceID, root.traceID)
+        self.assertEqual(child.parentID, server.spanID)
+        self.assertEqual(child.name, "?.baz")
+        self.assertIdentical(tracing.currentSpan(), None)
+
+    def test_sink(self):
+        sink = MemorySink(maxSpans=2)
+        tracer = Tracer(1.0, sink)
+        spans = [tracer.startClientSpan("RIFoo", "bar") for i in range(3)]
+        for span in spans:
+            span.finish()
+        spans[2].finish(failed=True) # only the first finish counts
+        self.assertEqual(sink.getSpans(), spans[1:])
+        self.assertEqual(sink.getSpans(spans[2].traceID), [spans[2]])
+        self.assertFalse(spans[2].failed)
+        self.assertTrue(spans[2].duration >= 0)
+
+
+class Calls(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.events = []
+        log.theLogger.addImmediateObserver(self.events.append)
+        self.addCleanup(log.theLogger.removeImmediateObserver,
+                        self.events.append)
+
+    def setupTracedBrokers(self, version=198, sampleRate=1.0):
+        self.setupBrokers({"banana-decision-version": version})
+        self.callingBroker.tracer = Tracer(sampleRate)
+        self.targetBroker.tracer = Tracer(0.0) # it follows the caller
+        return self.setupTarget(TracedTarget(), True)
+
+    def test_propagate(self):
+        rr, target = self.setupTracedBrokers()
+        d = rr.callRemote("work", PingTarget())
+        def _check(res):
+            self.assertEqual(res, 1)
+            # spans are recorded as they finish, innermost first
+            [ping, client] = self.callingBroker.tracer.sink.getSpans()
+            [child, server] = self.targetBroker.tracer.sink.getSpans()
+            traceID = client.traceID
+            # calling side: work() starts the trace
+            self.assertEqual((client.kind, client.name, client.parentID),
+                             ("client", RITraced.__remote_name__ + ".work",
+                              None))
+            # target side: the server span of work(), which is current while
+            # the method runs, and the client span of its ping()
+            self.assertIdentical(target.span, server)
+            self.assertEqual((server.kind, server.traceID, server.parentID),
+                             ("server", traceID, client.spanID))
+            self.assertEqual((child.kind, child.traceID, child.parentID),
+                             ("client", traceID, server.spanID))
+            # and back on the calling side, the server span of ping()
+            self.assertEqual((ping.kind, ping.name, ping.traceID,
+                              ping.parentID),
+                             ("server", RIPing.__remote_name__ + ".ping",
+                              traceID, child.spanID))
+            for span in [client, server, child, ping]:
+                self.assertFalse(span.failed)
+            [event] = [e for e in self.events if e.get("message") == "working"]
+            self.assertEqual(event["trace_id"], traceID)
+            self.assertEqual(event["span_id"], server.spanID)
+            self.assertIdentical(tracing.currentSpan(), None)
+        d.addCallback(_check)
+        return d
+
+    def test_not_sampled(self):
+        rr, target = self.setupTracedBrokers(sampleRate=0.0)
+        d = rr.callRemote("work", PingTarget())
+        def _check(res):
+            self.assertEqual(res, 1)
+            self.assertIdentical(target.span, None)
+            self.assertEqual(self.callingBroker.tracer.sink.getSpans(), [])
+            self.assertEqual(self.targetBroker.tracer.sink.getSpans(), [])
+            [event] = [e for e in self.events if e.get("message") == "working"]
+            self.assertNotIn("trace_id", event)
+        d.addCallback(_check)
+        return d
+
+    def test_old_peer(self):
+        # the far end would reject the extra field, so it is not sent, and
+        # only the caller's span is recorded
+        rr, target = self.setupTracedBrokers(version=197)
+        d = rr.callRemote("work", PingTarget())
+        def _check(res):
+            self.assertEqual(res, 1)
+            self.assertIdentical(target.span, None)
+            [client] = self.callingBroker.tracer.sink.getSpans()
+            self.assertEqual(client.kind, "client")
+            self.assertEqual(self.targetBroker.tracer.sink.getSpans(), [])
+        d.addCallback(_check)
+        return d
+
+
+class Options(unittest.TestCase):
+    def test_options(self):
+        t = Tub()
+        self.assertEqual(t.tracer.sampleRate, 0.0)
+        t.setOption("trace-sample-rate", 0.25)
+        self.assertEqual(t.tracer.sampleRate, 0.25)
+        sink = MemorySink()
+        t.setOption("trace-sink", sink)
+        self.assertIdentical(t.tracer.sink, sink)
@@ -0,0 +1,178 @@
+# -*- test-case-name: foolscap.test.test_timerwheel -*-
+
+"""A coarse timer wheel for the idle deadlines of many connections.
+
+Each connection wants to hear about it when it has been quiet for
+keepaliveTimeout or disconnectTimeout seconds. Giving every Broker its own
+reactor.callLater puts two DelayedCalls per connection into the reactor's
+heap, and they are re-armed all the time. The TimerWheel holds them all
+instead: it hashes each deadline into one of SLOTS buckets by its tick
+number, and a single DelayedCall visits the buckets once per tick, firing
+whatever has come due in bulk. Scheduling and cancelling are O(1), and a
+tick only looks at one bucket.
+
+Deadlines are rounded up to the next tick, so they fire a little late, but
+never early. The tick is made fine enough for the shortest timeout in use
+(see fitTimeout), and is one second at most.
+
+The wheel also keeps 'now', the time of its latest tick, for connections to
+stamp their activity with: Banana.dataReceived records it rather than
+asking the clock, and the idle checks compare against it.
+"""
+
+from twisted.internet import reactor
+from twisted.python import log
+
+class WheelTimer(object):
+    """A callback scheduled on a TimerWheel, returned by callLater()."""
+
+    # there are a couple of these for every connection
+    __slots__ = ("wheel", "when", "due", "f", "args", "kwargs",
+                 "called", "cancelled")
+
+    def __init__(self, wheel, when, f, args, kwargs):
+        self.wheel = wheel
+        self.when = when
+        self.due = None # the tick number, set by the wheel
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.called = False
+        self.cancelled = False
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        if self.active():
+            self.cancelled = True
+            self.wheel._remove(self)
+
+    def __repr__(self):
+        return "<WheelTimer %s at %s>" % (getattr(self.f, "__name__", self.f),
+                                          self.when)
+
+
+class TimerWheel(object):
+    """I run callbacks at (roughly) the time they ask for, using a single
+    DelayedCall that ticks every 'tick' seconds while anything is scheduled.
+    Each Tub has one, shared by all of its Brokers."""
+
+    SLOTS = 512
+    MAX_TICK = 1.0
+    # the tick is at most this fraction of the shortest timeout in use
+    TICKS_PER_TIMEOUT = 10
+
+    def __init__(self, tick=MAX_TICK, clock=None):
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.tick = tick
+        self.slots = {} # slot number -> set of WheelTimers, if any
+        self.count = 0
+        self.now = clock.seconds()
+        self.lastTick = self._tickNumber(self.now)
+        self._timer = None
+
+    def _tickNumber(self, when):
+        return int(when // self.tick)
+
+    def fitTimeout(self, seconds):
+        """Make sure the tick is fine enough to measure a timeout of this
+        many seconds: if it is too coarse, make it finer, and re-hash
+        everything that is scheduled."""
+        tick = float(seconds) / self.TICKS_PER_TIMEOUT
+        if tick >= self.tick or tick <= 0:
+            return
+        timers = [t for slot in self.slots.values() for t in slot]
+        self.tick = tick
+        self.slots = {}
+        self.count = 0
+        self.lastTick = self._tickNumber(self.now)
+        for t in timers:
+            self._insert(t)
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+            self._schedule()
+
+    def callLater(self, delay, f, *args, **kwargs):
+        """Call f(*args, **kwargs) after at least 'delay' seconds. Returns a
+        WheelTimer, which can be cancelled."""
+        if not self.count:
+            # we have not been ticking, so 'now' is stale
+            self.now = self.clock.seconds()
+            self.lastTick = self._tickNumber(self.now)
+        t = WheelTimer(self, self.now + delay, f, args, kwargs)
+        self._insert(t)
+        if not self._timer:
+            self._schedule()
+        return t
+
+    def _insert(self, t):
+        # round up, so it fires at the first tick at or after its time,
+        # and never on the tick that is being processed right now
+        due = int(-(-t.when // self.tick))
+        if due <= self.lastTick:
+            due = self.lastTick + 1
+        t.due = due
+        slot = self.slots.get(due % self.SLOTS)
+        if slot is None:
+            slot = self.slots[due % self.SLOTS] = set()
+        slot.add(t)
+        self.count += 1
+
+    def _remove(self, t):
+        if t.due is None:
+            return # already taken off the wheel, to be fired
+        slot = self.slots[t.due % self.SLOTS]
+        slot.discard(t)
+        if not slot:
+            del self.slots[t.due % self.SLOTS]
+        t.due = None
+        self.count -= 1
+        if not self.count and self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _schedule(self):
+        if self._timer or not self.count:
+            return
+        delay = max((self.lastTick + 1) * self.tick - self.clock.seconds(), 0)
+        self._timer = self.clock.callLater(delay, self._tickFired)
+
+    def _tickFired(self):
+        self._timer = None
+        self.now = self.clock.seconds()
+        first = self.lastTick + 1
+        # we were scheduled for tick 'first', so we have reached it, even if
+        # rounding says otherwise
+        current = max(self._tickNumber(self.now), first)
+        # if we were held up for more than a whole turn of the wheel, every
+        # slot needs a look, but only once
+        last = min(current, first + self.SLOTS - 1)
+        self.lastTick = current
+        expired = []
+        for tick in range(first, last + 1):
+            slot = self.slots.get(tick % self.SLOTS)
+            if not slot:
+                continue
+            due = [t for t in slot if t.due <= current]
+            if due:
+                slot.difference_update(due)
+                if not slot:
+                    del self.slots[tick % self.SLOTS]
+                expired.extend(due)
+        self.count -= len(expired)
+        for t in expired:
+            t.due = None
+        expired.sort(key=lambda t: t.when)
+        for t in expired:
+            if t.cancelled:
+                continue
+            t.called = True
+            try:
+                t.f(*t.args, **t.kwargs)
+            except Exception:
+                log.err()
+        self._schedule()
@@ -42,12 +42,22 @@ tokenNames = {
     STRING : 'STRING',
     BVOCAB : 'BVOCAB',
     SVOCAB : 'SVOCAB',
+    NONE   : 'NONE',
+    TRUE   : 'TRUE',
+    FALSE  : 'FALSE',
 }
 
 
 #SIZE_LIMIT = 1000  # default limit on the body length of long tokens (STRING, ERROR)
 SIZE_LIMIT = 640 * 1024   # 640k is all you'll ever need :-)
 
+# outbound priority lanes, most urgent first. Top-level objects are
+# serialized one at a time, so these only decide which queued object goes
+# next, they never interrupt one that has already started.
+PRIORITY_HIGH   = 0 # decref, small control messages
+PRIORITY_NORMAL = 1 # the default
+PRIORITY_BULK   = 2 # large transfers that should yield to everything else
+
 
 class InvalidRemoteInterface(Exception):
     pass
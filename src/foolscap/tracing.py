@@ -0,0 +1,146 @@
+# -*- test-case-name: foolscap.test.test_tracing -*-
+
+"""Follow one request across several Tubs.
+
+A traced call carries a small trace context (the trace ID, and the span ID
+of the call that made it) at the end of its (call) or (pipeline) sequence.
+Each hop records a Span: a 'client' span for every callRemote, from the call
+to its answer, and a 'server' span for every inbound call, from invocation
+to answer. Spans that share a traceID belong to the same request, and each
+one names its parent, so they can be put back together into a tree.
+
+Sampling is decided once, at the head of the request: a Tub starts a new
+trace for a fraction (the 'trace-sample-rate' option, 0 by default) of the
+calls it makes on its own, and every call made while a traced call is being
+served continues that trace, whatever its own rate. Calls that are not
+sampled carry no context and record nothing.
+
+While a traced remote_ method runs, currentSpan() returns its span, log
+events get its 'trace_id' and 'span_id', and the calls it makes become its
+children. The span is only current until the method returns: to continue
+the trace from a later callback, save currentSpan() and use runInSpan().
+"""
+
+import re, time, random
+from collections import deque
+from foolscap.tokens import Violation
+
+# the wire form of a context is "<trace ID>-<parent span ID>", in hex
+TRACE_ID_DIGITS = 32
+SPAN_ID_DIGITS = 16
+MAX_CONTEXT_LENGTH = 64
+CONTEXT_RE = re.compile(r"^([0-9a-f]{%d})-([0-9a-f]{%d})$"
+                        % (TRACE_ID_DIGITS, SPAN_ID_DIGITS))
+
+# the span of the traced call that is being served right now, if any
+_current = None
+
+def currentSpan():
+    """Return the Span of the traced remote_ method that is running now, or
+    None."""
+    return _current
+
+def runInSpan(span, f, *args, **kwargs):
+    """Run f(*args, **kwargs) with 'span' as the current span, so the calls
+    it makes and the log events it emits belong to that span's trace."""
+    global _current
+    previous, _current = _current, span
+    try:
+        return f(*args, **kwargs)
+    finally:
+        _current = previous
+
+def parseContext(data):
+    """Return (traceID, parentID) from the wire form of a trace context."""
+    mo = CONTEXT_RE.search(data)
+    if not mo:
+        raise Violation("malformed trace context %r" % (data,))
+    return mo.group(1), mo.group(2)
+
+def _newID(digits):
+    return "%0*x" % (digits, random.getrandbits(4 * digits))
+
+
+class Span:
+    """One hop of a traced request: a call we made (kind 'client') or one
+    that we served (kind 'server'). 'start' is wall-clock time, so spans
+    from different hosts can be lined up, while 'duration' is measured with
+    a monotonic clock."""
+
+    def __init__(self, sink, traceID, parentID, kind,
+                 interfaceName, methodName):
+        self.sink = sink
+        self.traceID = traceID
+        self.spanID = _newID(SPAN_ID_DIGITS)
+        self.parentID = parentID # None for the head of the trace
+        self.kind = kind
+        # named like the Tub's call statistics
+        self.name = "%s.%s" % (interfaceName or "?", methodName or "?")
+        self.start = time.time()
+        self._started = time.monotonic()
+        self.duration = None # set when finished
+        self.failed = False
+
+    def getContext(self):
+        """Return the trace context for the calls made as part of this
+        span, in its wire form."""
+        return "%s-%s" % (self.traceID, self.spanID)
+
+    def finish(self, failed=False):
+        if self.duration is not None:
+            return
+        self.duration = time.monotonic() - self._started
+        self.failed = failed
+        if self.sink is not None:
+            self.sink.record(self)
+
+    def __repr__(self):
+        return "<Span %s %s %s/%s>" % (self.kind, self.name,
+                                       self.traceID, self.spanID)
+
+
+class MemorySink:
+    """I keep the most recent maxSpans finished Spans. Any object with a
+    record(span) method can be used as a sink instead (see the Tub's
+    'trace-sink' option), for example to hand them to a tracing system."""
+
+    def __init__(self, maxSpans=1000):
+        self.spans = deque(maxlen=maxSpans)
+
+    def record(self, span):
+        self.spans.append(span)
+
+    def getSpans(self, traceID=None):
+        if traceID is None:
+            return list(self.spans)
+        return [s for s in self.spans if s.traceID == traceID]
+
+
+class Tracer:
+    """I decide which calls are traced, and create their Spans. Each Tub
+    has one, shared by its Brokers."""
+
+    def __init__(self, sampleRate=0.0, sink=None):
+        self.sampleRate = sampleRate
+        if sink is None:
+            sink = MemorySink()
+        self.sink = sink
+
+    def startClientSpan(self, interfaceName, methodName):
+        """Return a Span for an outbound call, or None if it is not
+        traced."""
+        parent = _current
+        if parent is not None:
+            return Span(self.sink, parent.traceID, parent.spanID,
+                        "client", interfaceName, methodName)
+        if self.sampleRate and random.random() < self.sampleRate:
+            return Span(self.sink, _newID(TRACE_ID_DIGITS), None,
+                        "client", interfaceName, methodName)
+        return None
+
+    def startServerSpan(self, context, interfaceName, methodName):
+        """Return a Span for an inbound call that arrived with the given
+        (traceID, parentID) context."""
+        traceID, parentID = context
+        return Span(self.sink, traceID, parentID, "server",
+                    interfaceName, methodName)
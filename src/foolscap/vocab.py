@@ -62,10 +62,122 @@ INITIAL_VOCAB_TABLES = {0: vocab_v0, 1: vocab_v1, 191: vocab_v191}
 
 
 def hashVocabTable(table_index):
-    data = b'\x00'.join(INITIAL_VOCAB_TABLES[table_index])
+    return hashVocabWords(INITIAL_VOCAB_TABLES[table_index])
+
+
+def hashVocabWords(words):
+    data = b'\x00'.join(words)
     digest = hashlib.sha1(data).hexdigest()
     return digest[:8]
 
 
 def getVocabIndices():
     return sorted(INITIAL_VOCAB_TABLES.keys())
+
+
+class AdaptiveVocabulary:
+    """I decide which outbound strings earn an entry in a connection's
+    vocabulary table, on top of the negotiated initial table.
+
+    Banana reports every BYTES/STRING token it sends with hit() (the string
+    went out as a VOCAB token) or miss() (it went out in full). A string
+    that misses promoteAfter times is added to the table with an
+    (add-vocab) sequence. Once maxEntries strings have been added, each new
+    one reuses the index of the entry with the fewest hits. After
+    maxEntries such evictions, the table is reset with a (set-vocab)
+    sequence holding the initial table plus the busier half of the adaptive
+    entries, and all counts start over.
+
+    @ivar base: the initial table, which is never evicted
+    @ivar entries: maps each adaptive entry to its hits since it was added
+    @ivar candidates: maps strings to their misses so far
+    """
+
+    promoteAfter  = 3     # misses before a string is added to the table
+    maxEntries    = 1024  # adaptive entries, not counting the base table
+    maxCandidates = 4096  # candidate counts are halved beyond this
+    minLength     = 2     # shorter strings gain nothing from a VOCAB token
+    maxLength     = 100   # AddVocabUnslicer rejects longer values
+
+    def __init__(self):
+        self.base = []
+        self.entries = {}
+        self.candidates = {}
+        self.hits = 0
+        self.misses = 0
+        self.promotions = 0
+        self.evictions = 0
+        self.resets = 0
+        self.evictionsSinceReset = 0
+
+    def hit(self, value):
+        self.hits += 1
+        entries = self.entries
+        if value in entries:
+            entries[value] += 1
+
+    def miss(self, value):
+        """Count a string that was sent in full. Return True if it should be
+        added to the table now."""
+        self.misses += 1
+        if not self.minLength <= len(value) <= self.maxLength:
+            return False
+        count = self.candidates.pop(value, 0) + 1
+        if self.promoteAfter <= count:
+            return True
+        self.candidates[value] = count
+        if self.maxCandidates < len(self.candidates):
+            # age the counts, forgetting strings that have only been seen once
+            self.candidates = {v: n // 2 for v, n in self.candidates.items() if 1 < n}
+        return False
+
+    def isFull(self):
+        return self.maxEntries <= len(self.entries)
+
+    def added(self, value):
+        self.entries[value] = 0
+        self.promotions += 1
+
+    def evict(self):
+        """Forget the adaptive entry with the fewest hits and return it, so
+        its index can be reused."""
+        victim = min(self.entries, key=self.entries.get)
+        del self.entries[victim]
+        self.evictions += 1
+        self.evictionsSinceReset += 1
+        return victim
+
+    def wantsReset(self):
+        return self.maxEntries <= self.evictionsSinceReset
+
+    def resetTable(self):
+        """Return the strings for a (set-vocab) sequence, in index order, and
+        start counting over."""
+        ranked = sorted(self.entries, key=self.entries.get, reverse=True)
+        keep = ranked[:self.maxEntries // 2]
+        self.candidates = {}
+        self.resets += 1
+        self.evictionsSinceReset = 0
+        return self.base + keep
+
+    def replaced(self, table):
+        # the whole outbound table was replaced (by a set-vocab sequence or
+        # by populateVocabTable): whatever is not in the base table counts as
+        # adaptive from now on
+        base = set(self.base)
+        self.entries = {v: 0 for v in table if v not in base}
+
+    def hitRate(self):
+        sent = self.hits + self.misses
+        return self.hits / sent if sent else 0.0
+
+    def getStats(self):
+        return {
+            'hits'      : self.hits,
+            'misses'    : self.misses,
+            'hit-rate'  : self.hitRate(),
+            'entries'   : len(self.base) + len(self.entries),
+            'promotions': self.promotions,
+            'evictions' : self.evictions,
+            'resets'    : self.resets,
+        }